@@ -4,6 +4,7 @@ from common.book import Book
 from common.middleware import Middleware
 from common.eof_packet import EOFPacket
 from common.persistence_manager import PersistenceManager
+from common.state_log import StateLog
 import json
 
 REQUIRED_DECADES = 10
@@ -21,6 +22,8 @@ class DecadeCounter:
         self.cluster_size = cluster_size
         self.persistence_manager = PersistenceManager(
             f'../storage/decade_counter_{instance_id}')
+        # Logs [author, decade] per new decade of an author
+        self.state_log = StateLog(self.persistence_manager, 'authors', self._apply_decade)
         self._init_state()
         self.middleware = Middleware(
             input_queues=input_queues,
@@ -28,7 +31,8 @@ class DecadeCounter:
             eof_callback=self.handle_eof,
             output_queues=output_queues,
             instance_id=instance_id,
-            persistence_manager=self.persistence_manager)
+            persistence_manager=self.persistence_manager,
+            cluster_size=cluster_size)
 
     def start(self):
         self.middleware.start()
@@ -39,19 +43,9 @@ class DecadeCounter:
 
     def handle_eof(self, eof_packet: EOFPacket):
         logging.debug(f" [x] Received EOF: {eof_packet}")
-        if self.instance_id not in eof_packet.ack_instances:
-            eof_packet.ack_instances.append(self.instance_id)
-            self.persistence_manager.delete_keys(f"{AUTHOR_PREFIX}{eof_packet.client_id}_", secondary_key=str(eof_packet.client_id))
-            self.authors.pop(eof_packet.client_id, None)
-
-        if len(eof_packet.ack_instances) == self.cluster_size:
-            self.middleware.send(
-                EOFPacket(
-                    eof_packet.client_id,
-                    eof_packet.packet_id).encode())
-            logging.debug(f" [x] Sent EOF: {eof_packet}")
-        else:
-            self.middleware.return_eof(eof_packet)
+        self.state_log.clear(eof_packet.client_id)
+        self.persistence_manager.delete_keys(f"{AUTHOR_PREFIX}{eof_packet.client_id}_", secondary_key=str(eof_packet.client_id))
+        self.authors.pop(eof_packet.client_id, None)
 
     def add_decade(self, book: Book):
         author = book.authors if book.authors else None
@@ -61,15 +55,12 @@ class DecadeCounter:
         client_id = book.client_id
         decade = (book.year // 10) * 10
         self.authors[client_id] = self.authors.get(client_id, {})
-        self.authors[client_id][author] = self.authors[client_id].get(author, [])
 
-        if decade in self.authors[client_id][author]:
+        if decade in self.authors[client_id].get(author, []):
             return
 
-        self.authors[client_id][author].append(decade)
-        key = f'{AUTHOR_PREFIX}{client_id}_{author}'
-        self.persistence_manager.put(
-            key, json.dumps(self.authors[client_id][author]), secondary_key=str(client_id))
+        self._apply_decade(self.authors[client_id], [author, decade])
+        self.state_log.record(client_id, [author, decade], self.authors[client_id])
 
         if len(self.authors[client_id][author]) == REQUIRED_DECADES:
             authors_packet = Authors(
@@ -78,14 +69,22 @@ class DecadeCounter:
                 authors=author
             )
             logging.info(f"Author {author} has published books in {REQUIRED_DECADES} different decades. Client id: {client_id}")
-            self.middleware.send(authors_packet.encode())
+            self.middleware.send(authors_packet)
+
+    def _apply_decade(self, authors: dict[str, list], delta: list):
+        [author, decade] = delta
+        decades = authors.setdefault(author, [])
+        if decade not in decades:
+            decades.append(decade)
 
     def _init_state(self):
         self.authors = {}
+        # Decades of an author per key, written by previous versions
         for (key, secondary_key) in self.persistence_manager.get_keys(AUTHOR_PREFIX):
             [client_id, author] = key.removeprefix(AUTHOR_PREFIX).split('_', maxsplit=1)
             client_id = int(client_id)
             if client_id not in self.authors:
                 self.authors[client_id] = {}
             self.authors[client_id][author] = json.loads(self.persistence_manager.get(key, secondary_key) or '[]')
+        self.authors = self.state_log.load(self.authors)
         logging.info(f"State initialized with {self.authors}")
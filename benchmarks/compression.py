@@ -0,0 +1,128 @@
+"""Size and cost of compressing batches of reviews, and its effect on RabbitMQ.
+
+    python3 benchmarks/compression.py --reviews datasets/Books_rating.csv
+    RABBITMQ_HOST=localhost python3 benchmarks/compression.py --reviews datasets/Books_rating.csv --rabbitmq
+
+Reviews are batched the way the Middleware batches them (MIDDLEWARE_BATCH_SIZE
+packets per message). For each zlib level the ratio and the compression and
+decompression throughput are printed. Without --reviews, the books of
+example_datasets are used instead.
+
+With --rabbitmq, the whole dataset is published to a scratch queue, once
+uncompressed and once per level, and then consumed back. The memory used by
+the RabbitMQ node (from the management API, on port 15672) is sampled once
+everything was published, and the time to publish and consume it all is
+measured end to end.
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import urllib.request
+import zlib
+
+from middleware_backends import ROOT, load_books
+from wire_format import load_reviews
+
+sys.path.insert(0, ROOT)
+
+from common.batch_packet import BatchPacket  # noqa: E402
+from common.middleware import BATCH_SIZE, COMPRESSED_ENCODING, RABBITMQ_HOST, RABBITMQ_PORT  # noqa: E402
+
+SCRATCH_QUEUE = 'benchmark_compression'
+MANAGEMENT_PORT = int(os.getenv('RABBITMQ_MANAGEMENT_PORT', '15672'))
+LEVELS = [1, 3, 6, 9]
+
+
+def load_batches(reviews_path: str, n_packets: int) -> list[bytes]:
+    if reviews_path:
+        packets = [review.encode() for review in load_reviews(reviews_path, n_packets)]
+    else:
+        packets = load_books(n_packets)
+    return [BatchPacket(packets[i:i + BATCH_SIZE]).encode().encode()
+            for i in range(0, len(packets), BATCH_SIZE)]
+
+
+def measure_codec(batches: list[bytes], level: int) -> dict:
+    started = time.perf_counter()
+    compressed = [zlib.compress(batch, level) for batch in batches]
+    compress_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    for body in compressed:
+        zlib.decompress(body)
+    decompress_seconds = time.perf_counter() - started
+    raw_bytes = sum(len(batch) for batch in batches)
+    return {
+        'level': level,
+        'ratio': round(sum(len(body) for body in compressed) / raw_bytes, 3),
+        'compress_mb_per_second': round(raw_bytes / compress_seconds / 1e6, 1),
+        'decompress_mb_per_second': round(raw_bytes / decompress_seconds / 1e6, 1),
+    }
+
+
+def node_memory() -> int:
+    request = urllib.request.Request(f'http://{RABBITMQ_HOST}:{MANAGEMENT_PORT}/api/nodes')
+    request.add_header('Authorization', 'Basic ' + base64.b64encode(b'guest:guest').decode())
+    with urllib.request.urlopen(request) as response:
+        return sum(node['mem_used'] for node in json.load(response))
+
+
+def measure_broker(batches: list[bytes], level: int) -> dict:
+    import pika
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST, RABBITMQ_PORT))
+    channel = connection.channel()
+    channel.queue_declare(queue=SCRATCH_QUEUE)
+    channel.queue_purge(queue=SCRATCH_QUEUE)
+    memory_before = node_memory()
+
+    started = time.monotonic()
+    properties = pika.BasicProperties(content_encoding=COMPRESSED_ENCODING) if level else None
+    for batch in batches:
+        body = zlib.compress(batch, level) if level else batch
+        channel.basic_publish(exchange='', routing_key=SCRATCH_QUEUE, body=body, properties=properties)
+    published = time.monotonic() - started
+    # The management API refreshes its stats every few seconds
+    time.sleep(6)
+    memory_published = node_memory()
+
+    started = time.monotonic()
+    received = 0
+    for _method, properties, body in channel.consume(SCRATCH_QUEUE, auto_ack=True):
+        if properties.content_encoding == COMPRESSED_ENCODING:
+            body = zlib.decompress(body)
+        received += 1
+        if received == len(batches):
+            break
+    consumed = time.monotonic() - started
+    channel.cancel()
+    connection.close()
+    return {
+        'level': level,
+        'broker_memory_mb': round((memory_published - memory_before) / 1e6, 1),
+        'publish_seconds': round(published, 3),
+        'consume_seconds': round(consumed, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reviews', help='path to Books_rating.csv')
+    parser.add_argument('--packets', type=int, default=None, help='defaults to the whole dataset')
+    parser.add_argument('--rabbitmq', action='store_true')
+    args = parser.parse_args()
+
+    n_packets = args.packets or (sys.maxsize if args.reviews else 20000)
+    batches = load_batches(args.reviews, n_packets)
+    print(json.dumps({'batches': len(batches), 'bytes': sum(len(batch) for batch in batches)}))
+    for level in LEVELS:
+        print(json.dumps(measure_codec(batches, level)))
+    if args.rabbitmq:
+        for level in [0] + LEVELS:
+            print(json.dumps(measure_broker(batches, level)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Throughput of a BookFilter -> Router DAG running in one process.
+
+Uses the in-process MemoryBroker (MIDDLEWARE_BACKEND=memory), so no RabbitMQ
+is needed and runs are repeatable:
+
+    python3 benchmarks/memory_pipeline.py --packets 100000 --filters 2 --routers 2
+
+Every stage instance runs in its own thread. The input queue is preloaded
+with books from example_datasets followed by an EOF, and the clock runs from
+the moment the stages start until that EOF comes out of the routers. With
+--profile every stage thread runs under cProfile and the aggregated stats
+are printed, free of any broker noise.
+"""
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+os.environ['MIDDLEWARE_BACKEND'] = 'memory'
+
+from middleware_backends import load_books, load_stage_module  # noqa: E402
+
+INPUT_QUEUE = 'pipeline_books'
+FILTERED_QUEUE = 'pipeline_filtered'
+ROUTED_QUEUE = 'pipeline_routed'
+
+
+def create_stages(n_filters: int, n_routers: int, n_outputs: int) -> list:
+    os.environ['FILTER_BY_FIELD'] = '"year"'
+    os.environ['FILTER_BY_VALUES'] = '[0, 9999]'
+    book_filter = load_stage_module('book_filter')
+    router = load_stage_module('router')
+    filters = [book_filter.BookFilter({INPUT_QUEUE: ''}, [FILTERED_QUEUE], [], i, n_filters)
+               for i in range(n_filters)]
+    routers = [router.Router({FILTERED_QUEUE: ''}, [ROUTED_QUEUE], [], 'title', i, n_routers, n_outputs)
+               for i in range(n_routers)]
+    return filters + routers
+
+
+def run_stage(stage, profiles: list):
+    if profiles is None:
+        stage.start()
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    stage.start()
+    profile.disable()
+    profiles.append(profile)
+
+
+def wait_for_eof(n_outputs: int) -> int:
+    from common.memory_broker import BROKER, MemoryConnection
+    from common.packet_decoder import PacketDecoder
+    from common.packet_type import PacketType
+
+    received = 0
+    channel = MemoryConnection().channel()
+
+    def on_message(ch, method, properties, body):
+        nonlocal received
+        packet = PacketDecoder.decode(body)
+        packets = packet.packets if packet.packet_type == PacketType.BATCH else [packet]
+        received += sum(1 for p in packets if p.packet_type != PacketType.EOF)
+        if any(p.packet_type == PacketType.EOF for p in packets):
+            ch.stop_consuming()
+
+    for i in range(n_outputs):
+        channel.basic_consume(f'{ROUTED_QUEUE}_{i}', on_message, auto_ack=True)
+    channel.start_consuming()
+    # Packets were published before the EOF, but some may still wait in the
+    # queues of the other outputs
+    for i in range(n_outputs):
+        for (body, _exchange, _routing_key, _redelivered, _properties) in BROKER.queues[f'{ROUTED_QUEUE}_{i}']:
+            packet = PacketDecoder.decode(body)
+            packets = packet.packets if packet.packet_type == PacketType.BATCH else [packet]
+            received += sum(1 for p in packets if p.packet_type != PacketType.EOF)
+    return received
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--packets', type=int, default=100000)
+    parser.add_argument('--filters', type=int, default=2)
+    parser.add_argument('--routers', type=int, default=2)
+    parser.add_argument('--outputs', type=int, default=2)
+    parser.add_argument('--profile', action='store_true')
+    args = parser.parse_args()
+
+    from common.eof_packet import EOFPacket
+    from common.memory_broker import BROKER
+
+    stages = create_stages(args.filters, args.routers, args.outputs)
+    for book in load_books(args.packets):
+        BROKER.publish('', INPUT_QUEUE, book.encode())
+    BROKER.publish('', INPUT_QUEUE, EOFPacket(0, args.packets).encode().encode())
+
+    profiles = [] if args.profile else None
+    threads = [threading.Thread(target=run_stage, args=(stage, profiles)) for stage in stages]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    received = wait_for_eof(args.outputs)
+    elapsed = time.monotonic() - started
+    for stage in stages:
+        stage.shutdown()
+    for thread in threads:
+        thread.join()
+
+    print(json.dumps({
+        'packets': args.packets,
+        'received': received,
+        'filters': args.filters,
+        'routers': args.routers,
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(args.packets / elapsed, 1),
+    }))
+    if profiles:
+        output = io.StringIO()
+        stats = pstats.Stats(profiles[0], stream=output)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.sort_stats('cumulative').print_stats(25)
+        print(output.getvalue())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
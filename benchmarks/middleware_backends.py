@@ -0,0 +1,142 @@
+"""Messages per second of a Router and a BookFilter on each Middleware backend.
+
+Needs a RabbitMQ reachable at RABBITMQ_HOST:RABBITMQ_PORT, e.g.:
+
+    docker compose -f docker-compose-rabbit.yaml up -d
+    RABBITMQ_HOST=localhost python3 benchmarks/middleware_backends.py
+
+Every (stage, backend) pair runs in its own process, since the backend is
+chosen with MIDDLEWARE_BACKEND when common.middleware is imported. The input
+queue is preloaded with books from example_datasets followed by an EOF, and
+the clock runs from the moment the stage starts consuming until that EOF
+shows up in its output queue.
+"""
+import argparse
+import csv
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BOOKS_PATH = os.path.join(ROOT, 'example_datasets', 'books_data.csv')
+BACKENDS = ['blocking', 'asyncio']
+STAGES = ['router', 'book_filter']
+INPUT_QUEUE = 'benchmark_input'
+OUTPUT_QUEUE = 'benchmark_output'
+
+
+def load_books(n_packets: int) -> list[str]:
+    from common.book import Book
+
+    with open(BOOKS_PATH, newline='') as f:
+        rows = list(csv.reader(f))[1:]
+    books = []
+    while len(books) < n_packets:
+        for row in rows:
+            line = io.StringIO()
+            csv.writer(line).writerow(row)
+            book = Book.from_csv_row(line.getvalue(), 0, len(books))
+            if book:
+                books.append(book.encode())
+            if len(books) == n_packets:
+                break
+    return books
+
+
+def load_stage_module(stage: str):
+    path = os.path.join(ROOT, stage, 'src', f'{stage}.py')
+    spec = importlib.util.spec_from_file_location(f'benchmark_{stage}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def create_stage(stage: str):
+    if stage == 'router':
+        module = load_stage_module('router')
+        return module.Router({INPUT_QUEUE: ''}, [OUTPUT_QUEUE], [], 'title', 0, 1, 1), f'{OUTPUT_QUEUE}_0'
+
+    os.environ['FILTER_BY_FIELD'] = '"year"'
+    os.environ['FILTER_BY_VALUES'] = '[0, 9999]'
+    module = load_stage_module('book_filter')
+    return module.BookFilter({INPUT_QUEUE: ''}, [OUTPUT_QUEUE], [], 0, 1), OUTPUT_QUEUE
+
+
+def preload(n_packets: int, output_queue: str):
+    import pika
+    from common.eof_packet import EOFPacket
+    from common.middleware import RABBITMQ_HOST, RABBITMQ_PORT
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST, RABBITMQ_PORT))
+    channel = connection.channel()
+    for queue in [INPUT_QUEUE, output_queue]:
+        channel.queue_declare(queue=queue)
+        channel.queue_purge(queue=queue)
+    for book in load_books(n_packets):
+        channel.basic_publish(exchange='', routing_key=INPUT_QUEUE, body=book)
+    channel.basic_publish(exchange='', routing_key=INPUT_QUEUE, body=EOFPacket(0, n_packets).encode())
+    connection.close()
+
+
+def wait_for_eof(output_queue: str, result: dict, on_eof):
+    import pika
+    from common.middleware import RABBITMQ_HOST, RABBITMQ_PORT
+    from common.packet_decoder import PacketDecoder
+    from common.packet_type import PacketType
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST, RABBITMQ_PORT))
+    channel = connection.channel()
+    for _method, _properties, body in channel.consume(output_queue, auto_ack=True):
+        packet = PacketDecoder.decode(body)
+        packets = packet.packets if packet.packet_type == PacketType.BATCH else [packet]
+        result['packets'] += sum(1 for p in packets if p.packet_type != PacketType.EOF)
+        if any(p.packet_type == PacketType.EOF for p in packets):
+            result['elapsed'] = time.monotonic() - result['started']
+            break
+    connection.close()
+    on_eof()
+
+
+def run_worker(stage: str, n_packets: int):
+    stage_instance, output_queue = create_stage(stage)
+    preload(n_packets, output_queue)
+    result = {'packets': 0, 'elapsed': None, 'started': time.monotonic()}
+    monitor = threading.Thread(target=wait_for_eof, args=(output_queue, result, stage_instance.shutdown))
+    monitor.start()
+    stage_instance.start()
+    monitor.join()
+    print(json.dumps({
+        'stage': stage,
+        'backend': os.environ.get('MIDDLEWARE_BACKEND', 'blocking'),
+        'packets': n_packets,
+        'seconds': round(result['elapsed'], 3),
+        'messages_per_second': round(n_packets / result['elapsed'], 1),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--packets', type=int, default=50000)
+    parser.add_argument('--stage', choices=STAGES)
+    args = parser.parse_args()
+
+    if args.stage:
+        run_worker(args.stage, args.packets)
+        return
+
+    for stage in STAGES:
+        for backend in BACKENDS:
+            env = dict(os.environ, MIDDLEWARE_BACKEND=backend)
+            subprocess.run([sys.executable, __file__, '--stage', stage, '--packets', str(args.packets)],
+                           env=env, check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Operations per second and recovery time of each PersistenceManager backend and durability level.
+
+    python3 benchmarks/persistence_backends.py --clients 4 --keys 5000
+    python3 benchmarks/persistence_backends.py --durability flush fsync group
+
+The workload is the one of ReviewStatsService: every client has --keys
+keys (one per title) under its own secondary key, each of them put
+--updates times, plus an append-only log of processed ids like the one of
+the Middleware. Then every key is read back, the keys of every client are
+listed and deleted. Recovery is the time to open a new PersistenceManager
+on the storage left after the puts and appends, i.e. what a restarted
+service pays before it can consume again. Storage goes to a temporary
+directory, or under --storage if given, which should be on the disk the
+services use for the fsync levels to mean anything.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from middleware_backends import ROOT
+
+sys.path.insert(0, ROOT)
+
+from common.log_persistence_manager import LogPersistenceManager  # noqa: E402
+from common.persistence_manager import (  # noqa: E402
+    DURABILITY_FLUSH,
+    DURABILITY_FSYNC,
+    DURABILITY_GROUP,
+    DURABILITY_NONE,
+    PersistenceManager,
+)
+
+BACKENDS = {'files': PersistenceManager, 'log': LogPersistenceManager}
+DURABILITY_LEVELS = [DURABILITY_NONE, DURABILITY_FLUSH, DURABILITY_FSYNC, DURABILITY_GROUP]
+
+
+def timed(operation, n_operations: int) -> float:
+    started = time.perf_counter()
+    operation()
+    return round(n_operations / (time.perf_counter() - started))
+
+
+def measure(backend: str, durability: str, storage_path: str, n_clients: int, n_keys: int, n_updates: int) -> dict:
+    manager = BACKENDS[backend](storage_path, durability)
+    keys = [(f'stats_{client_id}_title {i}', str(client_id))
+            for client_id in range(n_clients) for i in range(n_keys)]
+    value = json.dumps({'n_reviews': 10, 'score_sum': 42.5})
+
+    def put():
+        for _ in range(n_updates):
+            for (key, secondary_key) in keys:
+                manager.put(key, value, secondary_key)
+
+    def append():
+        for (i, (_key, secondary_key)) in enumerate(keys):
+            manager.append('processed_log', str(i), f'processed_{secondary_key}')
+
+    def get():
+        for (key, secondary_key) in keys:
+            manager.get(key, secondary_key)
+
+    def get_keys():
+        for client_id in range(n_clients):
+            manager.get_keys(f'stats_{client_id}_', str(client_id))
+
+    result = {
+        'backend': backend,
+        'durability': durability,
+        'keys': len(keys),
+        'put_per_second': timed(put, len(keys) * n_updates),
+        'append_per_second': timed(append, len(keys)),
+        'get_per_second': timed(get, len(keys)),
+        'get_keys_per_second': timed(get_keys, n_clients),
+        'files': len(os.listdir(storage_path)),
+        'bytes': sum(entry.stat().st_size for entry in os.scandir(storage_path)),
+    }
+    manager.sync()
+    started = time.perf_counter()
+    manager = BACKENDS[backend](storage_path, durability)
+    result['recovery_seconds'] = round(time.perf_counter() - started, 3)
+
+    def delete_keys():
+        for client_id in range(n_clients):
+            manager.delete_keys(f'stats_{client_id}_', str(client_id))
+
+    result['delete_keys_per_second'] = timed(delete_keys, n_clients)
+    manager.sync()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--keys', type=int, default=5000, help='keys per client')
+    parser.add_argument('--updates', type=int, default=3, help='puts per key')
+    parser.add_argument('--durability', nargs='+', choices=DURABILITY_LEVELS, default=DURABILITY_LEVELS)
+    parser.add_argument('--storage', help='directory to put the storage of every run under')
+    args = parser.parse_args()
+
+    for backend in BACKENDS:
+        for durability in args.durability:
+            storage_path = tempfile.mkdtemp(prefix=f'persistence_{backend}_', dir=args.storage)
+            try:
+                result = measure(backend, durability, storage_path, args.clients, args.keys, args.updates)
+                print(json.dumps(result))
+            finally:
+                # Namespaces dropped by delete_keys may still be being removed
+                shutil.rmtree(storage_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
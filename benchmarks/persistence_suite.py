@@ -0,0 +1,233 @@
+"""Cost of each PersistenceManager operation, and recovery time of the state of real services.
+
+    python3 benchmarks/persistence_suite.py
+    python3 benchmarks/persistence_suite.py --keys 1000 10000 --value-sizes 64 4096 --output results.jsonl
+    python3 benchmarks/persistence_suite.py --suite recovery --backends files
+
+Runs locally, without RabbitMQ or any service. Two suites:
+
+- ops: for every backend, key count and value size, the operations per
+  second of put (creating the keys, then overwriting them), append, get,
+  get_keys and delete_keys. Keys are spread over --clients secondary keys,
+  as services keep them per client.
+- recovery: builds directories shaped like the state of a ReviewFilter
+  (books of every client), a ReviewStatsService (snapshots and logs of
+  review deltas) and the processed ids of a Middleware, by running the
+  code of those services, and times opening a new PersistenceManager and
+  loading the state back with the same code the services run on startup.
+  The directory is still in the page cache, so this is the CPU and
+  syscall cost of recovery, not the disk reads of a real cold start.
+
+Every result is a JSON line tagged with the suite, the commit and the
+parameters, printed and appended to --output if given, so that runs of
+different commits can be compared.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from middleware_backends import ROOT, load_stage_module
+from persistence_backends import BACKENDS, timed
+
+sys.path.insert(0, ROOT)
+
+from common.middleware import Middleware  # noqa: E402
+from common.parked_reviews import ParkedReviews  # noqa: E402
+from common.persistence_manager import DURABILITY_FLUSH  # noqa: E402
+from common.state_log import StateLog  # noqa: E402
+
+SUITES = ['ops', 'recovery']
+SHAPES = ['review_filter', 'review_stats', 'middleware']
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure_ops(backend: str, durability: str, storage_path: str, n_clients: int, n_keys: int,
+                value_size: int) -> dict:
+    manager = BACKENDS[backend](storage_path, durability)
+    keys = [(f'stats_{i % n_clients}_{i}', f'client_{i % n_clients}') for i in range(n_keys)]
+    value = 'x' * value_size
+
+    def put():
+        for (key, secondary_key) in keys:
+            manager.put(key, value, secondary_key)
+
+    def append():
+        for (key, secondary_key) in keys:
+            manager.append(key, value, secondary_key)
+
+    def get():
+        for (key, secondary_key) in keys:
+            manager.get(key, secondary_key)
+
+    def get_keys():
+        for client_id in range(n_clients):
+            manager.get_keys(f'stats_{client_id}_', f'client_{client_id}')
+
+    def delete_keys():
+        for client_id in range(n_clients):
+            manager.delete_keys(f'stats_{client_id}_', f'client_{client_id}')
+
+    result = {
+        'put_new_per_second': timed(put, len(keys)),
+        'put_per_second': timed(put, len(keys)),
+        'append_per_second': timed(append, len(keys)),
+        'get_per_second': timed(get, len(keys)),
+        'get_keys_per_second': timed(get_keys, n_clients),
+        'delete_keys_per_second': timed(delete_keys, n_clients),
+    }
+    manager.sync()
+    return result
+
+
+class Shape:
+    """State of a service: written with its code, and loaded back the way it does on startup."""
+
+    def __init__(self, shape: str, args):
+        self.shape = shape
+        self.args = args
+        if shape == 'review_filter':
+            self.module = load_stage_module('review_filter')
+        elif shape == 'review_stats':
+            self.module = load_stage_module('review_stats_service')
+
+    def service(self, manager):
+        if self.shape == 'review_filter':
+            service = self.module.ReviewFilter.__new__(self.module.ReviewFilter)
+            service.books = {}
+            service.eofs = set()
+            service.should_requeue_eof = set()
+            service.last_packet_timestamp = {}
+            service.parked_lock = threading.Lock()
+            service.ready_to_release = []
+            service.parked = ParkedReviews(manager)
+            service.reviews_middleware = None
+        elif self.shape == 'review_stats':
+            service = self.module.ReviewStatsService.__new__(self.module.ReviewStatsService)
+            service.book_reviews = {}
+            service.state_log = StateLog(manager, 'review_stats', service._apply_review)
+            # Books reaching the required reviews are sent on
+            service.middleware = SimpleNamespace(send_to_queue=lambda queue, packet: None)
+        else:
+            service = Middleware.__new__(Middleware)
+            service.group_commit = False
+            service.state = {}
+            service._log_sizes = {}
+        service.persistence_manager = manager
+        return service
+
+    def write(self, manager) -> int:
+        """Writes the state of --clients clients, returns the number of messages it took."""
+        service = self.service(manager)
+        messages = 0
+        for client_id in range(self.args.clients):
+            if self.shape == 'review_filter':
+                for i in range(self.args.books):
+                    service._add_book(SimpleNamespace(
+                        client_id=client_id, title=f'Book title {i}', authors="['Some Author']"))
+                messages += self.args.books
+            elif self.shape == 'review_stats':
+                for i in range(self.args.reviews):
+                    service._save_review(SimpleNamespace(
+                        client_id=client_id, book_title=f'Book title {i % self.args.titles}',
+                        score=4.0, authors="['Some Author']", packet_id=i))
+                messages += self.args.reviews
+            else:
+                for i in range(self.args.packets):
+                    service.mark_as_processed(SimpleNamespace(client_id=client_id, packet_id=i, trace_id=i))
+                messages += self.args.packets
+        return messages
+
+    def load(self, manager):
+        service = self.service(manager)
+        if self.shape == 'middleware':
+            service.init_state()
+        else:
+            service._init_state()
+
+
+def measure_recovery(backend: str, shape: Shape, storage_path: str) -> dict:
+    manager = BACKENDS[backend](storage_path, DURABILITY_FLUSH)
+    started = time.perf_counter()
+    messages = shape.write(manager)
+    write_seconds = time.perf_counter() - started
+    manager.sync()
+    result = {
+        'messages': messages,
+        'write_per_second': round(messages / write_seconds),
+        'files': sum(len(files) for (_path, _dirs, files) in os.walk(storage_path)),
+        'bytes': sum(os.path.getsize(os.path.join(path, name))
+                     for (path, _dirs, files) in os.walk(storage_path) for name in files),
+    }
+    started = time.perf_counter()
+    manager = BACKENDS[backend](storage_path, DURABILITY_FLUSH)
+    result['open_seconds'] = round(time.perf_counter() - started, 3)
+    shape.load(manager)
+    result['recovery_seconds'] = round(time.perf_counter() - started, 3)
+    manager.sync()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suite', nargs='+', choices=SUITES, default=SUITES)
+    parser.add_argument('--backends', nargs='+', choices=list(BACKENDS), default=list(BACKENDS))
+    parser.add_argument('--durability', default=DURABILITY_FLUSH, help='durability level of the ops suite')
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--keys', type=int, nargs='+', default=[1000, 10000], help='keys of the ops suite')
+    parser.add_argument('--value-sizes', type=int, nargs='+', default=[64, 1024, 16384],
+                        help='value sizes of the ops suite, in bytes')
+    parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=SHAPES)
+    parser.add_argument('--books', type=int, default=50000, help='books per client of the review_filter shape')
+    parser.add_argument('--reviews', type=int, default=50000, help='reviews per client of the review_stats shape')
+    parser.add_argument('--titles', type=int, default=10000, help='titles reviewed per client of the review_stats shape')
+    parser.add_argument('--packets', type=int, default=50000, help='packets per client of the middleware shape')
+    parser.add_argument('--storage', help='directory to put the storage of every run under')
+    parser.add_argument('--output', help='JSON lines file to append the results to')
+    args = parser.parse_args()
+
+    tags = {'commit': commit(), 'timestamp': round(time.time())}
+    runs = []
+    if 'ops' in args.suite:
+        runs += [({'suite': 'ops', 'backend': backend, 'durability': args.durability, 'clients': args.clients,
+                   'keys': n_keys, 'value_size': value_size},
+                  lambda storage_path, backend=backend, n_keys=n_keys, value_size=value_size: measure_ops(
+                      backend, args.durability, storage_path, args.clients, n_keys, value_size))
+                 for backend in args.backends for n_keys in args.keys for value_size in args.value_sizes]
+    if 'recovery' in args.suite:
+        shapes = {shape: Shape(shape, args) for shape in args.shapes}
+        runs += [({'suite': 'recovery', 'backend': backend, 'shape': shape, 'clients': args.clients},
+                  lambda storage_path, backend=backend, shape=shape: measure_recovery(
+                      backend, shapes[shape], storage_path))
+                 for backend in args.backends for shape in args.shapes]
+
+    if args.storage:
+        os.makedirs(args.storage, exist_ok=True)
+    for (parameters, run) in runs:
+        storage_path = tempfile.mkdtemp(prefix='persistence_suite_', dir=args.storage)
+        try:
+            result = json.dumps({**tags, **parameters, **run(storage_path)})
+        finally:
+            # Namespaces dropped by delete_keys may still be being removed
+            shutil.rmtree(storage_path, ignore_errors=True)
+        print(result, flush=True)
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(result + '\n')
+
+
+if __name__ == '__main__':
+    main()
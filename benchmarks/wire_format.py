@@ -0,0 +1,105 @@
+"""Encode/decode throughput and size of the JSON and binary wire formats.
+
+    python3 benchmarks/wire_format.py --packets 20000
+    python3 benchmarks/wire_format.py --reviews datasets/Books_rating.csv
+
+Books come from example_datasets. Reviews are only measured when a
+Books_rating.csv is given, since it is not part of the repository. Every
+format is measured on single packets and on batches of --batch-size packets,
+the way the Middleware publishes them, and on lazy decoding of the first
+field only, which is what routers and filters do.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+
+from middleware_backends import ROOT, load_books
+
+sys.path.insert(0, ROOT)
+
+from common.batch_packet import BatchPacket  # noqa: E402
+from common.binary_codec import BinaryCodec  # noqa: E402
+from common.packet_decoder import PacketDecoder  # noqa: E402
+from common.review import Review  # noqa: E402
+
+
+def load_reviews(path: str, n_packets: int) -> list[Review]:
+    reviews = []
+    with open(path, newline='') as f:
+        rows = csv.reader(f)
+        next(rows)
+        for row in rows:
+            line = io.StringIO()
+            csv.writer(line).writerow(row)
+            reviews.append(Review.from_csv_row(line.getvalue(), 0, len(reviews)))
+            if len(reviews) == n_packets:
+                break
+    return reviews
+
+
+def measure(packets: list, encode, decode, encode_batch, batch_size: int) -> dict:
+    started = time.perf_counter()
+    bodies = [encode(packet) for packet in packets]
+    encode_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for body in bodies:
+        decode(body)
+    decode_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for body in bodies:
+        packet = PacketDecoder.decode_lazy(body)
+        packet.get(packet.FIELDS[packet.packet_type][0])
+    lazy_seconds = time.perf_counter() - started
+
+    batches = [encode_batch(bodies[i:i + batch_size]) for i in range(0, len(bodies), batch_size)]
+    started = time.perf_counter()
+    for batch in batches:
+        decode(batch)
+    batch_decode_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for batch in batches:
+        for packet in PacketDecoder.decode_lazy(batch).packets:
+            packet.get(packet.FIELDS[packet.packet_type][0])
+    batch_lazy_seconds = time.perf_counter() - started
+
+    return {
+        'encode_per_second': round(len(packets) / encode_seconds),
+        'decode_per_second': round(len(packets) / decode_seconds),
+        'lazy_first_field_per_second': round(len(packets) / lazy_seconds),
+        'batched_decode_per_second': round(len(packets) / batch_decode_seconds),
+        'batched_lazy_first_field_per_second': round(len(packets) / batch_lazy_seconds),
+        'bytes_per_packet': round(sum(len(body) for body in bodies) / len(bodies), 1),
+        'bytes_per_batch': round(sum(len(batch) for batch in batches) / len(batches), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--packets', type=int, default=20000)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--reviews', help='path to Books_rating.csv')
+    args = parser.parse_args()
+
+    datasets = {'books': [PacketDecoder.decode(book) for book in load_books(args.packets)]}
+    if args.reviews and os.path.exists(args.reviews):
+        datasets['reviews'] = load_reviews(args.reviews, args.packets)
+
+    formats = {
+        'json': (lambda packet: packet.encode(), lambda body: BatchPacket(body).encode()),
+        'binary': (BinaryCodec.encode, BinaryCodec.encode_batch),
+    }
+    for name, packets in datasets.items():
+        for wire_format, (encode, encode_batch) in formats.items():
+            result = measure(packets, encode, PacketDecoder.decode, encode_batch, args.batch_size)
+            print(json.dumps({'packets': name, 'format': wire_format, 'count': len(packets), **result}))
+
+
+if __name__ == '__main__':
+    main()
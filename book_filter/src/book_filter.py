@@ -3,7 +3,6 @@ import os
 import json
 
 from common.book import Book
-from common.eof_packet import EOFPacket
 from common.middleware import Middleware
 
 filter_by_field: str = json.loads(os.getenv("FILTER_BY_FIELD")) or ''
@@ -19,8 +18,9 @@ class BookFilter:
                  cluster_size: int):
         self.middleware: Middleware = Middleware(
             input_queues=input_queues, callback=self.filter_book,
-            eof_callback=self.handle_eof, output_queues=output_queues,
-            output_exchanges=output_exchanges)
+            output_queues=output_queues, output_exchanges=output_exchanges,
+            cluster_size=cluster_size, cluster_instance_id=instance_id,
+            lazy_decoding=True)
         self.instance_id = instance_id
         self.cluster_size = cluster_size
 
@@ -31,20 +31,6 @@ class BookFilter:
         logging.info(" [x] Graceful shutdown")
         self.middleware.shutdown()
 
-    def handle_eof(self, eof_packet: EOFPacket):
-        logging.debug(f" [x] Received EOF: {eof_packet}")
-        if self.instance_id not in eof_packet.ack_instances:
-            eof_packet.ack_instances.append(self.instance_id)
-
-        if len(eof_packet.ack_instances) == self.cluster_size:
-            self.middleware.send(
-                EOFPacket(
-                    eof_packet.client_id,
-                    eof_packet.packet_id).encode())
-            logging.debug(f" [x] Sent EOF: {eof_packet}")
-        else:
-            self.middleware.return_eof(eof_packet)
-
     def filter_book(self, book: Book):
         logging.debug(f" [x] Received {book}")
         if self.filter_by(filter_by_field, filter_by_values, book):
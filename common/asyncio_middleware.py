@@ -0,0 +1,222 @@
+import asyncio
+import logging
+from typing import Callable
+
+import aio_pika
+
+from common.middleware import (
+    ADAPTIVE_PREFETCH,
+    CONFIRM_WINDOW,
+    PUBLISH_RETRIES,
+    PUBLISHER_CONFIRMS,
+    RABBITMQ_HEARTBEAT,
+    RABBITMQ_HOST,
+    RABBITMQ_PORT,
+    Middleware,
+)
+from common.shm_transport import ShmDeliveryTag
+
+
+class AsyncioMiddleware(Middleware):
+    """Middleware backed by an aio-pika connection and an asyncio event loop.
+
+    Selected with MIDDLEWARE_BACKEND=asyncio. Callbacks stay synchronous: the
+    publishes they make are scheduled on the loop and the message they came
+    from is acked only once those publishes are done. Meanwhile the loop keeps
+    delivering and processing the next prefetched messages, so consuming,
+    publishing and persisting overlap without extra threads.
+
+    With MIDDLEWARE_PUBLISHER_CONFIRMS=true a publish is done when the broker
+    confirms it, so acks wait for confirms instead of socket writes. Up to
+    MIDDLEWARE_CONFIRM_WINDOW publishes wait for their confirm at once; later
+    ones queue on the loop without blocking consumption.
+
+    Queues and exchanges are declared before start() is called, while the
+    loop is not running.
+    """
+
+    def _connect(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._confirm_window = asyncio.Semaphore(CONFIRM_WINDOW)
+        self._exchanges: dict[str, aio_pika.abc.AbstractExchange] = {}
+        self._queues: dict[str, aio_pika.abc.AbstractQueue] = {}
+        self._consumer_tags: dict[str, str] = {}
+        self._in_flight: set[asyncio.Future] = set()
+        self._last_ack: asyncio.Future = None
+        self._stopped: asyncio.Event = None
+        self.connection = self._run(aio_pika.connect(
+            host=RABBITMQ_HOST, port=RABBITMQ_PORT, heartbeat=RABBITMQ_HEARTBEAT))
+        self.channel = self._run(self.connection.channel(publisher_confirms=PUBLISHER_CONFIRMS))
+        self._set_prefetch(self.prefetch_controller.prefetch)
+        self._underlay = self._run(self.channel.get_underlay_channel())
+        self._exchanges[''] = self.channel.default_exchange
+
+    def _run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def _set_prefetch(self, prefetch_count: int):
+        set_qos = self.channel.set_qos(prefetch_count=prefetch_count, global_=ADAPTIVE_PREFETCH)
+        if self.loop.is_running():
+            self.loop.create_task(set_qos)
+        else:
+            self._run(set_qos)
+
+    def _declare_queue(self, queue: str):
+        self._queues[queue] = self._run(self.channel.declare_queue(queue))
+
+    def _declare_exchange(self, exchange: str, exchange_type: str = 'fanout'):
+        self._exchanges[exchange] = self._run(self.channel.declare_exchange(
+            exchange, aio_pika.ExchangeType(exchange_type)))
+
+    def _bind_queue(self, queue: str, exchange: str):
+        self._run(self._queues[queue].bind(self._exchanges[exchange]))
+
+    def _consume(self, queue: str, callback: Callable, auto_ack: bool):
+        async def on_message(message: aio_pika.abc.AbstractIncomingMessage):
+            # The message exposes delivery_tag/routing_key and the AMQP
+            # properties, so it stands in for pika's method and properties
+            callback(self.channel, message, message, message.body)
+
+        self._consumer_tags[queue] = self._run(
+            self._queues[queue].consume(on_message, no_ack=auto_ack))
+
+    def _basic_publish(self, exchange: str, routing_key: str, body: str, content_encoding: str = None):
+        message = aio_pika.Message(body if isinstance(body, bytes) else body.encode(),
+                                   content_encoding=content_encoding)
+        publish = self.loop.create_task(self._publish(exchange, routing_key, message))
+        self._in_flight.add(publish)
+        publish.add_done_callback(self._in_flight.discard)
+        if not self.loop.is_running():
+            self.loop.run_until_complete(publish)
+
+    async def _publish(self, exchange: str, routing_key: str, message: aio_pika.Message):
+        if not PUBLISHER_CONFIRMS:
+            await self._exchanges[exchange].publish(message, routing_key=routing_key, mandatory=False)
+            return
+
+        async with self._confirm_window:
+            for attempt in range(1, PUBLISH_RETRIES + 1):
+                try:
+                    await self._exchanges[exchange].publish(message, routing_key=routing_key, mandatory=False)
+                    return
+                except aio_pika.exceptions.DeliveryError:
+                    if attempt == PUBLISH_RETRIES:
+                        raise
+                    logging.warning(f"Publish to {routing_key or exchange} was nacked, retrying ({attempt})")
+
+    def _call_later(self, delay: float, callback: Callable):
+        self.loop.call_later(delay, callback)
+
+    def _open_control_channel(self):
+        self.control_channel = self._run(self.connection.channel(publisher_confirms=False))
+        self._control_underlay = self._run(self.control_channel.get_underlay_channel())
+
+    def _consume_control(self, queue: str, callback: Callable):
+        async def on_message(message: aio_pika.abc.AbstractIncomingMessage):
+            callback(message.body, message.delivery_tag)
+
+        self._queues[queue] = self._run(self.control_channel.declare_queue(queue))
+        self._consumer_tags[queue] = self._run(self._queues[queue].consume(on_message))
+
+    def _ack_control(self, delivery_tag):
+        # After the EOF it was waiting for has been published
+        self._after_in_flight(self._control_underlay.basic_ack(delivery_tag),
+                              lambda: self._control_underlay.basic_nack(delivery_tag, requeue=True))
+
+    def _after_in_flight(self, operation, requeue: Callable = None):
+        """Runs an ack/nack once every publish made so far is done.
+
+        Operations are chained so they reach the broker in the same order
+        they were requested, which multiple acks rely on. If a publish
+        failed, requeue runs instead of the ack, so the broker redelivers
+        the messages that were being acked. Nacks requeue already.
+        """
+        publishes = list(self._in_flight)
+        previous = self._last_ack
+
+        async def run():
+            if previous:
+                await asyncio.gather(previous, return_exceptions=True)
+            results = await asyncio.gather(*publishes, return_exceptions=True)
+            errors = [result for result in results if isinstance(result, Exception)]
+            if errors and requeue is not None:
+                logging.error(f"Publish failed, requeueing the message instead of acking it: {errors[0]}")
+                operation.close()
+                await requeue()
+                return
+            await operation
+
+        self._last_ack = self.loop.create_task(run())
+
+    def ack(self, delivery_tag, multiple: bool = False):
+        if isinstance(delivery_tag, ShmDeliveryTag):
+            self._after_in_flight(self._run_sync(super().ack, delivery_tag, multiple),
+                                  lambda: self._run_sync(self._shm_consumers[delivery_tag.queue][0].nack,
+                                                         delivery_tag, multiple))
+        else:
+            self._after_in_flight(self._underlay.basic_ack(delivery_tag, multiple=multiple),
+                                  lambda: self._underlay.basic_nack(delivery_tag, multiple=multiple, requeue=True))
+
+    def nack(self, delivery_tag):
+        if isinstance(delivery_tag, ShmDeliveryTag):
+            self._after_in_flight(self._run_sync(super().nack, delivery_tag))
+        else:
+            self._after_in_flight(self._underlay.basic_nack(delivery_tag))
+
+    async def _run_sync(self, function: Callable, *args):
+        function(*args)
+
+    def start(self):
+        logging.info("Middleware started")
+        try:
+            if self.input_queues and not self.should_stop:
+                self.loop.run_until_complete(self._wait_until_stopped())
+        except (OSError, aio_pika.exceptions.AMQPConnectionError):
+            logging.debug("Connection closed")
+
+    async def _wait_until_stopped(self):
+        self._stopped = asyncio.Event()
+        await self._stopped.wait()
+
+    def stop(self):
+        for queue, consumer_tag in self._consumer_tags.items():
+            self.loop.create_task(self._queues[queue].cancel(consumer_tag))
+        logging.info("Middleware stopped consuming messages")
+
+    def _shutdown(self):
+        self.should_stop = True
+        try:
+            self.flush()
+            self.commit()
+        except Exception as e:
+            logging.error(f"Error flushing pending packets on shutdown: {e}")
+
+        if self.input_queues:
+            self.stop()
+            if ADAPTIVE_PREFETCH:
+                logging.info(f"Prefetch stats: {self.prefetch_controller.stats()}")
+
+        if self.loop.is_running():
+            self.loop.create_task(self._close())
+        else:
+            self.loop.run_until_complete(self._close())
+
+    async def _close(self):
+        if self._last_ack:
+            await asyncio.gather(self._last_ack, return_exceptions=True)
+        await asyncio.gather(*self._in_flight, return_exceptions=True)
+        await self.connection.close()
+        if self._stopped:
+            self._stopped.set()
+        logging.info("Middleware stopped")
+
+    def shutdown(self):
+        logging.info("Stopping middleware")
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self._shutdown)
+        else:
+            self._shutdown()
+
+    def call_threadsafe(self, callback: Callable):
+        self.loop.call_soon_threadsafe(callback)
@@ -0,0 +1,37 @@
+from common.packet import Packet
+from common.packet_type import PacketType
+
+
+class BatchPacket(Packet):
+    """Envelope that carries several packets in a single broker message.
+
+    Packets can be given either already encoded or as Packet instances;
+    encoded packets are embedded as-is, so batching does not re-serialize
+    them.
+    """
+
+    def __init__(self, packets: list):
+        super().__init__(None, None)
+        self.packets = packets
+
+    @property
+    def packet_type(self):
+        return PacketType.BATCH
+
+    @property
+    def payload(self):
+        return [packet if isinstance(packet, str) else packet.encode()
+                for packet in self.packets]
+
+    def encode(self) -> str:
+        return f'[null,null,{PacketType.BATCH.value},[{",".join(self.payload)}]]'
+
+    @staticmethod
+    def decode(packets: list[Packet]) -> 'BatchPacket':
+        return BatchPacket(packets)
+
+    def __len__(self):
+        return len(self.packets)
+
+    def __str__(self):
+        return f"BatchPacket(size={len(self.packets)})"
@@ -0,0 +1,209 @@
+import struct
+from collections import namedtuple
+
+from common.packet_type import PacketType
+
+# Binary packets start with MAGIC, which no JSON packet does (they start
+# with '['), followed by the format VERSION. Decoders tell both formats
+# apart by that first byte, so producers can switch a queue to the binary
+# format once all of its consumers understand it.
+MAGIC = 0xB7
+VERSION = 1
+
+# Tags of the encoded values
+NULL = 0
+FALSE = 1
+TRUE = 2
+INT = 3
+FLOAT = 4
+STRING = 5
+LIST = 6
+# An encoded binary packet embedded as-is, e.g. in a batch
+PACKET = 7
+
+DOUBLE = struct.Struct('<d')
+
+BinaryHeader = namedtuple('BinaryHeader', ['client_id', 'packet_id', 'packet_type', 'n_fields', 'payload_start'])
+
+
+class BinaryCodec:
+    """Compact binary encoding of packets.
+
+    A packet is MAGIC, VERSION and its type, followed by its client and
+    packet ids as varints (0 for null) and its payload fields. Every field
+    is a tag followed by its value: varints for ints, length-prefixed UTF-8
+    for strings, so texts are copied as they are instead of being escaped.
+    decode() gives the same [client_id, packet_id, type, payload] list as
+    json.loads does on a JSON packet, so PacketDecoder handles both alike.
+    """
+
+    @staticmethod
+    def is_binary(body) -> bool:
+        return isinstance(body, (bytes, bytearray)) and len(body) > 0 and body[0] == MAGIC
+
+    @staticmethod
+    def encode(packet) -> bytes:
+        """Encodes a Packet, or anything with its ids, packet_type and payload."""
+        out = bytearray((MAGIC, VERSION, packet.packet_type.value))
+        _write_id(out, packet.client_id)
+        _write_id(out, packet.packet_id)
+        if packet.packet_type == PacketType.BATCH:
+            return bytes(BinaryCodec._write_batch(out, packet.packets))
+        payload = packet.payload
+        _write_varint(out, len(payload))
+        for value in payload:
+            _write_value(out, value)
+        return bytes(out)
+
+    @staticmethod
+    def encode_batch(packets: list) -> bytes:
+        """Encodes a BatchPacket of binary packets, embedding them unchanged."""
+        out = bytearray((MAGIC, VERSION, PacketType.BATCH.value))
+        _write_id(out, None)
+        _write_id(out, None)
+        return bytes(BinaryCodec._write_batch(out, packets))
+
+    @staticmethod
+    def _write_batch(out: bytearray, packets: list) -> bytearray:
+        _write_varint(out, len(packets))
+        for packet in packets:
+            if not isinstance(packet, (bytes, bytearray)):
+                packet = BinaryCodec.encode(packet)
+            out.append(PACKET)
+            _write_varint(out, len(packet))
+            out += packet
+        return out
+
+    @staticmethod
+    def decode(body: bytes, start: int = 0) -> list:
+        header = BinaryCodec.decode_header(body, start)
+        payload = []
+        position = header.payload_start
+        read_value = BinaryCodec.read_value
+        for _ in range(header.n_fields):
+            (value, position) = read_value(body, position)
+            payload.append(value)
+        return [header.client_id, header.packet_id, header.packet_type, payload]
+
+    @staticmethod
+    def decode_header(body: bytes, start: int = 0) -> BinaryHeader:
+        if body[start + 1] != VERSION:
+            raise ValueError(f"Unsupported binary packet version: {body[start + 1]}")
+        (client_id, position) = _read_id(body, start + 3)
+        (packet_id, position) = _read_id(body, position)
+        (n_fields, position) = _read_varint(body, position)
+        return BinaryHeader(client_id, packet_id, body[start + 2], n_fields, position)
+
+    @staticmethod
+    def read_value(body: bytes, position: int) -> tuple:
+        """Decodes the value at position, returning it and where the next one starts."""
+        tag = body[position]
+        if tag == STRING:
+            length = body[position + 1]
+            if length < 0x80:
+                position += 2
+            else:
+                (length, position) = _read_varint(body, position + 1)
+            return body[position:position + length].decode(), position + length
+        position += 1
+        if tag == INT:
+            (value, position) = _read_varint(body, position)
+            return _unzigzag(value), position
+        if tag == FLOAT:
+            return DOUBLE.unpack_from(body, position)[0], position + DOUBLE.size
+        if tag == NULL:
+            return None, position
+        if tag == FALSE or tag == TRUE:
+            return tag == TRUE, position
+        if tag == LIST:
+            (length, position) = _read_varint(body, position)
+            values = []
+            for _ in range(length):
+                (value, position) = BinaryCodec.read_value(body, position)
+                values.append(value)
+            return values, position
+        if tag == PACKET:
+            (length, position) = _read_varint(body, position)
+            return BinaryCodec.decode(body, position), position + length
+        raise ValueError(f"Unknown binary value tag: {tag}")
+
+    @staticmethod
+    def split_batch(body: bytes, header: BinaryHeader) -> list[bytes]:
+        """Returns the encoded packets of a binary batch, without decoding them."""
+        packets = []
+        position = header.payload_start
+        for _ in range(header.n_fields):
+            if body[position] != PACKET:
+                raise ValueError("Malformed binary batch")
+            (length, position) = _read_varint(body, position + 1)
+            packets.append(body[position:position + length])
+            position += length
+        return packets
+
+
+def _write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(body: bytes, position: int) -> tuple[int, int]:
+    byte = body[position]
+    if byte < 0x80:
+        return byte, position + 1
+    value = 0
+    shift = 0
+    while True:
+        byte = body[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def _zigzag(value: int) -> int:
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def _unzigzag(value: int) -> int:
+    return -((value + 1) >> 1) if value & 1 else value >> 1
+
+
+def _write_id(out: bytearray, value: int):
+    _write_varint(out, 0 if value is None else _zigzag(value) + 1)
+
+
+def _read_id(body: bytes, position: int) -> tuple[int, int]:
+    (value, position) = _read_varint(body, position)
+    return (None if value == 0 else _unzigzag(value - 1)), position
+
+
+def _write_value(out: bytearray, value):
+    if isinstance(value, str):
+        data = value.encode()
+        out.append(STRING)
+        _write_varint(out, len(data))
+        out += data
+    elif value is None:
+        out.append(NULL)
+    elif value is True or value is False:
+        out.append(TRUE if value else FALSE)
+    elif isinstance(value, int):
+        out.append(INT)
+        _write_varint(out, _zigzag(value))
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += DOUBLE.pack(value)
+    elif isinstance(value, (list, tuple)):
+        out.append(LIST)
+        _write_varint(out, len(value))
+        for item in value:
+            _write_value(out, item)
+    elif isinstance(value, (bytes, bytearray)):
+        out.append(PACKET)
+        _write_varint(out, len(value))
+        out += value
+    else:
+        raise TypeError(f"Cannot encode {type(value).__name__} in a binary packet")
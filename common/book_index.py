@@ -0,0 +1,290 @@
+import mmap
+import os
+import struct
+import zlib
+from array import array
+
+INITIAL_SLOTS = 8
+
+MAPPED_MAGIC = b'MBI1'
+# Magic, records added, books and bytes of data used
+MAPPED_HEADER = struct.Struct('<4sQQQ')
+# Lengths of the title and authors of a book, followed by both
+MAPPED_BOOK = struct.Struct('<II')
+MAPPED_INITIAL_SLOTS = 1024
+MAPPED_INITIAL_DATA_BYTES = 1024 * 1024
+
+
+class StringTable:
+    """Set of strings numbered in insertion order, stored without a Python object per string.
+
+    Strings are kept UTF-8 encoded back to back in a single bytearray, with
+    the offset of each (4 bytes), and found through an open addressing
+    table of hash(string) -> number (12 bytes per slot, kept at most 2/3
+    full). A hash match is confirmed by comparing the stored bytes, so
+    lookups are exact.
+
+    One thread can add strings while others look them up: a string is
+    only put in a slot once it is stored, and a grown table replaces the
+    old one whole.
+    """
+
+    def __init__(self):
+        self._data = bytearray()
+        # String i is _data[_offsets[i]:_offsets[i + 1]]
+        self._offsets = array('I', [0])
+        # Hash and number + 1 of the string of each slot, 0 if empty
+        self._table = (array('q', bytes(8 * INITIAL_SLOTS)), array('I', bytes(4 * INITIAL_SLOTS)))
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes of the buffers of the table, about the memory it takes."""
+        (hashes, slots) = self._table
+        return sum(len(buffer) * buffer.itemsize for buffer in [self._offsets, hashes, slots]) + len(self._data)
+
+    def __getitem__(self, number: int) -> str:
+        return self._data[self._offsets[number]:self._offsets[number + 1]].decode()
+
+    def find(self, string: str) -> int:
+        """Returns the number of string, -1 if it is not in the table."""
+        (_slot, number) = self._find(string, hash(string))
+        return number
+
+    def add(self, string: str) -> int:
+        """Returns the number of string, adding it if it is not in the table."""
+        string_hash = hash(string)
+        (slot, number) = self._find(string, string_hash)
+        if number >= 0:
+            return number
+        self._data += string.encode()
+        self._offsets.append(len(self._data))
+        (hashes, slots) = self._table
+        hashes[slot] = string_hash
+        slots[slot] = len(self)
+        if 3 * len(self) >= 2 * len(slots):
+            self._grow()
+        return len(self) - 1
+
+    def _find(self, string: str, string_hash: int) -> tuple[int, int]:
+        """Returns the slot of string and its number, or the empty slot where it goes and -1."""
+        encoded = None
+        (hashes, slots) = self._table
+        mask = len(slots) - 1
+        slot = string_hash & mask
+        while (number := slots[slot]):
+            number -= 1
+            if hashes[slot] == string_hash:
+                if encoded is None:
+                    encoded = string.encode()
+                if self._data[self._offsets[number]:self._offsets[number + 1]] == encoded:
+                    return slot, number
+            slot = (slot + 1) & mask
+        return slot, -1
+
+    def _grow(self):
+        (hashes, slots) = self._table
+        (new_hashes, new_slots) = (array('q', bytes(16 * len(hashes))), array('I', bytes(8 * len(slots))))
+        mask = len(new_slots) - 1
+        for (string_hash, number) in zip(hashes, slots):
+            if number:
+                slot = string_hash & mask
+                while new_slots[slot]:
+                    slot = (slot + 1) & mask
+                new_hashes[slot] = string_hash
+                new_slots[slot] = number
+        self._table = (new_hashes, new_slots)
+
+
+class BookIndex:
+    """Authors of the books of a client by title, in a fraction of the memory of a dict of str.
+
+    Titles and authors are kept in StringTables, so a book costs the UTF-8
+    bytes of its title and about 22 bytes of offsets and table slots, plus
+    the 4 byte number of its authors. Authors are interned, so repeated
+    ones are stored once. Like a dict, it can be read from one thread
+    while another one adds books to it.
+    """
+
+    def __init__(self):
+        self._titles = StringTable()
+        self._authors = StringTable()
+        # Number of the authors of each title
+        self._author_numbers = array('I')
+
+    def __len__(self) -> int:
+        return len(self._titles)
+
+    @property
+    def nbytes(self) -> int:
+        return self._titles.nbytes + self._authors.nbytes + len(self._author_numbers) * self._author_numbers.itemsize
+
+    def __contains__(self, title: str) -> bool:
+        return self._titles.find(title) >= 0
+
+    def get(self, title: str) -> str:
+        """Returns the authors of the book with title, None if there is none."""
+        book = self._titles.find(title)
+        return self._authors[self._author_numbers[book]] if book >= 0 else None
+
+    def add(self, title: str, authors: str):
+        authors = self._authors.add(authors)
+        book = self._titles.find(title)
+        if book >= 0:
+            self._author_numbers[book] = authors
+        else:
+            # Numbered before the title can be found from other threads
+            self._author_numbers.append(authors)
+            self._titles.add(title)
+
+
+class MappedBookIndex:
+    """BookIndex kept in memory mapped files, for clients with more books than fit in memory.
+
+    <path>.data holds the books back to back, each as the lengths of its
+    title and authors followed by both UTF-8 encoded. <path>.table holds a
+    header and an open addressing table of (hash of the title, offset of
+    its book + 1) slots, as two uint64 each, kept at most 2/3 full. Titles
+    are hashed with crc32, which unlike hash() is the same after a restart.
+    A lookup reads a few slots and the title of the ones with a matching
+    hash, so it touches a couple of pages, which the kernel keeps cached as
+    memory allows. Adding a title again appends its book and points its
+    slot at it. Both files double when full, and readers keep using the
+    mappings they started with, so one thread can add books while others
+    look them up.
+
+    The header counts the records added, and is updated after the book
+    they add. It tells how many records of the log the index was built
+    from, so reopening it only adds the ones after those. Writes go to
+    the page cache, which outlives a crash of the process.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            self._open()
+        except (OSError, ValueError, struct.error):
+            self._create()
+
+    @property
+    def records(self) -> int:
+        return self._records
+
+    def __len__(self) -> int:
+        return self._books
+
+    def __contains__(self, title: str) -> bool:
+        encoded = title.encode()
+        (_slot, offset) = self._find(encoded, _mapped_hash(encoded))
+        return offset >= 0
+
+    def get(self, title: str) -> str:
+        """Returns the authors of the book with title, None if there is none."""
+        encoded = title.encode()
+        (_slot, offset) = self._find(encoded, _mapped_hash(encoded))
+        if offset < 0:
+            return None
+        data = self._data
+        (title_length, authors_length) = MAPPED_BOOK.unpack_from(data, offset)
+        start = offset + MAPPED_BOOK.size + title_length
+        return data[start:start + authors_length].decode()
+
+    def add(self, title: str, authors: str):
+        encoded = title.encode()
+        title_hash = _mapped_hash(encoded)
+        (slot, offset) = self._find(encoded, title_hash)
+        authors = authors.encode()
+        book = MAPPED_BOOK.pack(len(encoded), len(authors)) + encoded + authors
+        if self._data_length + len(book) > len(self._data):
+            self._grow_data(self._data_length + len(book))
+        self._data[self._data_length:self._data_length + len(book)] = book
+        (table, slots) = self._table
+        # The hash goes first, readers skip slots without an offset
+        if offset < 0:
+            slots[2 * slot] = title_hash
+            self._books += 1
+        slots[2 * slot + 1] = self._data_length + 1
+        self._data_length += len(book)
+        self._records += 1
+        MAPPED_HEADER.pack_into(table, 0, MAPPED_MAGIC, self._records, self._books, self._data_length)
+        if 3 * self._books >= 2 * (len(slots) // 2):
+            self._grow_table()
+
+    def remove(self):
+        """Deletes the files of the index. Lookups already mapping them still work."""
+        for path in [f'{self.path}.table', f'{self.path}.data']:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _find(self, encoded: bytes, title_hash: int) -> tuple[int, int]:
+        """Returns the slot of the title and the offset of its book, or the empty slot where it goes and -1."""
+        (_table, slots) = self._table
+        data = self._data
+        mask = len(slots) // 2 - 1
+        slot = title_hash & mask
+        while (offset := slots[2 * slot + 1]):
+            if slots[2 * slot] == title_hash:
+                offset -= 1
+                (title_length, _authors_length) = MAPPED_BOOK.unpack_from(data, offset)
+                start = offset + MAPPED_BOOK.size
+                if data[start:start + title_length] == encoded:
+                    return slot, offset
+            slot = (slot + 1) & mask
+        return slot, -1
+
+    def _open(self):
+        table = _map(f'{self.path}.table')
+        (magic, self._records, self._books, self._data_length) = MAPPED_HEADER.unpack_from(table, 0)
+        n_slots = (len(table) - MAPPED_HEADER.size) // 16
+        if magic != MAPPED_MAGIC or n_slots & (n_slots - 1):
+            raise ValueError(f"{self.path}.table is not a book index")
+        self._data = _map(f'{self.path}.data')
+        if self._data_length > len(self._data):
+            raise ValueError(f"{self.path}.data is shorter than its index")
+        self._table = (table, memoryview(table)[MAPPED_HEADER.size:].cast('Q'))
+
+    def _create(self):
+        (self._records, self._books, self._data_length) = (0, 0, 0)
+        with open(f'{self.path}.data', 'wb') as f:
+            f.truncate(MAPPED_INITIAL_DATA_BYTES)
+        self._data = _map(f'{self.path}.data')
+        self._table = self._new_table(f'{self.path}.table', MAPPED_INITIAL_SLOTS)
+
+    def _new_table(self, path: str, n_slots: int) -> tuple[mmap.mmap, memoryview]:
+        with open(path, 'wb') as f:
+            f.truncate(MAPPED_HEADER.size + 16 * n_slots)
+        table = _map(path)
+        MAPPED_HEADER.pack_into(table, 0, MAPPED_MAGIC, self._records, self._books, self._data_length)
+        return table, memoryview(table)[MAPPED_HEADER.size:].cast('Q')
+
+    def _grow_data(self, size: int):
+        os.truncate(f'{self.path}.data', max(size, 2 * len(self._data)))
+        self._data = _map(f'{self.path}.data')
+
+    def _grow_table(self):
+        (_table, slots) = self._table
+        # Built aside and renamed, so a crash leaves either table whole
+        (table, new_slots) = self._new_table(f'{self.path}.table.new', 2 * (len(slots) // 2))
+        mask = len(new_slots) // 2 - 1
+        for i in range(0, len(slots), 2):
+            if slots[i + 1]:
+                slot = slots[i] & mask
+                while new_slots[2 * slot + 1]:
+                    slot = (slot + 1) & mask
+                new_slots[2 * slot] = slots[i]
+                new_slots[2 * slot + 1] = slots[i + 1]
+        os.replace(f'{self.path}.table.new', f'{self.path}.table')
+        self._table = (table, new_slots)
+
+
+def _map(path: str) -> mmap.mmap:
+    with open(path, 'r+b') as f:
+        return mmap.mmap(f.fileno(), 0)
+
+
+def _mapped_hash(encoded: bytes) -> int:
+    return zlib.crc32(encoded) | len(encoded) << 32
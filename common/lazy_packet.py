@@ -0,0 +1,162 @@
+import bisect
+import json
+import re
+
+from common.binary_codec import BinaryCodec, BinaryHeader
+from common.packet_type import PACKET_FIELDS, PacketType
+
+# Client id, packet id and type of an encoded packet, up to its payload
+HEADER_REGEX = re.compile(r'\[\s*(-?\d+|null)\s*,\s*(-?\d+|null)\s*,\s*(\d+)\s*,\s*\[\s*')
+SEPARATOR_REGEX = re.compile(r'\s*,\s*')
+# End of a packet of a JSON batch followed by the header of the next one.
+# No field of a Book or Review is a list followed by such a header, but the
+# text of a string can be, so a match only counts if the quotes before it
+# in the packet are balanced.
+NEXT_PACKET_REGEX = re.compile(r'\]\s*,\s*(?=\[\s*(?:-?\d+|null)\s*,\s*(?:-?\d+|null)\s*,\s*\d+\s*,\s*\[)')
+BACKSLASH_QUOTE_REGEX = re.compile(r'\\"')
+JSON_DECODER = json.JSONDecoder()
+# Packet types that can be viewed lazily, by their encoded value
+LAZY_TYPES = {packet_type.value: packet_type for packet_type in [PacketType.BOOK, PacketType.REVIEW]}
+
+
+class LazyPacket:
+    """Read-only view of an encoded Book or Review, in JSON or binary format.
+
+    Only the header is parsed up front. Payload fields are decoded one by
+    one, in order, up to the first one asked for, so reading the title of a
+    book does not parse its description. encode() gives back the original
+    body, so a packet that is only routed or filtered is forwarded without
+    being re-serialized.
+    """
+
+    FIELDS = {packet_type: PACKET_FIELDS[packet_type] for packet_type in [PacketType.BOOK, PacketType.REVIEW]}
+    # Same as FIELDS, by name
+    FIELD_INDEXES = {packet_type: {field: i for i, field in enumerate(fields)}
+                     for packet_type, fields in FIELDS.items()}
+
+    def __init__(self, body: str, client_id: int, packet_id: int, packet_type: PacketType,
+                 payload_start: int = None, values: list = None):
+        self.body = body
+        self.client_id = client_id
+        self.packet_id = packet_id
+        self.packet_type = packet_type
+        # Payload fields decoded so far and where the next one starts
+        self._values = values if values is not None else []
+        self._position = payload_start
+        self._binary = isinstance(body, bytes)
+
+    def get(self, field: str):
+        index = LazyPacket.FIELD_INDEXES[self.packet_type].get(field)
+        if index is None:
+            return None
+        while len(self._values) <= index:
+            if self._binary:
+                (value, self._position) = BinaryCodec.read_value(self.body, self._position)
+            else:
+                if self._values:
+                    self._position = SEPARATOR_REGEX.match(self.body, self._position).end()
+                (value, self._position) = JSON_DECODER.raw_decode(self.body, self._position)
+            self._values.append(value)
+        return self._values[index]
+
+    @property
+    def payload(self) -> list:
+        fields = LazyPacket.FIELDS[self.packet_type]
+        self.get(fields[-1])
+        return self._values
+
+    def __getattr__(self, name: str):
+        # Only called for attributes not set in __init__, i.e. payload fields
+        if name in LazyPacket.FIELDS.get(self.__dict__.get('packet_type'), ()):
+            return self.get(name)
+        raise AttributeError(name)
+
+    def encode(self) -> str:
+        return self.body
+
+    def materialize(self):
+        """Fully decodes the packet into its Packet subclass."""
+        from common.packet_decoder import PacketDecoder
+        return PacketDecoder.decode(self.body)
+
+    @property
+    def trace_id(self) -> str:
+        return f"{self.client_id}-{self.packet_id}"
+
+    def __str__(self):
+        if self._binary:
+            return f"LazyPacket({self.packet_type.name}, {self.trace_id})"
+        return self.body
+
+    @staticmethod
+    def from_header(body: str, header: re.Match) -> 'LazyPacket':
+        """Returns a view of body given its HEADER_REGEX match, None if it is not a Book or Review."""
+        packet_type = LAZY_TYPES.get(int(header.group(3)))
+        if packet_type is None:
+            return None
+        return LazyPacket(body, _header_id(header.group(1)), _header_id(header.group(2)),
+                          packet_type, payload_start=header.end())
+
+    @staticmethod
+    def from_binary(body: bytes, header: BinaryHeader = None) -> 'LazyPacket':
+        """Returns a view of a binary packet, None if it is not a Book or Review."""
+        header = header or BinaryCodec.decode_header(body)
+        packet_type = LAZY_TYPES.get(header.packet_type)
+        if packet_type is None:
+            return None
+        return LazyPacket(body, header.client_id, header.packet_id, packet_type,
+                          payload_start=header.payload_start)
+
+    @staticmethod
+    def view_batch(body: str, payload_start: int) -> list['LazyPacket']:
+        """Returns views of the packets of an encoded BatchPacket.
+
+        Packets are split where the header of the next one starts, all
+        found with a single regex scan, and only their headers are parsed,
+        so their fields are left for get() like those of an unbatched
+        packet. Returns None if the batch carries a packet other than a
+        Book or Review.
+        """
+        # Where the list of packets closes, before the bracket of the batch
+        batch_end = body.rindex(']', 0, body.rindex(']'))
+        if body.find('[', payload_start, batch_end) < 0:
+            return []
+        escaped = _escaped_quotes(body, payload_start, batch_end)
+        packets = []
+        start = payload_start
+        boundaries = [(match.start() + 1, match.end())
+                      for match in NEXT_PACKET_REGEX.finditer(body, payload_start, batch_end)]
+        boundaries.append((body.rindex(']', payload_start, batch_end) + 1, None))
+        for (end, next_start) in boundaries:
+            if next_start is not None:
+                quotes = body.count('"', start, end)
+                if escaped:
+                    quotes -= bisect.bisect_left(escaped, end) - bisect.bisect_left(escaped, start)
+                if quotes % 2:
+                    # Inside a string of the packet
+                    continue
+            header = HEADER_REGEX.match(body, start)
+            packet_type = LAZY_TYPES.get(int(header.group(3))) if header else None
+            if packet_type is None:
+                return None
+            packets.append(LazyPacket(body[start:end], _header_id(header.group(1)), _header_id(header.group(2)),
+                                      packet_type, payload_start=header.end() - start))
+            start = next_start
+        return packets
+
+
+def _header_id(value: str) -> int:
+    return None if value == 'null' else int(value)
+
+
+def _escaped_quotes(body: str, start: int, end: int) -> list[int]:
+    """Returns the positions of the escaped quotes between start and end, in order."""
+    escaped = []
+    for match in BACKSLASH_QUOTE_REGEX.finditer(body, start, end):
+        position = match.start()
+        # Escaped by an odd number of backslashes
+        while body[position - 1] == '\\':
+            position -= 1
+        if (match.end() - position) % 2 == 0:
+            escaped.append(match.end() - 1)
+    return escaped
@@ -0,0 +1,409 @@
+import logging
+import os
+import struct
+import threading
+import zlib
+from typing import Iterator
+
+from common.persistence_manager import DURABILITY_NONE, PersistenceManager
+
+# The log is split into segments of about LOG_SEGMENT_BYTES. Sealed segments
+# are compacted in the background, every LOG_COMPACTION_INTERVAL_S seconds at
+# most, once at least LOG_COMPACTION_RATIO of their bytes are dead records.
+LOG_SEGMENT_BYTES = int(os.getenv('PERSISTENCE_LOG_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+LOG_COMPACTION_RATIO = float(os.getenv('PERSISTENCE_LOG_COMPACTION_RATIO', '0.5'))
+LOG_COMPACTION_INTERVAL_S = float(os.getenv('PERSISTENCE_LOG_COMPACTION_INTERVAL_S', '10'))
+
+SEGMENT_PREFIX = 'segment_'
+SEGMENT_SUFFIX = '.log'
+COMPACTION_FILE = '_compaction'
+
+# Record: CRC32 of everything after it, op, and the lengths of the secondary
+# key, key and value, followed by the three of them in UTF-8
+RECORD_HEADER = struct.Struct('<IBHHI')
+PUT = 1
+APPEND = 2
+# Deletes every key of the secondary key that starts with the record key
+DELETE = 3
+# Ends a transaction, whose records are flagged with IN_TRANSACTION
+COMMIT = 4
+# First record of a compacted segment, which supersedes all the previous ones
+COMPACTED = 5
+IN_TRANSACTION = 0x80
+
+
+class LogPersistenceManager(PersistenceManager):
+    """PersistenceManager backed by an append-only log of records.
+
+    Selected with PERSISTENCE_BACKEND=log. Every put, append and delete_keys
+    is a record appended to the current segment of the log, so writes are a
+    single append to an open file instead of a file per key. An in-memory
+    index maps every key to where its values are in the log, so a get reads
+    them with one pread each. The index is rebuilt on startup by scanning
+    the log; records are CRC-checked and the log is truncated at the first
+    torn or corrupted one.
+
+    Values overwritten or deleted stay in the log as dead records. A
+    background thread rewrites the live records of all sealed segments into
+    one compacted segment, which starts with a COMPACTED record so that a
+    crash halfway through never brings back deleted keys.
+
+    Reads the data written by this backend only, the files backend keeps
+    its own layout.
+
+    Every operation holds a single lock, and the transaction is shared by
+    all threads.
+    """
+
+    _transaction: bytearray = None
+
+    def __init__(self, storage_path='./', durability: str = None):
+        self._lock = threading.RLock()
+        self._segment: int = 0
+        self._writer = None
+        # Segment -> read-only file, size and bytes of records still indexed
+        self._readers: dict[int, object] = {}
+        self._sizes: dict[int, int] = {}
+        self._live_bytes: dict[int, int] = {}
+        self._compaction_lock = threading.RLock()
+        self._compaction_wakeup = threading.Event()
+        # Sets _keys_index, which here maps secondary key -> key -> the
+        # (segment, offset, length, record size) of each of its values
+        super().__init__(storage_path, durability)
+        threading.Thread(target=self._compaction_loop, daemon=True).start()
+
+    def _segment_path(self, segment: int) -> str:
+        return f'{self.storage_path}/{SEGMENT_PREFIX}{segment:08d}{SEGMENT_SUFFIX}'
+
+    def _open_segment(self, segment: int, size: int = 0):
+        self._segment = segment
+        # Segments have no header, records are checked one by one
+        self._writer = self._handle(self._segment_path(segment), header=b'')
+        self._readers[segment] = open(self._segment_path(segment), 'rb')
+        self._sizes[segment] = size
+        self._live_bytes.setdefault(segment, 0)
+
+    def _close_segment(self, segment: int):
+        self._readers.pop(segment).close()
+        self._sizes.pop(segment)
+        self._live_bytes.pop(segment)
+
+    def _write_record(self, op: int, secondary_key: str, key: str, value: bytes = b'') -> tuple:
+        """Appends a record to the current segment, or to the transaction if one is open.
+
+        Returns the location of its value.
+        """
+        secondary_key = secondary_key.encode()
+        key = key.encode()
+        if self._transaction is not None:
+            op |= IN_TRANSACTION
+        record = _encode_record(op, secondary_key, key, value)
+        segment = self._segment
+        if self._transaction is not None:
+            offset = self._sizes[self._segment] + len(self._transaction)
+            self._transaction += record
+        else:
+            offset = self._sizes[self._segment]
+            self._writer.write(record)
+            self._written(self._segment_path(segment), self._writer)
+            self._sizes[self._segment] += len(record)
+            self._roll_segment()
+        return (segment, offset + len(record) - len(value), len(value), len(record))
+
+    def _roll_segment(self):
+        if self._sizes[self._segment] < LOG_SEGMENT_BYTES:
+            return
+        self._close_handle(self._segment_path(self._segment))
+        self._open_segment(self._segment + 1)
+        self._compaction_wakeup.set()
+
+    def _read_value(self, location: tuple) -> bytes:
+        (segment, offset, length, _size) = location
+        if segment == self._segment and offset + length > self._sizes[segment]:
+            # Not committed yet, still in the transaction buffer
+            start = offset - self._sizes[segment]
+            return bytes(self._transaction[start:start + length])
+        if segment == self._segment and self.durability == DURABILITY_NONE:
+            self._writer.flush()
+        return os.pread(self._readers[segment].fileno(), length, offset)
+
+    def _index(self, secondary_key: str, key: str, location: tuple, op: int):
+        keys = self._keys_index.setdefault(secondary_key, {})
+        locations = keys.get(key)
+        if locations is None:
+            keys[key] = [location]
+            self._key_added(key, secondary_key)
+        elif op == PUT:
+            self._kill(locations)
+            keys[key] = [location]
+        else:
+            locations.append(location)
+        self._live_bytes[location[0]] += location[3]
+
+    def _unindex(self, prefix: str, secondary_key: str) -> bool:
+        deleted = self._pop_keys(prefix, secondary_key)
+        for (_key, locations) in deleted:
+            self._kill(locations)
+        return len(deleted) > 0
+
+    def _kill(self, locations: list[tuple]):
+        for (segment, _offset, _length, size) in locations:
+            if segment in self._live_bytes:
+                self._live_bytes[segment] -= size
+
+    def put(self, key: str, value: str, secondary_key: str = 'default'):
+        try:
+            logging.debug(f"Putting value: {value} for key: {key}")
+            with self._lock:
+                location = self._write_record(PUT, secondary_key, key, value.encode())
+                self._index(secondary_key, key, location, PUT)
+        except Exception as e:
+            logging.error(f"Error putting value: {value} for key: {key}: {e}")
+
+    def get(self, key: str, secondary_key: str = 'default') -> str:
+        with self._lock:
+            locations = self._keys_index.get(secondary_key, {}).get(key)
+            if locations is None:
+                return ''
+            return b'\n'.join(self._read_value(location) for location in locations).decode()
+
+    def iter_records(self, key: str, secondary_key: str = 'default') -> Iterator[str]:
+        # Compaction would move the values while they are read, so it waits
+        with self._compaction_lock:
+            with self._lock:
+                locations = list(self._keys_index.get(secondary_key, {}).get(key, []))
+            for location in locations:
+                with self._lock:
+                    value = self._read_value(location)
+                yield value.decode()
+
+    def append(self, key: str, value: str, secondary_key: str = 'default'):
+        try:
+            logging.debug(f"Appending value: {value} for key: {key}")
+            with self._lock:
+                location = self._write_record(APPEND, secondary_key, key, value.encode())
+                self._index(secondary_key, key, location, APPEND)
+        except Exception as e:
+            logging.error(f"Error appending value: {value} for key: {key}: {e}")
+
+    def begin_transaction(self):
+        """Buffers every record in memory until commit_transaction.
+
+        The records are written together, followed by a COMMIT record. On
+        recovery, records of a transaction without its COMMIT are dropped,
+        so a transaction is persisted either whole or not at all.
+        """
+        with self._lock:
+            if self._transaction is None:
+                self._transaction = bytearray()
+
+    def commit_transaction(self, fsync: bool = False):
+        with self._lock:
+            transaction = self._transaction
+            self._transaction = None
+            if not transaction:
+                return
+            logging.debug(f"Committing transaction of {len(transaction)} bytes")
+            transaction += _encode_record(COMMIT, b'', b'', b'')
+            self._writer.write(transaction)
+            self._written(self._segment_path(self._segment), self._writer, fsync)
+            if fsync:
+                self.sync()
+            self._sizes[self._segment] += len(transaction)
+            self._roll_segment()
+
+    def delete_keys(self, prefix: str = '', secondary_key: str = 'default'):
+        logging.debug(f"Deleting keys by prefix: {prefix}, secondary_key: {secondary_key}")
+        try:
+            with self._lock:
+                if self._unindex(prefix, secondary_key):
+                    self._write_record(DELETE, secondary_key, prefix)
+        except Exception as e:
+            logging.error(f"Error deleting keys by prefix: {prefix}: {e}")
+
+    def get_keys(self, prefix='', secondary_key: str = None) -> list[tuple[str, str]]:
+        with self._lock:
+            return super().get_keys(prefix, secondary_key)
+
+    def _init_state(self):
+        segments = []
+        for file in os.scandir(self.storage_path):
+            if file.name == COMPACTION_FILE:
+                # Left by a compaction that did not finish
+                os.remove(file.path)
+            elif file.name.startswith(SEGMENT_PREFIX) and file.name.endswith(SEGMENT_SUFFIX):
+                segments.append(int(file.name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        segments.sort()
+
+        first = 0
+        for (i, segment) in enumerate(segments):
+            self._readers[segment] = open(self._segment_path(segment), 'rb')
+            self._live_bytes[segment] = 0
+            (size, compacted) = self._recover_segment(segment)
+            self._sizes[segment] = size
+            if compacted:
+                first = i
+        # Segments superseded by a compacted one whose compaction did not
+        # get to delete them
+        for segment in segments[:first]:
+            self._close_segment(segment)
+            os.remove(self._segment_path(segment))
+        segments = segments[first:]
+
+        if segments:
+            self._readers.pop(segments[-1]).close()
+            self._open_segment(segments[-1], self._sizes[segments[-1]])
+        else:
+            self._open_segment(0)
+        logging.debug(f"Initialized LogPersistenceManager with {len(segments)} segments, "
+                      f"{sum(len(keys) for keys in self._keys_index.values())} keys")
+
+    def _recover_segment(self, segment: int) -> tuple[int, bool]:
+        """Indexes the records of a segment, truncating it at the first bad one.
+
+        Returns the size of the segment and whether it is a compacted one.
+        """
+        path = self._segment_path(segment)
+        with open(path, 'rb') as f:
+            data = f.read()
+        compacted = False
+        # Records of the current transaction, indexed once it is committed
+        pending = []
+        committed = 0
+        position = 0
+        while position < len(data):
+            record = _decode_record(data, position)
+            if record is None:
+                logging.error(f"Corrupted record in {path} at byte {position}, truncating it")
+                break
+            (op, secondary_key, key, location, end) = record
+            location = (segment, *location)
+            position = end
+            if op & IN_TRANSACTION:
+                pending.append((op & ~IN_TRANSACTION, secondary_key, key, location))
+                continue
+            for pending_record in pending:
+                self._replay(*pending_record)
+            pending = []
+            if op == COMPACTED:
+                compacted = True
+                self._keys_index = {}
+                self._sorted_keys = {}
+                self._live_bytes = dict.fromkeys(self._live_bytes, 0)
+            elif op != COMMIT:
+                self._replay(op, secondary_key, key, location)
+            committed = position
+        if committed < len(data):
+            if pending:
+                logging.warning(f"Dropping an uncommitted transaction at the end of {path}")
+            os.truncate(path, committed)
+        return committed, compacted
+
+    def _replay(self, op: int, secondary_key: str, key: str, location: tuple):
+        if op == DELETE:
+            self._unindex(key, secondary_key)
+        else:
+            self._index(secondary_key, key, location, op)
+
+    def _compaction_loop(self):
+        while True:
+            self._compaction_wakeup.wait(LOG_COMPACTION_INTERVAL_S)
+            self._compaction_wakeup.clear()
+            try:
+                self.compact()
+            except Exception as e:
+                logging.error(f"Error compacting {self.storage_path}: {e}")
+
+    def compact(self, force: bool = False):
+        """Rewrites the live values of all sealed segments into the last of them.
+
+        Only runs when at least LOG_COMPACTION_RATIO of the sealed bytes are
+        dead, unless forced. Writes to the current segment go on meanwhile:
+        the lock is only held to take a snapshot of the index and to swap
+        the compacted segment in.
+        """
+        with self._compaction_lock:
+            self._compact(force)
+
+    def _compact(self, force: bool):
+        with self._lock:
+            sealed = sorted(segment for segment in self._sizes if segment != self._segment)
+            size = sum(self._sizes[segment] for segment in sealed)
+            live = sum(self._live_bytes[segment] for segment in sealed)
+            if not sealed or (not force and size - live < size * LOG_COMPACTION_RATIO):
+                return
+            sealed_set = set(sealed)
+            # (secondary key, key, its locations in sealed segments), which
+            # always come before the ones in the current segment
+            snapshot = []
+            for secondary_key, keys in self._keys_index.items():
+                for key, locations in keys.items():
+                    n = 0
+                    while n < len(locations) and locations[n][0] in sealed_set:
+                        n += 1
+                    if n:
+                        snapshot.append((secondary_key, key, locations[:n]))
+            readers = {segment: self._readers[segment].fileno() for segment in sealed}
+
+        target = sealed[-1]
+        logging.debug(f"Compacting segments {sealed[0]}-{target} ({size} bytes, {live} live)")
+        temp_path = f'{self.storage_path}/{COMPACTION_FILE}'
+        # New locations of the values of each key of the snapshot
+        compacted = []
+        with open(temp_path, 'wb') as f:
+            f.write(_encode_record(COMPACTED, b'', b'', b''))
+            offset = f.tell()
+            for (secondary_key, key, locations) in snapshot:
+                # A record per value, so iter_records yields the same values
+                # before and after compaction
+                new_locations = []
+                for (i, (segment, value_offset, length, _size)) in enumerate(locations):
+                    value = os.pread(readers[segment], length, value_offset)
+                    op = PUT if i == 0 else APPEND
+                    record = _encode_record(op, secondary_key.encode(), key.encode(), value)
+                    f.write(record)
+                    offset += len(record)
+                    new_locations.append((target, offset - len(value), len(value), len(record)))
+                compacted.append(new_locations)
+            f.flush()
+            os.fsync(f.fileno())
+
+        with self._lock:
+            for segment in sealed:
+                self._close_segment(segment)
+            os.replace(temp_path, self._segment_path(target))
+            self._fsync_directory()
+            self._readers[target] = open(self._segment_path(target), 'rb')
+            self._sizes[target] = offset
+            self._live_bytes[target] = 0
+            for ((secondary_key, key, locations), new_locations) in zip(snapshot, compacted):
+                current = self._keys_index.get(secondary_key, {}).get(key)
+                # Keys written again or deleted since the snapshot keep their
+                # newer locations, their compacted records are dead already
+                if current is not None and current[:len(locations)] == locations:
+                    current[:len(locations)] = new_locations
+                    self._live_bytes[target] += sum(location[3] for location in new_locations)
+            for segment in sealed[:-1]:
+                os.remove(self._segment_path(segment))
+        logging.debug(f"Compacted segments {sealed[0]}-{target} into {offset} bytes")
+
+
+def _encode_record(op: int, secondary_key: bytes, key: bytes, value: bytes) -> bytes:
+    body = RECORD_HEADER.pack(0, op, len(secondary_key), len(key), len(value))[4:] + secondary_key + key + value
+    return zlib.crc32(body).to_bytes(4, byteorder='little') + body
+
+
+def _decode_record(data: bytes, position: int) -> tuple:
+    """Returns the op, keys, value location and end of the record at position, None if it is torn or corrupted."""
+    if position + RECORD_HEADER.size > len(data):
+        return None
+    (crc, op, secondary_length, key_length, value_length) = RECORD_HEADER.unpack_from(data, position)
+    value_offset = position + RECORD_HEADER.size + secondary_length + key_length
+    end = value_offset + value_length
+    if end > len(data) or zlib.crc32(memoryview(data)[position + 4:end]) != crc:
+        return None
+    keys_offset = position + RECORD_HEADER.size
+    secondary_key = data[keys_offset:keys_offset + secondary_length].decode()
+    key = data[keys_offset + secondary_length:value_offset].decode()
+    return op, secondary_key, key, (value_offset, value_length, end - position), end
+
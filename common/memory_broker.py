@@ -0,0 +1,266 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+from typing import Callable
+
+Delivery = namedtuple('Delivery', ['delivery_tag', 'exchange', 'routing_key', 'redelivered'])
+
+
+class MemoryBroker:
+    """In-process stand-in for RabbitMQ.
+
+    Supports named queues, fanout exchanges and the default exchange, which is
+    all the pipeline uses. Messages published to a queue that was not declared
+    are dropped, as RabbitMQ does. A single lock guards every queue, and each
+    connection waits on its own condition of that lock, which is only notified
+    when one of the queues its channels consume from gets a message.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.queues: dict[str, deque] = {}
+        self.bindings: dict[str, set[str]] = {}
+        self.consumers: dict[str, list['MemoryChannel']] = {}
+
+    def queue_declare(self, queue: str):
+        with self.lock:
+            self.queues.setdefault(queue, deque())
+
+    def exchange_declare(self, exchange: str, exchange_type: str = 'fanout'):
+        if exchange_type != 'fanout':
+            raise ValueError(f"Unsupported exchange type: {exchange_type}")
+        with self.lock:
+            self.bindings.setdefault(exchange, set())
+
+    def queue_bind(self, exchange: str, queue: str):
+        with self.lock:
+            self.bindings.setdefault(exchange, set()).add(queue)
+
+    def add_consumer(self, queue: str, channel: 'MemoryChannel'):
+        with self.lock:
+            self.consumers.setdefault(queue, []).append(channel)
+
+    def remove_consumer(self, channel: 'MemoryChannel'):
+        with self.lock:
+            for channels in self.consumers.values():
+                if channel in channels:
+                    channels.remove(channel)
+
+    def publish(self, exchange: str, routing_key: str, body: bytes, properties=None):
+        with self.lock:
+            queues = self.bindings.get(exchange, ()) if exchange else (routing_key,)
+            for queue in queues:
+                if queue in self.queues:
+                    self.queues[queue].append((body, exchange, routing_key, False, properties))
+                    self._notify_consumers(queue)
+                else:
+                    logging.debug("Dropped message to undeclared queue %s", queue)
+
+    def requeue(self, queue: str, body: bytes, exchange: str, routing_key: str, properties=None):
+        with self.lock:
+            self.queues[queue].appendleft((body, exchange, routing_key, True, properties))
+            self._notify_consumers(queue)
+
+    def _notify_consumers(self, queue: str):
+        for channel in self.consumers.get(queue, ()):
+            channel.connection.condition.notify()
+
+    def purge(self):
+        with self.lock:
+            self.queues.clear()
+            self.bindings.clear()
+
+
+class MemoryChannel:
+    """Subset of pika's BlockingChannel on top of a MemoryBroker.
+
+    Unacked deliveries count towards the prefetch limit (per channel, whether
+    it was set as global or not) and are requeued when the channel closes,
+    which is how a crashed consumer gets its messages redelivered.
+    """
+
+    def __init__(self, connection: 'MemoryConnection'):
+        self.connection = connection
+        self.broker = connection.broker
+        self.condition = connection.condition
+        self.prefetch_count = 0
+        self.consumers: list[tuple[str, Callable, bool]] = []
+        self.unacked: dict[int, tuple[str, bytes, str, str, any]] = {}
+        self.consuming = False
+        self.is_open = True
+        self._delivery_tags = itertools.count(1)
+        self._next_consumer = 0
+
+    def basic_qos(self, prefetch_size: int = 0, prefetch_count: int = 0, global_qos: bool = False):
+        with self.condition:
+            self.prefetch_count = prefetch_count
+            self.condition.notify()
+
+    def confirm_delivery(self):
+        # Publishing appends to the queue right away, so it is always confirmed
+        pass
+
+    def queue_declare(self, queue: str):
+        self.broker.queue_declare(queue)
+
+    def exchange_declare(self, exchange: str, exchange_type: str = 'fanout'):
+        self.broker.exchange_declare(exchange, exchange_type)
+
+    def queue_bind(self, exchange: str, queue: str):
+        self.broker.queue_bind(exchange, queue)
+
+    def basic_consume(self, queue: str, on_message_callback: Callable, auto_ack: bool = False):
+        self.consumers.append((queue, on_message_callback, auto_ack))
+        self.broker.add_consumer(queue, self)
+
+    def basic_publish(self, exchange: str, routing_key: str, body, properties=None, mandatory: bool = False):
+        self.broker.publish(exchange, routing_key, body.encode() if isinstance(body, str) else body, properties)
+
+    def basic_ack(self, delivery_tag: int, multiple: bool = False):
+        with self.condition:
+            for tag in self._delivery_tags_up_to(delivery_tag, multiple):
+                del self.unacked[tag]
+            self.condition.notify()
+
+    def basic_nack(self, delivery_tag: int, multiple: bool = False, requeue: bool = True):
+        with self.condition:
+            # Requeued from the last one so they keep their order at the head
+            for tag in reversed(self._delivery_tags_up_to(delivery_tag, multiple)):
+                (queue, body, exchange, routing_key, properties) = self.unacked.pop(tag)
+                if requeue:
+                    self.broker.requeue(queue, body, exchange, routing_key, properties)
+            self.condition.notify()
+
+    def _delivery_tags_up_to(self, delivery_tag: int, multiple: bool) -> list[int]:
+        if multiple:
+            return [tag for tag in self.unacked if tag <= delivery_tag]
+        if delivery_tag not in self.unacked:
+            raise ValueError(f"Unknown delivery tag {delivery_tag}")
+        return [delivery_tag]
+
+    def _next_delivery(self):
+        """Takes the next message for one of the consumers, if the prefetch allows it.
+
+        Must be called with the broker lock held. Consumers are visited
+        round robin so one busy queue does not starve the others.
+        """
+        if self.prefetch_count and len(self.unacked) >= self.prefetch_count:
+            return None
+        for i in range(len(self.consumers)):
+            (queue, callback, auto_ack) = self.consumers[(self._next_consumer + i) % len(self.consumers)]
+            messages = self.broker.queues.get(queue)
+            if messages:
+                self._next_consumer = (self._next_consumer + i + 1) % len(self.consumers)
+                (body, exchange, routing_key, redelivered, properties) = messages.popleft()
+                delivery_tag = next(self._delivery_tags)
+                if not auto_ack:
+                    self.unacked[delivery_tag] = (queue, body, exchange, routing_key, properties)
+                return self, callback, Delivery(delivery_tag, exchange, routing_key, redelivered), properties, body
+        return None
+
+    def start_consuming(self):
+        """Dispatches messages of every channel of the connection, as pika does."""
+        self.consuming = True
+        while self.consuming and self.is_open:
+            self.connection.process_events()
+            if not self.consuming or not self.is_open:
+                break
+            delivery = None
+            with self.condition:
+                for channel in self.connection.channels():
+                    delivery = channel._next_delivery()
+                    if delivery is not None:
+                        break
+                if delivery is None and not self.connection.has_ready_callbacks():
+                    self.condition.wait(self.connection.time_to_next_timer())
+            if delivery is not None:
+                (channel, callback, method, properties, body) = delivery
+                callback(channel, method, properties, body)
+
+    def stop_consuming(self):
+        self.consuming = False
+        with self.condition:
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            if not self.is_open:
+                return
+            self.is_open = False
+            self.consuming = False
+            self.broker.remove_consumer(self)
+            for tag in reversed(list(self.unacked)):
+                (queue, body, exchange, routing_key, properties) = self.unacked.pop(tag)
+                self.broker.requeue(queue, body, exchange, routing_key, properties)
+            self.condition.notify()
+
+
+class MemoryConnection:
+    """Subset of pika's BlockingConnection on top of a MemoryBroker.
+
+    Timers and thread-safe callbacks run in the thread that is consuming, the
+    same as with pika. When nothing is consuming, thread-safe callbacks run
+    right away in the caller's thread.
+    """
+
+    def __init__(self, broker: MemoryBroker = None):
+        self.broker = broker or BROKER
+        self.condition = threading.Condition(self.broker.lock)
+        self.is_open = True
+        self._channels: list[MemoryChannel] = []
+        self._timers: list[tuple[float, int, Callable]] = []
+        self._callbacks: list[Callable] = []
+        self._sequence = itertools.count()
+
+    def channel(self) -> MemoryChannel:
+        channel = MemoryChannel(self)
+        self._channels.append(channel)
+        return channel
+
+    def call_later(self, delay: float, callback: Callable):
+        with self.broker.lock:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._sequence), callback))
+            self._wake_up()
+
+    def add_callback_threadsafe(self, callback: Callable):
+        with self.broker.lock:
+            if any(channel.consuming for channel in self._channels):
+                self._callbacks.append(callback)
+                self._wake_up()
+                return
+        callback()
+
+    def _wake_up(self):
+        self.condition.notify()
+
+    def channels(self) -> list[MemoryChannel]:
+        return [channel for channel in self._channels if channel.is_open]
+
+    def has_ready_callbacks(self) -> bool:
+        return bool(self._callbacks) or bool(self._timers and self._timers[0][0] <= time.monotonic())
+
+    def time_to_next_timer(self) -> float:
+        if not self._timers:
+            return None
+        return max(0, self._timers[0][0] - time.monotonic())
+
+    def process_events(self):
+        with self.broker.lock:
+            callbacks = self._callbacks
+            self._callbacks = []
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                callbacks.append(heapq.heappop(self._timers)[2])
+        for callback in callbacks:
+            callback()
+
+    def close(self):
+        for channel in self._channels:
+            channel.close()
+        self.is_open = False
+
+
+BROKER = MemoryBroker()
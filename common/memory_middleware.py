@@ -0,0 +1,17 @@
+from common.memory_broker import BROKER, MemoryConnection
+from common.middleware import Middleware
+
+
+class MemoryMiddleware(Middleware):
+    """Middleware backed by the in-process MemoryBroker instead of RabbitMQ.
+
+    Selected with MIDDLEWARE_BACKEND=memory. Every Middleware of the process
+    shares the same broker, so a whole DAG of stages can run in one process,
+    each stage in its own thread, with no external service involved. Meant
+    for benchmarks and profiling of stage code.
+    """
+
+    def _connect(self):
+        self.connection = MemoryConnection(BROKER)
+        self.channel = self.connection.channel()
+        self._set_prefetch(self.prefetch_controller.prefetch)
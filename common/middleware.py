@@ -1,19 +1,113 @@
+import json
 import logging
 import os
+import time
+import zlib
+from collections import namedtuple
 from typing import Callable
 import pika
 
+from common.batch_packet import BatchPacket
+from common.binary_codec import BinaryCodec
+from common.lazy_packet import LazyPacket
 from common.packet import Packet
 from common.packet_type import PacketType
 from common.packet_decoder import PacketDecoder
 from common.eof_packet import EOFPacket
 from common.persistence_manager import PersistenceManager
+from common.prefetch_controller import PrefetchController
+from common.processed_ids import ProcessedIds
+from common.projection import Projection
+from common.shm_transport import (
+    SHM_POLL_MS,
+    SHM_QUEUES,
+    ShmDelivery,
+    ShmDeliveryTag,
+    open_consumer,
+    open_producer,
+)
 
 RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
 RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT', '5672'))
 RABBITMQ_HEARTBEAT = int(os.getenv('RABBITMQ_HEARTBEAT', '1200'))
+# The prefetch count of each consumer is PREFETCH_COUNT. With
+# MIDDLEWARE_ADAPTIVE_PREFETCH it only starts there and is then adapted to
+# the measured service time of the stage, so that the prefetched messages
+# hold about PREFETCH_TARGET_MS of work, within [PREFETCH_MIN, PREFETCH_MAX].
+PREFETCH_COUNT = int(os.getenv('MIDDLEWARE_PREFETCH', '100'))
+PREFETCH_MIN = int(os.getenv('MIDDLEWARE_PREFETCH_MIN', '1'))
+PREFETCH_MAX = int(os.getenv('MIDDLEWARE_PREFETCH_MAX', '1000'))
+PREFETCH_TARGET_MS = int(os.getenv('MIDDLEWARE_PREFETCH_TARGET_MS', '100'))
+PREFETCH_INTERVAL_MS = int(os.getenv('MIDDLEWARE_PREFETCH_INTERVAL_MS', '1000'))
+# Per-consumer limits only apply to consumers created after them, so an
+# adaptive prefetch is set as a channel-wide (global) limit instead, shared
+# by every queue the channel consumes
+ADAPTIVE_PREFETCH = (os.getenv('MIDDLEWARE_ADAPTIVE_PREFETCH', 'false').lower() == 'true'
+                     and PREFETCH_MIN < PREFETCH_MAX)
+# 'blocking' uses a pika.BlockingConnection, 'asyncio' an aio-pika connection
+# driven by an asyncio event loop (see common.asyncio_middleware) and 'memory'
+# an in-process broker with no RabbitMQ at all (see common.memory_middleware)
+BLOCKING_BACKEND = 'blocking'
+ASYNCIO_BACKEND = 'asyncio'
+MEMORY_BACKEND = 'memory'
+MIDDLEWARE_BACKEND = os.getenv('MIDDLEWARE_BACKEND', BLOCKING_BACKEND)
+# With publisher confirms, a message is acked only once the broker confirmed
+# every publish derived from it. Nacked publishes are retried PUBLISH_RETRIES
+# times. At most CONFIRM_WINDOW publishes wait for a confirm at once. The
+# blocking backend waits for each one before the next publish, so it only
+# accepts a window of 1, its default: windowed confirms need the asyncio
+# backend, which the docker-compose generator selects along with confirms.
+PUBLISHER_CONFIRMS = os.getenv('MIDDLEWARE_PUBLISHER_CONFIRMS', 'false').lower() == 'true'
+CONFIRM_WINDOW = int(os.getenv('MIDDLEWARE_CONFIRM_WINDOW',
+                               '256' if MIDDLEWARE_BACKEND == ASYNCIO_BACKEND else '1'))
+PUBLISH_RETRIES = int(os.getenv('MIDDLEWARE_PUBLISH_RETRIES', '3'))
+# Outgoing packets are grouped per destination into BatchPackets of up to
+# BATCH_SIZE packets / BATCH_MAX_BYTES bytes. A batch size of 1 disables it.
+# Batches are flushed before the input messages they derive from are acked:
+# after each message, or after each group under a group commit. EOFs are
+# never batched.
+BATCH_SIZE = int(os.getenv('MIDDLEWARE_BATCH_SIZE', '100'))
+BATCH_MAX_BYTES = int(os.getenv('MIDDLEWARE_BATCH_MAX_BYTES', str(256 * 1024)))
+BATCH_TIMEOUT_MS = int(os.getenv('MIDDLEWARE_BATCH_TIMEOUT_MS', '100'))
+# Stateful stages (with a PersistenceManager) can group-commit: the state
+# writes and processed ids of up to GROUP_COMMIT_SIZE messages are persisted
+# together and acked with a single multiple ack, at most GROUP_COMMIT_MS after
+# the first of them was processed. A group size of 1 disables it.
+GROUP_COMMIT_SIZE = int(os.getenv('MIDDLEWARE_GROUP_COMMIT_SIZE', '1'))
+GROUP_COMMIT_MS = int(os.getenv('MIDDLEWARE_GROUP_COMMIT_MS', '50'))
+GROUP_COMMIT_FSYNC = os.getenv('MIDDLEWARE_GROUP_COMMIT_FSYNC', 'false').lower() == 'true'
+# Packets are published in the binary format (see common.binary_codec) to the
+# queues and exchanges listed here and as JSON everywhere else. Consumers
+# read both, so a queue is switched once all of its consumers are upgraded.
+# Instance queues ({queue}_{i}) follow the name of their queue.
+BINARY_QUEUES = set(json.loads(os.getenv('MIDDLEWARE_BINARY_QUEUES') or '[]'))
+# Messages of at least min_bytes sent to the queues and exchanges in
+# MIDDLEWARE_COMPRESSION are zlib-compressed at the given level, e.g.
+# {"reviews": {"level": 1, "min_bytes": 4096}}, and flagged with the
+# COMPRESSED_ENCODING content encoding, so consumers only inflate those.
+# Shared memory queues are never compressed.
+COMPRESSION: dict[str, dict] = json.loads(os.getenv('MIDDLEWARE_COMPRESSION') or '{}')
+COMPRESSION_LEVEL = int(os.getenv('MIDDLEWARE_COMPRESSION_LEVEL', '1'))
+COMPRESSION_MIN_BYTES = int(os.getenv('MIDDLEWARE_COMPRESSION_MIN_BYTES', '4096'))
+COMPRESSED_ENCODING = 'deflate'
+
+# EOFs are aggregated per stage through these queues and exchange, named
+# after the stage input queue (see Middleware._init_eof_coordination)
+EOF_COORDINATOR_SUFFIX = 'eof_coordinator'
+EOF_DRAIN_SUFFIX = 'eof_drain'
+EOF_COORDINATOR_INSTANCE = 0
 
 PROCESSED_KEY = 'processed'
+PROCESSED_LOG_KEY = f'{PROCESSED_KEY}_log'
+PROCESSED_SNAPSHOT_KEY = f'{PROCESSED_KEY}_snapshot'
+# Processed ids are logged one by one and folded into a compact snapshot
+# every PROCESSED_SNAPSHOT_INTERVAL ids
+PROCESSED_SNAPSHOT_INTERVAL = int(os.getenv('MIDDLEWARE_PROCESSED_SNAPSHOT_INTERVAL', '10000'))
+
+
+# How packets are sent to an output: in the binary format or as JSON, the
+# Projection applied to them and the zlib level and minimum size to compress
+OutputFormat = namedtuple('OutputFormat', ['binary', 'projection', 'compression_level', 'compression_min_bytes'])
 
 
 class CallbackAction:
@@ -23,6 +117,15 @@ class CallbackAction:
 
 
 class Middleware:
+    def __new__(cls, *args, **kwargs):
+        if cls is Middleware and MIDDLEWARE_BACKEND == ASYNCIO_BACKEND:
+            from common.asyncio_middleware import AsyncioMiddleware
+            cls = AsyncioMiddleware
+        elif cls is Middleware and MIDDLEWARE_BACKEND == MEMORY_BACKEND:
+            from common.memory_middleware import MemoryMiddleware
+            cls = MemoryMiddleware
+        return super().__new__(cls)
+
     def __init__(self,
                  input_queues: dict[str, str] = {},
                  callback: Callable = None,
@@ -32,11 +135,10 @@ class Middleware:
                  n_output_instances: int = None,
                  instance_id: int = None,
                  persistence_manager: PersistenceManager = None,
+                 cluster_size: int = 1,
+                 cluster_instance_id: int = None,
+                 lazy_decoding: bool = False,
                  ):
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(
-            RABBITMQ_HOST, RABBITMQ_PORT, heartbeat=RABBITMQ_HEARTBEAT))
-        self.channel = self.connection.channel()
-        self.channel.basic_qos(prefetch_count=100)
         self.input_queues: dict[str, str] = {}
         self.output_queues = output_queues
         self.output_exchanges = output_exchanges
@@ -44,13 +146,102 @@ class Middleware:
         self.eof_callback = eof_callback
         self.n_output_instances = n_output_instances
         self.instance_id = instance_id
-        self._init_input(input_queues)
-        self._init_output()
+        self.cluster_size = cluster_size
+        self.cluster_instance_id = instance_id if cluster_instance_id is None else cluster_instance_id
+        # Books and Reviews reach the callback as LazyPackets, for stages that
+        # only look at a few fields and forward packets unchanged
+        self.lazy_decoding = lazy_decoding
         self.should_stop = False
+        self._eof_coordinator_queue: str = None
+        self._eof_drain_exchange: str = None
+        self.control_channel = None
+        # (client_id, packet_id) -> {instance_id: delivery_tag} of the EOF
+        # reports received by the coordinator and not acked yet
+        self._eof_reports: dict[tuple[int, int], dict[int, any]] = {}
+        self._pending: dict[tuple[str, str], list] = {}
+        self._output_formats: dict[tuple[str, str], OutputFormat] = {}
+        self._pending_bytes: dict[tuple[str, str], int] = {}
+        self._pending_since: float = None
+        self._uncommitted_ids: dict[int, list[int]] = {}
+        self._uncommitted_messages = 0
+        # Last delivery tag of the group per source: '' for the channel,
+        # the queue name for shared memory queues
+        self._uncommitted_delivery_tags: dict[str, any] = {}
+        self._commit_scheduled = False
+        self._shm_producers = {}
+        # Shared memory queues published to through RabbitMQ from now on
+        self._shm_fallbacks: set[str] = set()
+        self._shm_consumers = {}
         self.persistence_manager = persistence_manager
-        self.state: dict[int, set[int]] = {}
+        self.group_commit = persistence_manager is not None and GROUP_COMMIT_SIZE > 1
+        self.state: dict[int, ProcessedIds] = {}
+        self._log_sizes: dict[int, int] = {}
+        # Messages of a group are acked together, so fewer of them would stall
+        minimum = max(PREFETCH_MIN, GROUP_COMMIT_SIZE) if self.group_commit else PREFETCH_MIN
+        self.prefetch_controller = PrefetchController(
+            PREFETCH_COUNT, minimum, max(PREFETCH_MAX, minimum),
+            PREFETCH_TARGET_MS / 1000, PREFETCH_INTERVAL_MS / 1000)
+        self._connect()
+        self._init_input(input_queues)
+        self._init_output()
         self.init_state()
 
+    def _connect(self):
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(
+            RABBITMQ_HOST, RABBITMQ_PORT, heartbeat=RABBITMQ_HEARTBEAT))
+        self.channel = self.connection.channel()
+        self._set_prefetch(self.prefetch_controller.prefetch)
+        if PUBLISHER_CONFIRMS:
+            if CONFIRM_WINDOW > 1:
+                raise ValueError(f"MIDDLEWARE_CONFIRM_WINDOW={CONFIRM_WINDOW} needs MIDDLEWARE_BACKEND=asyncio, "
+                                 f"the blocking backend waits for every confirm before the next publish")
+            self.channel.confirm_delivery()
+
+    def _set_prefetch(self, prefetch_count: int):
+        self.channel.basic_qos(prefetch_count=prefetch_count, global_qos=ADAPTIVE_PREFETCH)
+
+    def _declare_queue(self, queue: str):
+        self.channel.queue_declare(queue=queue)
+
+    def _declare_exchange(self, exchange: str, exchange_type: str = 'fanout'):
+        self.channel.exchange_declare(
+            exchange=exchange, exchange_type=exchange_type)
+
+    def _bind_queue(self, queue: str, exchange: str):
+        self.channel.queue_bind(exchange=exchange, queue=queue)
+
+    def _consume(self, queue: str, callback: Callable, auto_ack: bool):
+        self.channel.basic_consume(
+            queue=queue,
+            on_message_callback=callback,
+            auto_ack=auto_ack)
+
+    def _basic_publish(self, exchange: str, routing_key: str, body: str, content_encoding: str = None):
+        properties = pika.BasicProperties(content_encoding=content_encoding) if content_encoding else None
+        for attempt in range(1, PUBLISH_RETRIES + 1):
+            try:
+                self.channel.basic_publish(
+                    exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+                return
+            except pika.exceptions.NackError:
+                if attempt == PUBLISH_RETRIES:
+                    raise
+                logging.warning(f"Publish to {routing_key or exchange} was nacked, retrying ({attempt})")
+
+    def _call_later(self, delay: float, callback: Callable):
+        self.connection.call_later(delay, callback)
+
+    def _open_control_channel(self):
+        self.control_channel = self.connection.channel()
+
+    def _consume_control(self, queue: str, callback: Callable):
+        self.control_channel.basic_consume(
+            queue=queue,
+            on_message_callback=lambda ch, method, properties, body: callback(body, method.delivery_tag))
+
+    def _ack_control(self, delivery_tag):
+        self.control_channel.basic_ack(delivery_tag=delivery_tag)
+
     def _init_input(self, input_queues):
         for queue, exchange in input_queues.items():
             suffix = "" if self.instance_id is None else f'_{self.instance_id}'
@@ -61,15 +252,14 @@ class Middleware:
     def _init_output(self):
         if self.n_output_instances is None:
             for queue in self.output_queues:
-                self.channel.queue_declare(queue=queue)
+                self._declare_queue(queue)
         else:
             for i in range(self.n_output_instances):
                 for queue in self.output_queues:
-                    self.channel.queue_declare(queue=f'{queue}_{i}')
+                    self._declare_queue(f'{queue}_{i}')
 
         for exchange in self.output_exchanges:
-            self.channel.exchange_declare(
-                exchange=exchange, exchange_type='fanout')
+            self._declare_exchange(exchange)
 
     def start(self):
         logging.info("Middleware started")
@@ -81,26 +271,137 @@ class Middleware:
         except pika.exceptions.ConnectionClosedByBroker:
             logging.debug("Connection closed")
 
-    def send(self, data: str, instance_id: int = None):
+    def send(self, data, instance_id: int = None):
+        """Publishes data to every output, in the wire format of each one.
+
+        data can be a Packet or LazyPacket, or an already encoded packet
+        (JSON str or binary bytes), which is forwarded unchanged unless its
+        output takes the other format.
+        """
         if not self.should_stop:
             suffix = f"_{instance_id}" if instance_id is not None else ""
             for queue in self.output_queues:
                 self.send_to_queue(f'{queue}{suffix}', data)
 
             for exchange in self.output_exchanges:
-                self.channel.basic_publish(
-                    exchange=exchange, routing_key='', body=data)
+                self._publish(exchange, '', data)
                 logging.debug("Sent to exchange %s: %s", exchange, data)
 
-    def send_to_queue(self, queue: str, data: str):
-        self.channel.basic_publish(exchange='', routing_key=queue, body=data)
+    def send_to_queue(self, queue: str, data):
+        self._publish('', queue, data)
         logging.debug("Sent to queue %s: %s", queue, data)
 
+    def _publish(self, exchange: str, routing_key: str, data):
+        destination = (exchange, routing_key)
+        output_format = self._output_format(destination)
+        eof = isinstance(data, EOFPacket)
+        if output_format.projection is not None:
+            data = output_format.projection.apply(data)
+        data = self._encode(data, output_format.binary)
+        if BATCH_SIZE <= 1 or eof:
+            # An EOF goes in a message of its own, after the packets before
+            # it. In their batch, a redelivery after it was handled would
+            # bring back packets of a client already cleared downstream.
+            self._flush_destination(destination)
+            self._send(exchange, routing_key, data)
+            return
+
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+        self._pending.setdefault(destination, []).append(data)
+        self._pending_bytes[destination] = self._pending_bytes.get(
+            destination, 0) + len(data)
+        if len(self._pending[destination]) >= BATCH_SIZE \
+                or self._pending_bytes[destination] >= BATCH_MAX_BYTES:
+            self._flush_destination(destination)
+        elif (time.monotonic() - self._pending_since) * 1000 >= BATCH_TIMEOUT_MS:
+            self.flush()
+
+    def _flush_destination(self, destination: tuple[str, str]):
+        packets = self._pending.pop(destination, [])
+        self._pending_bytes.pop(destination, None)
+        if not self._pending:
+            self._pending_since = None
+        if not packets:
+            return
+        (exchange, routing_key) = destination
+        if len(packets) == 1:
+            body = packets[0]
+        elif self._output_format(destination).binary:
+            body = BinaryCodec.encode_batch(packets)
+        else:
+            body = BatchPacket(packets).encode()
+        self._send(exchange, routing_key, body)
+        logging.debug("Flushed %d packets to %s", len(packets), destination)
+
+    def _output_format(self, destination: tuple[str, str]) -> OutputFormat:
+        if destination not in self._output_formats:
+            (exchange, routing_key) = destination
+            name = exchange or routing_key
+            # Instance queues ({queue}_{i}) are sent to as their queue is
+            (queue, _separator, suffix) = name.rpartition('_')
+            names = [name, queue] if suffix.isdigit() else [name]
+            binary = any(name in BINARY_QUEUES for name in names)
+            compression = next((COMPRESSION[name] for name in names if name in COMPRESSION), None)
+            self._output_formats[destination] = OutputFormat(
+                binary,
+                Projection.for_output(name),
+                None if compression is None else compression.get('level', COMPRESSION_LEVEL),
+                None if compression is None else compression.get('min_bytes', COMPRESSION_MIN_BYTES))
+        return self._output_formats[destination]
+
+    @staticmethod
+    def _encode(data, binary: bool):
+        """Encodes data in the binary or JSON format, re-encoding it only if needed."""
+        if isinstance(data, LazyPacket):
+            data = data.body
+        if isinstance(data, (str, bytes)):
+            if BinaryCodec.is_binary(data) == binary:
+                return data
+            if not binary and isinstance(data, bytes) and not BinaryCodec.is_binary(data):
+                return data.decode()
+            data = PacketDecoder.decode(data)
+        return BinaryCodec.encode(data) if binary else data.encode()
+
+    def _send(self, exchange: str, routing_key: str, body):
+        if not exchange and routing_key in SHM_QUEUES and routing_key not in self._shm_fallbacks:
+            if routing_key not in self._shm_producers:
+                self._shm_producers[routing_key] = open_producer(routing_key)
+            if self._shm_producers[routing_key].publish(body.encode() if isinstance(body, str) else body):
+                return
+            # The ring is empty by now, and everything after this message
+            # goes through RabbitMQ too, so that it keeps its order
+            logging.warning(f"Message too large for shared memory queue {routing_key}, "
+                            f"publishing it and every later one through RabbitMQ")
+            self._shm_fallbacks.add(routing_key)
+            self._shm_producers.pop(routing_key).ring.close()
+
+        output_format = self._output_format((exchange, routing_key))
+        if output_format.compression_level is not None and len(body) >= output_format.compression_min_bytes:
+            compressed = zlib.compress(body.encode() if isinstance(body, str) else body,
+                                       output_format.compression_level)
+            if len(compressed) < len(body):
+                self._basic_publish(exchange, routing_key, compressed, COMPRESSED_ENCODING)
+                return
+        self._basic_publish(exchange, routing_key, body)
+
+    def flush(self):
+        """Publishes every batched packet that has not been sent yet."""
+        for destination in list(self._pending):
+            self._flush_destination(destination)
+
     def _shutdown(self):
         self.should_stop = True
+        try:
+            self.flush()
+            self.commit()
+        except Exception as e:
+            logging.error(f"Error flushing pending packets on shutdown: {e}")
 
         if self.input_queues:
             self.stop()
+            if ADAPTIVE_PREFETCH:
+                logging.info(f"Prefetch stats: {self.prefetch_controller.stats()}")
 
         if self.channel:
             self.channel.close()
@@ -112,6 +413,10 @@ class Middleware:
         logging.info("Stopping middleware")
         self.connection.add_callback_threadsafe(self._shutdown)
 
+    def call_threadsafe(self, callback: Callable):
+        """Runs callback on the thread of the middleware, from any other thread, e.g. to send from it."""
+        self.connection.add_callback_threadsafe(callback)
+
     def add_input_queue(self,
                         input_queue: str,
                         callback: Callable,
@@ -119,23 +424,59 @@ class Middleware:
                         exchange: str = "",
                         exchange_type: str = "fanout",
                         auto_ack=False):
-        self.channel.queue_declare(queue=input_queue)
+        if auto_ack:
+            # Nothing to ack later, so there is nothing to group either
+            self.group_commit = False
+        self._declare_queue(input_queue)
         if exchange:
-            self.channel.exchange_declare(
-                exchange=exchange, exchange_type=exchange_type)
-            self.channel.queue_bind(exchange=exchange, queue=input_queue)
+            self._declare_exchange(exchange, exchange_type)
+            self._bind_queue(input_queue, exchange)
 
         wrapped_callback = self._callback_wrapper(callback,
                                                   eof_callback,
                                                   auto_ack)
-        self.channel.basic_consume(
-            queue=input_queue,
-            on_message_callback=wrapped_callback,
-            auto_ack=auto_ack)
+        self._consume(input_queue, wrapped_callback, auto_ack)
+        if self.cluster_size > 1 and self._eof_coordinator_queue is None and not auto_ack:
+            self._init_eof_coordination(input_queue, wrapped_callback)
+        if input_queue in SHM_QUEUES:
+            # Still consumed from RabbitMQ too, where producers on other hosts
+            # (or with a message too large for the ring) publish
+            self._shm_consumers[input_queue] = (open_consumer(input_queue), wrapped_callback, auto_ack)
+            if len(self._shm_consumers) == 1:
+                self._call_later(SHM_POLL_MS / 1000, self._poll_shm)
 
         if input_queue not in self.input_queues:
             self.input_queues[input_queue] = exchange
 
+    def _init_eof_coordination(self, input_queue: str, wrapped_callback: Callable):
+        """Sets up the control queues that aggregate the EOFs of the stage.
+
+        Every instance reports to the coordinator (instance 0) once it has
+        handled an EOF, and the coordinator emits the downstream EOF as soon
+        as all of them did. Instances with their own input queue get their
+        own copy of the EOF from upstream. On a queue shared by competing
+        instances only one of them receives it, so that one broadcasts a
+        drain marker through the drain exchange. Peers consume it on the same
+        channel as their data, so it is handled only after every message
+        they were already delivered.
+        """
+        stage = input_queue if self.instance_id is None else input_queue.removesuffix(f'_{self.instance_id}')
+        self._eof_coordinator_queue = f'{stage}_{EOF_COORDINATOR_SUFFIX}'
+        self._declare_queue(self._eof_coordinator_queue)
+        if self.instance_id is None:
+            self._eof_drain_exchange = f'{stage}_{EOF_DRAIN_SUFFIX}'
+            drain_queue = f'{self._eof_drain_exchange}_{self.cluster_instance_id}'
+            self._declare_exchange(self._eof_drain_exchange)
+            self._declare_queue(drain_queue)
+            self._bind_queue(drain_queue, self._eof_drain_exchange)
+            self._consume(drain_queue, wrapped_callback, False)
+
+        if self.cluster_instance_id == EOF_COORDINATOR_INSTANCE:
+            # Reports stay unacked until every instance reported, so they are
+            # consumed on their own channel where they do not take up prefetch
+            self._open_control_channel()
+            self._consume_control(self._eof_coordinator_queue, self._on_eof_report)
+
     def _callback_wrapper(self,
                           callback: Callable[[Packet], CallbackAction],
                           eof_callback: Callable[[EOFPacket], any],
@@ -143,56 +484,197 @@ class Middleware:
                           ):
 
         def wrapper(ch, method, properties, body):
-            packet = PacketDecoder.decode(body)
-            action = CallbackAction.ACK
-            if packet.packet_type == PacketType.EOF:
-                logging.debug("Received EOF packet")
-                if eof_callback:
-                    action = eof_callback(packet) or CallbackAction.ACK
-
-                if action == CallbackAction.ACK:
-                    self.clear_processed(packet.client_id)
+            started = time.perf_counter()
+            if properties is not None and properties.content_encoding == COMPRESSED_ENCODING:
+                body = zlib.decompress(body)
+            if self.lazy_decoding:
+                packet = PacketDecoder.decode_lazy(body)
             else:
-                if not self.is_duplicate(packet):
-                    action = callback(packet) or CallbackAction.ACK
-                    if action == CallbackAction.ACK:
-                        self.mark_as_processed(packet)
+                packet = PacketDecoder.decode(body)
+            packets = packet.packets if packet.packet_type == PacketType.BATCH else [packet]
+            actions = [self._handle_packet(packet, callback, eof_callback, method)
+                       for packet in packets]
+            # Everything derived from this message has to reach the broker
+            # before the message is acknowledged, which under a group commit
+            # is when the group is, so batches span the whole group
+            if auto_ack or not self.group_commit:
+                self.flush()
 
             if not auto_ack:
-                if action == CallbackAction.ACK:
-                    self.ack(method.delivery_tag)
-                elif action == CallbackAction.NACK:
+                self.prefetch_controller.record_message(time.perf_counter() - started)
+                if CallbackAction.NACK in actions:
                     self.nack(method.delivery_tag)
-                elif action == CallbackAction.REQUEUE:
-                    self.send_to_queue(method.routing_key, body)
+                    self.prefetch_controller.record_ack()
+                elif self.group_commit:
+                    self._defer_ack(method.delivery_tag)
+                else:
                     self.ack(method.delivery_tag)
-                    logging.debug("Requeued packet to %s", method.routing_key)
+                    self.prefetch_controller.record_ack()
+                self._adjust_prefetch()
 
         return wrapper
 
-    def ack(self, delivery_tag):
-        self.channel.basic_ack(delivery_tag=delivery_tag)
+    def _handle_packet(self,
+                       packet: Packet,
+                       callback: Callable[[Packet], CallbackAction],
+                       eof_callback: Callable[[EOFPacket], any],
+                       method) -> CallbackAction:
+        action = CallbackAction.ACK
+        if packet.packet_type == PacketType.EOF:
+            if packet.ack_instances == [self.cluster_instance_id]:
+                # Our own drain marker, this instance already handled the EOF
+                return action
+            logging.debug("Received EOF packet")
+            # EOF handling cleans up state, so previous messages must be durable first
+            self.commit()
+            if eof_callback:
+                action = eof_callback(packet) or CallbackAction.ACK
+
+            if action == CallbackAction.ACK:
+                self.clear_processed(packet.client_id)
+                self._eof_handled(packet)
+        else:
+            if not self.is_duplicate(packet):
+                if self.group_commit:
+                    self.persistence_manager.begin_transaction()
+                action = callback(packet) or CallbackAction.ACK
+                if action == CallbackAction.ACK:
+                    self.mark_as_processed(packet)
+
+        if action == CallbackAction.REQUEUE:
+            self.send_to_queue(method.routing_key, packet)
+            logging.debug("Requeued packet to %s", method.routing_key)
+        return action
+
+    def _eof_handled(self, eof_packet: EOFPacket):
+        if self.cluster_size <= 1 or self._eof_coordinator_queue is None:
+            self.send_eof(eof_packet)
+            return
+
+        # Everything this instance derived from the client's packets has to
+        # reach the broker before its report, so it is all flushed first
+        self.flush()
+        if self.instance_id is None and not eof_packet.ack_instances:
+            marker = EOFPacket(eof_packet.client_id, eof_packet.packet_id, [self.cluster_instance_id])
+            self._send(self._eof_drain_exchange, '', marker.encode())
+            logging.debug(f"Broadcast drain marker for client {eof_packet.client_id}")
+        report = EOFPacket(eof_packet.client_id, eof_packet.packet_id, [self.cluster_instance_id])
+        self._send('', self._eof_coordinator_queue, report.encode())
+        logging.debug(f"Reported EOF of client {eof_packet.client_id} to the coordinator")
+
+    def _on_eof_report(self, body: bytes, delivery_tag):
+        report = PacketDecoder.decode(body)
+        key = (report.client_id, report.packet_id)
+        reports = self._eof_reports.setdefault(key, {})
+        for instance_id in report.ack_instances:
+            if instance_id in reports:
+                # Reported twice (the EOF was redelivered), the older one can go
+                self._ack_control(reports[instance_id])
+            reports[instance_id] = delivery_tag
+        logging.debug(f"EOF of client {report.client_id}: {len(reports)}/{self.cluster_size} instances done")
+        if len(reports) < self.cluster_size:
+            return
+
+        self.send_eof(report)
+        self.flush()
+        for delivery_tag in self._eof_reports.pop(key).values():
+            self._ack_control(delivery_tag)
+        logging.info(f"All instances done with client {report.client_id}, forwarded EOF")
+
+    def send_eof(self, eof_packet: EOFPacket):
+        """Sends the EOF downstream, to every instance when there are several."""
+        data = EOFPacket(eof_packet.client_id, eof_packet.packet_id)
+        if self.n_output_instances is None:
+            self.send(data)
+            return
+        for instance_id in range(self.n_output_instances):
+            for queue in self.output_queues:
+                self.send_to_queue(f'{queue}_{instance_id}', data)
+        for exchange in self.output_exchanges:
+            self._publish(exchange, '', data)
+
+    def _poll_shm(self):
+        if self.should_stop:
+            return
+        delivered = 0
+        for (queue, (consumer, callback, auto_ack)) in self._shm_consumers.items():
+            limit = max(0, self.prefetch_controller.prefetch - consumer.unacked)
+            for (delivery_tag, body) in consumer.poll(limit):
+                callback(self.channel, ShmDelivery(delivery_tag, queue), None, body)
+                if auto_ack:
+                    consumer.ack(delivery_tag)
+                delivered += 1
+        self._call_later(0 if delivered else SHM_POLL_MS / 1000, self._poll_shm)
+
+    def _adjust_prefetch(self):
+        if not ADAPTIVE_PREFETCH:
+            return
+        prefetch_count = self.prefetch_controller.update()
+        if prefetch_count is not None:
+            self._set_prefetch(prefetch_count)
+
+    def ack(self, delivery_tag, multiple: bool = False):
+        if isinstance(delivery_tag, ShmDeliveryTag):
+            self._shm_consumers[delivery_tag.queue][0].ack(delivery_tag, multiple)
+        else:
+            self.channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple)
+
+    def _defer_ack(self, delivery_tag):
+        source = delivery_tag.queue if isinstance(delivery_tag, ShmDeliveryTag) else ''
+        self._uncommitted_delivery_tags[source] = delivery_tag
+        self._uncommitted_messages += 1
+        if self._uncommitted_messages >= GROUP_COMMIT_SIZE:
+            self.commit()
+        elif not self._commit_scheduled:
+            self._commit_scheduled = True
+            self._call_later(GROUP_COMMIT_MS / 1000, self._on_commit_timeout)
+
+    def _on_commit_timeout(self):
+        self._commit_scheduled = False
+        if not self.should_stop:
+            self.commit()
+
+    def commit(self):
+        """Publishes the packets batched for the pending group, persists it and acks every message in it.
+
+        Processed ids are logged in the same transaction as the state written
+        by the callbacks, which the persistence manager commits atomically,
+        so a crash never keeps one without the other. Messages are only
+        acked after that.
+        """
+        if not self.group_commit:
+            return
+        self.flush()
+        self.persistence_manager.begin_transaction()
+        for client_id, packet_ids in self._uncommitted_ids.items():
+            self._log_processed(client_id, packet_ids)
+        self.persistence_manager.commit_transaction(GROUP_COMMIT_FSYNC)
+        for client_id in self._uncommitted_ids:
+            self._snapshot_processed(client_id)
+        self._uncommitted_ids = {}
+
+        for delivery_tag in self._uncommitted_delivery_tags.values():
+            self.ack(delivery_tag, multiple=True)
+        if self._uncommitted_delivery_tags:
+            self.prefetch_controller.record_ack(self._uncommitted_messages)
+            logging.debug("Committed %d messages", self._uncommitted_messages)
+        self._uncommitted_delivery_tags = {}
+        self._uncommitted_messages = 0
 
     def nack(self, delivery_tag):
-        self.channel.basic_nack(delivery_tag=delivery_tag)
+        if isinstance(delivery_tag, ShmDeliveryTag):
+            self._shm_consumers[delivery_tag.queue][0].nack(delivery_tag)
+        else:
+            self.channel.basic_nack(delivery_tag=delivery_tag)
 
     def stop(self):
         self.channel.stop_consuming()
         logging.info("Middleware stopped consuming messages")
 
-    def return_eof(self, eof_packet: EOFPacket):
-        data = eof_packet.encode()
-        for queue in self.input_queues:
-            queue = queue if self.instance_id is None else queue.removesuffix(
-                f'{self.instance_id}')+f"{self.instance_id+1}"
-            self.channel.basic_publish(
-                exchange='', routing_key=queue, body=data)
-            logging.debug("Sent to queue %s: %s", queue, data)
-
     def is_duplicate(self, packet: Packet) -> bool:
         if self.persistence_manager:
-            processed_ids = self.state.get(packet.client_id, set())
-            if packet.packet_id in processed_ids:
+            processed_ids = self.state.get(packet.client_id)
+            if processed_ids is not None and packet.packet_id in processed_ids:
                 logging.debug(f"Packet {packet.trace_id} is a duplicate!")
                 return True
         return False
@@ -202,27 +684,77 @@ class Middleware:
             client_id = packet.client_id
             packet_id = packet.packet_id
             if client_id not in self.state:
-                self.state[client_id] = set()
+                self.state[client_id] = ProcessedIds()
             self.state[client_id].add(packet_id)
-            key = f"{PROCESSED_KEY}_{client_id}"
-            self.persistence_manager.append(key, str(packet_id))
+            if self.group_commit:
+                self._uncommitted_ids.setdefault(client_id, []).append(packet_id)
+                return
+            self._log_processed(client_id, [packet_id])
+            self._snapshot_processed(client_id)
             logging.debug(f"Marked {packet.trace_id} as processed")
 
+    def _log_processed(self, client_id: int, packet_ids: list[int]):
+        self.persistence_manager.append(
+            PROCESSED_LOG_KEY,
+            '\n'.join(str(packet_id) for packet_id in packet_ids),
+            f"{PROCESSED_KEY}_{client_id}")
+        self._log_sizes[client_id] = self._log_sizes.get(client_id, 0) + len(packet_ids)
+
+    def _snapshot_processed(self, client_id: int):
+        if self._log_sizes.get(client_id, 0) < PROCESSED_SNAPSHOT_INTERVAL:
+            return
+        # The snapshot already contains every logged id, so a crash before
+        # the log is deleted only replays ids that are already there
+        secondary_key = f"{PROCESSED_KEY}_{client_id}"
+        self.persistence_manager.put(
+            PROCESSED_SNAPSHOT_KEY, self.state[client_id].encode(), secondary_key)
+        self.persistence_manager.delete_keys(PROCESSED_LOG_KEY, secondary_key)
+        self._log_sizes[client_id] = 0
+
     def clear_processed(self, client_id: int):
         if self.persistence_manager:
-            key = f"{PROCESSED_KEY}_{client_id}"
-            self.persistence_manager.delete_keys(key)
+            self.persistence_manager.delete_keys(secondary_key=f"{PROCESSED_KEY}_{client_id}")
             self.state.pop(client_id, None)
+            self._log_sizes.pop(client_id, None)
             logging.debug(f"Cleared processed packets for client {client_id}")
 
     def init_state(self):
         if self.persistence_manager:
             keys = self.persistence_manager.get_keys(PROCESSED_KEY)
             for (key, secondary_key) in keys:
-                client_id = int(key.split('_', maxsplit=1)[1])
-                processed_ids = self.persistence_manager.get(key, secondary_key).splitlines()
-                self.state[client_id] = set(processed_ids)
-            logging.debug(f"Initialized state with {self.state}")
+                if key == PROCESSED_SNAPSHOT_KEY:
+                    client_id = int(secondary_key.removeprefix(f"{PROCESSED_KEY}_"))
+                    self.state[client_id] = ProcessedIds.decode(
+                        self.persistence_manager.get(key, secondary_key))
+
+            legacy_keys = []
+            for (key, secondary_key) in keys:
+                if key == PROCESSED_SNAPSHOT_KEY:
+                    continue
+                if key == PROCESSED_LOG_KEY:
+                    client_id = int(secondary_key.removeprefix(f"{PROCESSED_KEY}_"))
+                else:
+                    # Plain id log written by previous versions as processed_<client_id>
+                    client_id = int(key.split('_', maxsplit=1)[1])
+                    legacy_keys.append((key, secondary_key))
+                processed_ids = self.state.setdefault(client_id, ProcessedIds())
+                packet_ids = []
+                n_packet_ids = 0
+                # Each record holds the ids of a message or of a group commit
+                for record in self.persistence_manager.iter_records(key, secondary_key):
+                    for packet_id in record.splitlines():
+                        processed_ids.add(int(packet_id))
+                        n_packet_ids += 1
+                        if key != PROCESSED_LOG_KEY:
+                            packet_ids.append(int(packet_id))
+                if key == PROCESSED_LOG_KEY:
+                    self._log_sizes[client_id] = self._log_sizes.get(client_id, 0) + n_packet_ids
+                elif packet_ids:
+                    self._log_processed(client_id, packet_ids)
+
+            for (key, secondary_key) in legacy_keys:
+                self.persistence_manager.delete_keys(key, secondary_key)
+            logging.debug(f"Initialized state with {[str(ids) for ids in self.state.values()]}")
         else:
             logging.debug(
                 "No persistence manager, skipping state initialization")
@@ -2,9 +2,12 @@ import json
 import logging
 
 from common.authors import Authors
+from common.batch_packet import BatchPacket
+from common.binary_codec import BinaryCodec
 from common.book import Book
 from common.book_stats import BookStats
 from common.eof_packet import EOFPacket
+from common.lazy_packet import HEADER_REGEX, LazyPacket
 from common.packet_type import PacketType
 from common.review import Review
 from common.review_and_author import ReviewAndAuthor
@@ -13,8 +16,47 @@ from common.packet import Packet
 
 class PacketDecoder:
     @staticmethod
-    def decode(body: str) -> 'Packet':
-        fields = json.loads(body)
+    def decode(body) -> 'Packet':
+        if BinaryCodec.is_binary(body):
+            return PacketDecoder.decode_fields(BinaryCodec.decode(body))
+        return PacketDecoder.decode_fields(json.loads(body))
+
+    @staticmethod
+    def decode_lazy(body) -> 'Packet':
+        """Decodes Books and Reviews, on their own or batched, as LazyPackets.
+
+        Any other packet (or a batch holding one) is decoded as usual.
+        """
+        if BinaryCodec.is_binary(body):
+            return PacketDecoder._decode_lazy_binary(body)
+        if isinstance(body, bytes):
+            body = body.decode()
+        header = HEADER_REGEX.match(body)
+        if header and int(header.group(3)) == PacketType.BATCH.value:
+            packets = LazyPacket.view_batch(body, header.end())
+            if packets is not None:
+                return BatchPacket.decode(packets)
+        elif header:
+            packet = LazyPacket.from_header(body, header)
+            if packet is not None:
+                return packet
+        return PacketDecoder.decode(body)
+
+    @staticmethod
+    def _decode_lazy_binary(body: bytes) -> 'Packet':
+        header = BinaryCodec.decode_header(body)
+        if header.packet_type == PacketType.BATCH.value:
+            packets = [LazyPacket.from_binary(packet) for packet in BinaryCodec.split_batch(body, header)]
+            if None not in packets:
+                return BatchPacket.decode(packets)
+        else:
+            packet = LazyPacket.from_binary(body, header)
+            if packet is not None:
+                return packet
+        return PacketDecoder.decode(body)
+
+    @staticmethod
+    def decode_fields(fields: list) -> 'Packet':
         client_id = fields[0]
         packet_id = fields[1]
         packet_type = PacketType(fields[2])
@@ -31,6 +73,9 @@ class PacketDecoder:
             return ReviewAndAuthor.decode(packet_payload, client_id, packet_id)
         elif packet_type == PacketType.AUTHORS:
             return Authors.decode(packet_payload, client_id, packet_id)
+        elif packet_type == PacketType.BATCH:
+            return BatchPacket.decode(
+                [PacketDecoder.decode_fields(packet) for packet in packet_payload])
         else:
             logging.error(f"Tipo de paquete desconocido: {packet_type}")
             raise ValueError("Tipo de paquete desconocido")
@@ -9,3 +9,12 @@ class PacketType(Enum):
     REVIEW_AND_AUTHOR = 4
     RESULT = 5
     AUTHORS = 6
+    BATCH = 7
+
+
+# Names of the payload fields of the packets that carry records, in order
+PACKET_FIELDS = {
+    PacketType.BOOK: ['title', 'description', 'authors', 'publisher', 'year', 'categories'],
+    PacketType.REVIEW: ['book_title', 'score', 'text'],
+    PacketType.REVIEW_AND_AUTHOR: ['book_title', 'score', 'text', 'authors'],
+}
@@ -0,0 +1,170 @@
+import itertools
+import json
+import logging
+import os
+from typing import Iterator
+
+from common.persistence_manager import PersistenceManager
+
+# Reviews of a client kept in memory while parked. Further ones spill to
+# disk and are only read back once their book arrives.
+PARKED_REVIEWS_IN_MEMORY = int(os.getenv('PARKED_REVIEWS_IN_MEMORY', '10000'))
+# A client's log is rewritten once it holds as many released entries as
+# parked ones, and at least PARKED_LOG_COMPACTION_MIN_ENTRIES
+PARKED_LOG_COMPACTION_MIN_ENTRIES = int(os.getenv('PARKED_LOG_COMPACTION_MIN_ENTRIES', '1000'))
+
+LOG_KEY = 'log'
+SPILLED_KEY_PREFIX = 'spilled_'
+
+
+class ParkedReviews:
+    """Reviews waiting for their book, per client and title, on disk until they are released.
+
+    A review is persisted before park returns, so its message can be acked
+    right away and the review still survives a crash. Up to
+    PARKED_REVIEWS_IN_MEMORY reviews of a client are kept in memory and
+    logged to a single append log as [title, review], and [title, null]
+    once the reviews of title are released. Reviews past that spill to a
+    log per title, which is read back and deleted on release.
+
+    Releasing takes two steps: take, once the book is known, moves the
+    reviews of a title out of the parked ones, and released, once they
+    were sent on, removes them from disk. A crash in between parks them
+    again on startup, so they are released twice rather than lost. A
+    client with nothing left parked is removed from disk.
+
+    Not thread safe: the caller serializes every call but the iteration of
+    releasing.
+    """
+
+    def __init__(self, persistence_manager: PersistenceManager, name: str = 'parked'):
+        self.persistence_manager = persistence_manager
+        self.name = name
+        # client id -> title -> reviews in memory (and in the log)
+        self._parked: dict[int, dict[str, list[str]]] = {}
+        # client id -> title -> reviews in memory taken, until released
+        self._releasing: dict[int, dict[str, list[str]]] = {}
+        # client id -> titles with spilled reviews
+        self._spilled: dict[int, set[str]] = {}
+        # client id -> (parked entries in its log, released entries)
+        self._log_entries: dict[int, tuple[int, int]] = {}
+
+    def _secondary_key(self, client_id: int) -> str:
+        return f'{self.name}_{client_id}'
+
+    def __contains__(self, client_id: int) -> bool:
+        return bool(self._parked.get(client_id) or self._releasing.get(client_id) or self._spilled.get(client_id))
+
+    def titles(self, client_id: int) -> set[str]:
+        return set(self._parked.get(client_id, {})) | self._spilled.get(client_id, set())
+
+    def park(self, client_id: int, title: str, review: str):
+        (entries, released) = self._log_entries.get(client_id, (0, 0))
+        if entries - released < PARKED_REVIEWS_IN_MEMORY:
+            self.persistence_manager.append(LOG_KEY, json.dumps([title, review]), self._secondary_key(client_id))
+            self._parked.setdefault(client_id, {}).setdefault(title, []).append(review)
+            self._log_entries[client_id] = (entries + 1, released)
+        else:
+            self.persistence_manager.append(_spilled_key(title), review, self._secondary_key(client_id))
+            self._spilled.setdefault(client_id, set()).add(title)
+
+    def take(self, client_id: int, title: str) -> bool:
+        """Starts releasing the reviews of title, returns whether it has any."""
+        reviews = self._parked.get(client_id, {}).pop(title, None)
+        if reviews is None and title not in self._spilled.get(client_id, ()):
+            return False
+        self._releasing.setdefault(client_id, {})[title] = reviews or []
+        return True
+
+    def releasing(self, client_id: int, title: str) -> Iterator[str]:
+        """Returns the reviews of title taken, to send them on."""
+        reviews = self._releasing.get(client_id, {}).get(title, [])
+        if title not in self._spilled.get(client_id, ()):
+            return iter(reviews)
+        spilled = self.persistence_manager.iter_records(_spilled_key(title), self._secondary_key(client_id))
+        return itertools.chain(reviews, spilled)
+
+    def released(self, client_id: int, title: str):
+        """Removes the reviews of title from disk, once they were sent on."""
+        reviews = self._releasing.get(client_id, {}).pop(title, None)
+        if reviews is None:
+            return
+        secondary_key = self._secondary_key(client_id)
+        if title in self._spilled.get(client_id, ()):
+            self._spilled[client_id].discard(title)
+            self.persistence_manager.delete_keys(_spilled_key(title), secondary_key)
+        if client_id not in self:
+            self.clear(client_id)
+            return
+        if reviews:
+            self.persistence_manager.append(LOG_KEY, json.dumps([title, None]), secondary_key)
+            (entries, released) = self._log_entries[client_id]
+            self._log_entries[client_id] = (entries, released + len(reviews))
+            self._maybe_compact(client_id)
+
+    def drop(self, client_id: int):
+        """Forgets the parked reviews of a client but those being released, e.g. once its books ended.
+
+        They stay on disk until the ones being released are, when the
+        whole client is removed.
+        """
+        releasing = self._releasing.get(client_id, {})
+        dropped = self._parked.pop(client_id, {})
+        self._spilled[client_id] = {title for title in self._spilled.get(client_id, ()) if title in releasing}
+        if client_id not in self:
+            self.clear(client_id)
+            return
+        (entries, released) = self._log_entries.get(client_id, (0, 0))
+        self._log_entries[client_id] = (entries, released + sum(len(reviews) for reviews in dropped.values()))
+        logging.debug(f"Dropped parked reviews of client {client_id} of {len(dropped)} titles")
+
+    def clear(self, client_id: int):
+        """Deletes every parked review of a client, which the files backend does in the background."""
+        self.persistence_manager.delete_keys(secondary_key=self._secondary_key(client_id))
+        for parked in [self._parked, self._releasing, self._spilled, self._log_entries]:
+            parked.pop(client_id, None)
+
+    def _maybe_compact(self, client_id: int):
+        (entries, released) = self._log_entries[client_id]
+        if released < max(PARKED_LOG_COMPACTION_MIN_ENTRIES, entries - released):
+            return
+        # A single record, so the log is replaced whole or not at all
+        entries = [json.dumps([title, review])
+                   for parked in [self._parked.get(client_id, {}), self._releasing.get(client_id, {})]
+                   for (title, reviews) in parked.items() for review in reviews]
+        self.persistence_manager.put(LOG_KEY, '\n'.join(entries), self._secondary_key(client_id))
+        self._log_entries[client_id] = (len(entries), 0)
+
+    def load(self) -> list[int]:
+        """Loads the reviews parked before a restart, returns the clients that have any."""
+        secondary_keys = {secondary_key for (_key, secondary_key) in self.persistence_manager.get_keys()
+                          if secondary_key.startswith(f'{self.name}_')}
+        for secondary_key in secondary_keys:
+            suffix = secondary_key.removeprefix(f'{self.name}_')
+            if not suffix.isdigit():
+                continue
+            client_id = int(suffix)
+            parked: dict[str, list[str]] = {}
+            # Each record holds an entry, or every entry of a compacted log
+            for record in self.persistence_manager.iter_records(LOG_KEY, secondary_key):
+                for entry in record.splitlines():
+                    [title, review] = json.loads(entry)
+                    if review is None:
+                        parked.pop(title, None)
+                    else:
+                        parked.setdefault(title, []).append(review)
+            self._parked[client_id] = parked
+            entries = sum(len(reviews) for reviews in parked.values())
+            self._log_entries[client_id] = (entries, 0)
+            self._spilled[client_id] = {json.loads(key.removeprefix(SPILLED_KEY_PREFIX)) for (key, _secondary_key)
+                                        in self.persistence_manager.get_keys(SPILLED_KEY_PREFIX, secondary_key)}
+            if client_id not in self:
+                # Everything was released before the client was removed
+                self.clear(client_id)
+        return list(self._parked)
+
+
+def _spilled_key(title: str) -> str:
+    # A JSON string ends at its only unescaped quote, so deleting this
+    # prefix never matches the key of a longer title
+    return f'{SPILLED_KEY_PREFIX}{json.dumps(title)}'
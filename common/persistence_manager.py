@@ -1,104 +1,521 @@
+import ctypes
 import os
 import logging
+import shutil
+import struct
+import threading
 import uuid
 import json
+import zlib
+from collections import OrderedDict
+from typing import Iterator
+
+from common.sorted_keys import SortedKeys
 
 KEYS_INDEX_KEY_PREFIX = 'keys_index_'
-LENGTH_BYTES = 6
 TEMP_FILE = '_temp'
+# Every secondary key is a namespace with its own directory, holding its key
+# index and the files of its keys, so that deleting all of its keys is a
+# rename of the directory to DROPPED_PREFIX + uuid, removed in the
+# background (and on startup if that did not finish). Secondary keys of
+# previous versions keep their files in the storage directory.
+NAMESPACE_PREFIX = 'namespace_'
+DROPPED_PREFIX = '_dropped_'
+# Every file starts with FILE_MAGIC, followed by its records: the length and
+# CRC32 of a value and the value in UTF-8. Files without it were written by
+# previous versions (6-byte length, unicode_escape'd value and '\n') and
+# are rewritten on startup, after which FORMAT_FILE marks the directory as
+# migrated.
+FILE_MAGIC = b'PMR1'
+RECORD_HEADER = struct.Struct('<II')
+FORMAT_FILE = '_format'
+LEGACY_LENGTH_BYTES = 6
+# A transaction is written whole to JOURNAL_FILE before it is applied, with
+# the size each appended to file had, and the journal is deleted once it
+# is. One left by a crash is applied again on startup, cutting those files
+# back to their size first, so a transaction lands whole or not at all.
+JOURNAL_FILE = '_journal'
+# 'files' keeps a file per key, 'log' an append-only log of records with an
+# in-memory index (see common.log_persistence_manager)
+FILES_BACKEND = 'files'
+LOG_BACKEND = 'log'
+PERSISTENCE_BACKEND = os.getenv('PERSISTENCE_BACKEND', FILES_BACKEND)
+# When writes reach the disk: 'none' leaves them in the process buffers until
+# they fill up or are read, 'flush' hands every write to the OS (survives a
+# crash of the process, not of the machine), 'fsync' fsyncs every write and
+# 'group' fsyncs all the files written since the last fsync, and the
+# directory once, every GROUP_FSYNC_OPS writes or GROUP_FSYNC_MS after the
+# first of them. commit_transaction(fsync=True) fsyncs whatever the level.
+DURABILITY_NONE = 'none'
+DURABILITY_FLUSH = 'flush'
+DURABILITY_FSYNC = 'fsync'
+DURABILITY_GROUP = 'group'
+DURABILITY = os.getenv('PERSISTENCE_DURABILITY', DURABILITY_FLUSH)
+GROUP_FSYNC_MS = int(os.getenv('PERSISTENCE_GROUP_FSYNC_MS', '10'))
+GROUP_FSYNC_OPS = int(os.getenv('PERSISTENCE_GROUP_FSYNC_OPS', '100'))
+# Files appended to are kept open, up to OPEN_FILES of them (least recently
+# used ones are closed first)
+OPEN_FILES = int(os.getenv('PERSISTENCE_OPEN_FILES', '256'))
+# Deleted keys are appended to the key index of their secondary key as
+# tombstones. The index is rewritten without them in the background once
+# its dead entries (deleted keys and their tombstones) reach
+# INDEX_COMPACTION_MIN_ENTRIES and outnumber its live ones.
+INDEX_COMPACTION_MIN_ENTRIES = int(os.getenv('PERSISTENCE_INDEX_COMPACTION_MIN_ENTRIES', '1000'))
+# Files are written, appended to and read under one of LOCK_STRIPES locks,
+# picked by path, so threads using different keys do not wait for each
+# other. Each lock has its own temp file.
+LOCK_STRIPES = int(os.getenv('PERSISTENCE_LOCK_STRIPES', '64'))
+
+
+def _load_syncfs():
+    # syncfs(2) flushes a whole filesystem in one call, so a group of files
+    # costs a single sync instead of an fsync each. Linux only.
+    try:
+        syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return None
+    syncfs.argtypes = [ctypes.c_int]
+    return syncfs
+
+
+SYNCFS = _load_syncfs()
 
 
 class PersistenceManager:
-    def __init__(self, storage_path='./'):
+    """Key-value storage of a service, safe to use from several threads.
+
+    Transactions are per thread: begin_transaction buffers the writes of
+    the calling thread only.
+    """
+
+    def __new__(cls, *args, **kwargs):
+        if cls is PersistenceManager and PERSISTENCE_BACKEND == LOG_BACKEND:
+            from common.log_persistence_manager import LogPersistenceManager
+            cls = LogPersistenceManager
+        return super().__new__(cls)
+
+    def __init__(self, storage_path='./', durability: str = None):
         if not os.path.exists(storage_path):
             logging.debug(f"Creating storage path: {storage_path}")
             os.makedirs(storage_path)
-        self.storage_path = storage_path
+        self.storage_path = os.path.normpath(storage_path)
+        self.durability = durability or DURABILITY
+        # path -> file open for appending
+        self._handles: OrderedDict[str, object] = OrderedDict()
+        # path -> file written but not fsynced yet, and the directories
+        # where files were created, replaced or deleted since then
+        self._dirty: dict[str, object] = {}
+        self._dirty_ops = 0
+        self._dirty_directories: set[str] = set()
+        self._sync_timer: threading.Timer = None
+        # Group fsyncs run on a timer thread
+        self._sync_lock = threading.RLock()
+        self._locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+        self._local = threading.local()
         self._keys_index: dict[str, dict[str, str]] = {}
+        # secondary key -> directory of its files
+        self._directories: dict[str, str] = {}
+        # secondary key -> its keys, sorted for prefix lookups. Built on the
+        # first lookup and kept up to date after it.
+        self._sorted_keys: dict[str, SortedKeys] = {}
+        # secondary key -> dead entries in its key index file. Writes to the
+        # index files and the compactions of them hold _index_lock.
+        self._index_garbage: dict[str, int] = {}
+        self._index_compactions: set[str] = set()
+        self._index_lock = threading.RLock()
+        # Transactions are journaled one at a time
+        self._journal_lock = threading.Lock()
         self._init_state()
 
-    def _append(self, path, data: str):
+    @property
+    def _transaction(self) -> dict[str, tuple[str, list[str]]]:
+        # path -> (value written with put or None, values appended after
+        # it), of the current thread
+        return getattr(self._local, 'transaction', None)
+
+    @_transaction.setter
+    def _transaction(self, transaction: dict[str, tuple[str, list[str]]]):
+        self._local.transaction = transaction
+
+    def _stripe(self, path) -> int:
+        return hash(path) % len(self._locks)
+
+    def _encode(self, data: str) -> bytes:
+        data = data.encode()
+        return RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+
+    def _append(self, path, data: str, fsync: bool = False):
+        self._append_many(path, [data], fsync)
+
+    def _append_many(self, path, values: list[str], fsync: bool = False):
         try:
             logging.debug(f"Appending to {path}")
-            data = data.encode('unicode_escape')
-            data += b'\n'
-            length_bytes = len(data).to_bytes(
-                LENGTH_BYTES, byteorder='big')
-            with open(path, 'ab') as f:
-                f.write(length_bytes + data)
-                f.flush()
+            data = b''.join(self._encode(value) for value in values)
+            with self._locks[self._stripe(path)]:
+                f = self._handle(path)
+                f.write(data)
+                self._written(path, f, fsync)
         except Exception as e:
             logging.error(f"Error appending to {path}: {e}")
 
-    def _write(self, path, data: str):
+    def _write(self, path, data: str, appended: list[str] = [], fsync: bool = False):
         try:
             logging.debug(f"Writing to {path}")
-            data = data.encode('unicode_escape')
-            data += b'\n'
-            length_bytes = len(data).to_bytes(
-                LENGTH_BYTES, byteorder='big')
-            temp_path = f'{self.storage_path}/{TEMP_FILE}'
-            with open(temp_path, 'wb') as f:
-                f.write(length_bytes + data)
-                f.flush()
-            os.replace(temp_path, path)
+            data = FILE_MAGIC + b''.join(self._encode(value) for value in [data, *appended])
+            stripe = self._stripe(path)
+            with self._locks[stripe]:
+                self._close_handle(path, discard=True)
+                temp_path = f'{os.path.dirname(path)}/{TEMP_FILE}_{stripe}'
+                f = open(temp_path, 'wb')
+                f.write(data)
+                # Made durable before it replaces path, or kept open until the
+                # next sync, which fsyncs it under its new name
+                self._written(path, f, fsync)
+                os.replace(temp_path, path)
+                self._directory_changed(path)
+                with self._sync_lock:
+                    if self._dirty.get(path) is not f:
+                        f.close()
         except Exception as e:
             logging.error(f"Error writing to {path}: {e}")
 
-    def _read(self, path):
+    def _handle(self, path, header: bytes = FILE_MAGIC):
+        """Returns the cached file open for appending to path, opening it (and writing header if it has none yet) if needed."""
+        # Index compactions close handles from their own thread
+        with self._sync_lock:
+            f = self._handles.get(path)
+            if f is not None:
+                self._handles.move_to_end(path)
+                return f
+            if len(self._handles) >= OPEN_FILES:
+                self._evict_handle()
+            created = not os.path.exists(path)
+            f = open(path, 'ab')
+            self._handles[path] = f
+            # Also when a crash left the file empty, or with part of header
+            if f.tell() < len(header):
+                f.truncate(0)
+                f.write(header)
+            if created:
+                self._directory_changed(path)
+            return f
+
+    def _evict_handle(self):
+        """Closes the least recently used handle that no other thread is writing to."""
+        for path in self._handles:
+            lock = self._locks[self._stripe(path)]
+            if lock.acquire(blocking=False):
+                try:
+                    self._close(path, self._handles.pop(path))
+                finally:
+                    lock.release()
+                return
+
+    def _close_handle(self, path, discard: bool = False):
+        with self._sync_lock:
+            f = self._handles.pop(path, None)
+            if f is not None:
+                self._close(path, f, discard)
+
+    def _close(self, path, f, discard: bool = False):
+        """Closes f, first fsyncing it if it has unsynced writes, unless they are discarded."""
+        with self._sync_lock:
+            if self._dirty.get(path) is f:
+                self._dirty.pop(path)
+                if not discard:
+                    f.flush()
+                    os.fsync(f.fileno())
+            f.close()
+
+    def _written(self, path, f, fsync: bool = False):
+        """Makes the writes to f, the file of path, as durable as the durability level says.
+
+        With fsync, they are only fsynced on the next sync(), so several
+        files can be written before fsyncing all of them together.
+        """
+        if self.durability == DURABILITY_NONE and not fsync:
+            return
+        f.flush()
+        if self.durability == DURABILITY_FLUSH and not fsync:
+            return
+        if self.durability == DURABILITY_FSYNC and not fsync:
+            os.fsync(f.fileno())
+            if self._dirty_directories:
+                self._fsync_directories()
+            return
+        with self._sync_lock:
+            previous = self._dirty.get(path)
+            if previous is not None and previous is not f and self._handles.get(path) is not previous:
+                # A replaced temp file, f is the file of path now
+                previous.close()
+            self._dirty[path] = f
+            if not fsync:
+                self._schedule_sync()
+
+    def _directory_changed(self, path: str = None):
+        """Notes that the file at path, in the storage directory by default, was created, replaced or deleted."""
+        with self._sync_lock:
+            self._dirty_directories.add(os.path.dirname(path) if path else self.storage_path)
+        if self.durability == DURABILITY_FSYNC:
+            self._fsync_directories()
+        elif self.durability == DURABILITY_GROUP:
+            with self._sync_lock:
+                self._schedule_sync(ops=0)
+
+    def _schedule_sync(self, ops: int = 1):
+        self._dirty_ops += ops
+        if self._dirty_ops >= GROUP_FSYNC_OPS:
+            self.sync()
+        elif self._sync_timer is None:
+            self._sync_timer = threading.Timer(GROUP_FSYNC_MS / 1000, self.sync)
+            self._sync_timer.daemon = True
+            self._sync_timer.start()
+
+    def _fsync_directories(self):
+        with self._sync_lock:
+            (directories, self._dirty_directories) = (self._dirty_directories, set())
+        for directory in directories:
+            try:
+                self._fsync_directory(directory)
+            except FileNotFoundError:
+                # A namespace dropped meanwhile
+                pass
+
+    def _fsync_directory(self, directory: str = None):
+        fd = os.open(directory or self.storage_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _syncfs(self):
+        fd = os.open(self.storage_path, os.O_RDONLY)
+        try:
+            if SYNCFS(fd) != 0:
+                raise OSError(ctypes.get_errno(), "syncfs failed")
+        finally:
+            os.close(fd)
+        self._dirty_directories = set()
+
+    def sync(self):
+        """fsyncs every file written since the last sync, and then their directories once.
+
+        Several files are synced together with a single syncfs where available.
+        """
+        with self._sync_lock:
+            if self._sync_timer is not None:
+                self._sync_timer.cancel()
+                self._sync_timer = None
+            try:
+                for f in self._dirty.values():
+                    f.flush()
+                if SYNCFS is not None and len(self._dirty) > 1:
+                    self._syncfs()
+                else:
+                    for f in self._dirty.values():
+                        os.fsync(f.fileno())
+                    self._fsync_directories()
+                for path, f in self._dirty.items():
+                    if self._handles.get(path) is not f:
+                        f.close()
+            except Exception as e:
+                logging.error(f"Error syncing {self.storage_path}: {e}")
+            self._dirty = {}
+            self._dirty_ops = 0
+
+    def _iter_file(self, path) -> Iterator[str]:
+        """Yields the values stored in the file at path one at a time.
+
+        The file is truncated at the first torn or corrupted record, which
+        is the end of the last complete write.
+        """
         try:
             logging.debug(f"Reading from {path}")
             with open(path, 'rb') as f:
-                data = ''
-                while (length := f.read(LENGTH_BYTES)):
-                    length = int.from_bytes(length, byteorder='big')
-                    content = f.readline()
-                    if len(content) == length:
-                        data += content.decode('unicode_escape')
-                    else:
-                        logging.error(f"Corrupted data in {path} expected {length} bytes, got {len(content)} bytes")
-                        logging.error(f"Content: {content}")
-                return data
+                # Records appended after this point, possibly while they are
+                # read, are left for the next read
+                with self._locks[self._stripe(path)]:
+                    if self.durability == DURABILITY_NONE and path in self._handles:
+                        self._handles[path].flush()
+                    size = os.fstat(f.fileno()).st_size
+                magic = f.read(len(FILE_MAGIC))
+                if magic != FILE_MAGIC:
+                    # Created by a write that did not get to its header
+                    if not FILE_MAGIC.startswith(magic):
+                        logging.error(f"Unknown format in {path}")
+                    return
+                position = len(FILE_MAGIC)
+                while position < size:
+                    header = f.read(RECORD_HEADER.size)
+                    data = None
+                    if len(header) == RECORD_HEADER.size:
+                        (length, crc) = RECORD_HEADER.unpack(header)
+                        data = f.read(length)
+                        if len(data) != length or zlib.crc32(data) != crc:
+                            data = None
+                    if data is None:
+                        logging.error(f"Corrupted record in {path} at byte {position}, truncating it")
+                        with self._locks[self._stripe(path)]:
+                            # Unless path was replaced since it was opened
+                            if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                                os.truncate(path, position)
+                        return
+                    position += RECORD_HEADER.size + length
+                    yield data.decode()
         except OSError as e:
             if e.errno == 2:  # File not found
-                return ''
+                return
             logging.error(f"Error reading from {path}: {e}")
 
     def _delete(self, path):
         try:
             logging.debug(f"Deleting {path}")
-            os.remove(path)
+            with self._locks[self._stripe(path)]:
+                self._close_handle(path, discard=True)
+                os.remove(path)
+            self._directory_changed(path)
         except Exception as e:
             logging.error(f"Error deleting {path}: {e}")
 
     def put(self, key: str, value: str, secondary_key: str = 'default'):
         try:
-            path = f'{self.storage_path}/{self._get_internal_key(key, secondary_key)}'
+            path = self._path(key, secondary_key)
             logging.debug(f"Putting value: {value} for key: {key}")
-            self._write(path, value)
+            if self._transaction is not None:
+                self._transaction[path] = (value, [])
+            else:
+                self._write(path, value)
         except Exception as e:
             logging.error(f"Error putting value: {value} for key: {key}: {e}")
 
     def get(self, key: str, secondary_key: str = 'default') -> str:
+        return '\n'.join(self.iter_records(key, secondary_key))
+
+    def iter_records(self, key: str, secondary_key: str = 'default') -> Iterator[str]:
+        """Yields the value put to key and the ones appended after it, one at a time.
+
+        Same values as get() joins, without building the whole string, so
+        long append logs are read in linear time and constant memory.
+        """
         if key not in self._keys_index.get(secondary_key, {}):
-            return ''
-        path = f'{self.storage_path}/{self._get_internal_key(key, secondary_key)}'
-        return self._read(path).removesuffix('\n')
+            return
+        path = self._path(key, secondary_key)
+        if self._transaction is not None and path in self._transaction:
+            (value, appended) = self._transaction[path]
+            if value is None:
+                yield from self._iter_file(path)
+            else:
+                yield value
+            yield from appended
+        else:
+            yield from self._iter_file(path)
 
     def append(self, key: str, value: str, secondary_key: str = 'default'):
         try:
-            path = f'{self.storage_path}/{self._get_internal_key(key, secondary_key)}'
+            path = self._path(key, secondary_key)
             logging.debug(f"Appending value: {value} for key: {key}")
-            self._append(path, value)
+            if self._transaction is not None:
+                self._transaction.setdefault(path, (None, []))[1].append(value)
+            else:
+                self._append(path, value)
         except Exception as e:
             logging.error(f"Error appending value: {value} for key: {key}: {e}")
 
+    def begin_transaction(self):
+        """Buffers every put/append in memory until commit_transaction.
+
+        Used to group the writes of several messages into a single write per
+        key. Keys created during the transaction are indexed right away, so
+        a crash before committing only loses the buffered values, and
+        commit_transaction applies all of them or none (see JOURNAL_FILE).
+        """
+        if self._transaction is None:
+            self._transaction = {}
+
+    def commit_transaction(self, fsync: bool = False):
+        transaction = self._transaction
+        self._transaction = None
+        if not transaction:
+            return
+        logging.debug(f"Committing transaction with {len(transaction)} keys")
+        if len(transaction) == 1 and next(iter(transaction.values()))[0] is not None:
+            # A single put replaces its file whole already
+            self._apply(transaction, fsync)
+            return
+        with self._journal_lock:
+            self._write_journal(transaction, fsync)
+            self._apply(transaction, fsync)
+            self._delete(f'{self.storage_path}/{JOURNAL_FILE}')
+
+    def _apply(self, transaction: dict[str, tuple[str, list[str]]], fsync: bool = False):
+        for path, (value, appended) in transaction.items():
+            if value is None:
+                self._append_many(path, appended, fsync)
+            else:
+                self._write(path, value, appended, fsync)
+        # Out of the buffers before the journal goes, whatever the durability
+        self._flush_handles(transaction)
+        if fsync:
+            self.sync()
+
+    def _flush_handles(self, paths):
+        with self._sync_lock:
+            for path in paths:
+                f = self._handles.get(path)
+                if f is not None:
+                    f.flush()
+
+    def _write_journal(self, transaction: dict[str, tuple[str, list[str]]], fsync: bool = False):
+        """Writes transaction to JOURNAL_FILE as [path, value, appended, size before appending] entries."""
+        self._flush_handles(transaction)
+        entries = []
+        for path, (value, appended) in transaction.items():
+            size = os.path.getsize(path) if value is None and os.path.exists(path) else None
+            entries.append([os.path.relpath(path, self.storage_path), value, appended, size])
+        journal_path = f'{self.storage_path}/{JOURNAL_FILE}'
+        # Renamed into place, so a journal is always complete
+        with open(f'{journal_path}.new', 'w') as f:
+            json.dump(entries, f)
+            if fsync or self.durability == DURABILITY_FSYNC:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(f'{journal_path}.new', journal_path)
+        self._directory_changed(journal_path)
+
+    def _replay_journal(self):
+        """Applies again the transaction of a journal left by a crash, if there is one."""
+        journal_path = f'{self.storage_path}/{JOURNAL_FILE}'
+        if not os.path.exists(journal_path):
+            return
+        with open(journal_path) as f:
+            entries = json.load(f)
+        logging.info(f"Replaying journal of a transaction with {len(entries)} keys")
+        for [name, value, appended, size] in entries:
+            path = f'{self.storage_path}/{name}'
+            if not os.path.isdir(os.path.dirname(path)):
+                # Its namespace was dropped after the transaction
+                continue
+            if value is not None:
+                self._write(path, value, appended, fsync=True)
+                continue
+            if os.path.exists(path):
+                if size is None:
+                    # Recreated with its header by the append
+                    os.remove(path)
+                elif os.path.getsize(path) > size:
+                    os.truncate(path, size)
+            self._append_many(path, appended, fsync=True)
+        self.sync()
+        self._delete(journal_path)
+        self._fsync_directory()
+
     def get_keys(self, prefix='', secondary_key: str = None) -> list[tuple[str, str]]:
         try:
             logging.debug(f"Getting keys with prefix: {prefix}, secondary_key: {secondary_key}")
             keys = []
-            for _secondary_key in [secondary_key] if secondary_key else self._keys_index.keys():
-                keys.extend([(key, _secondary_key) for key in self._keys_index.get(_secondary_key, {}) if key.startswith(prefix)])
+            with self._index_lock:
+                for _secondary_key in [secondary_key] if secondary_key else list(self._keys_index.keys()):
+                    keys.extend([(key, _secondary_key) for key in self._keys_with_prefix(prefix, _secondary_key)])
             return keys
         except Exception as e:
             logging.error(f"Error getting keys with prefix: {prefix}: {e}")
@@ -106,40 +523,209 @@ class PersistenceManager:
 
     def delete_keys(self, prefix: str = '', secondary_key: str = 'default'):
         logging.debug(f"Deleting keys by prefix: {prefix}, secondary_key: {secondary_key}")
+        if secondary_key not in self._keys_index:
+            return
         try:
-            keys_to_delete = self.get_keys(prefix, secondary_key)
-            for (key, secondary_key) in keys_to_delete:
-                path = f'{self.storage_path}/{self._keys_index[secondary_key][key]}'
-                self._delete(path)
-                self._keys_index[secondary_key].pop(key)
-                logging.debug(f"Deleted key: {key}")
-            new_keys = [json.dumps([key, value]) for key, value in self._keys_index[secondary_key].items()]
-            if len(new_keys) == 0:
-                self._delete(f'{self.storage_path}/{KEYS_INDEX_KEY_PREFIX}{secondary_key}')
-            else:
-                self._write(f'{self.storage_path}/{KEYS_INDEX_KEY_PREFIX}{secondary_key}', '\n'.join(new_keys))
+            with self._index_lock:
+                directory = self._directories[secondary_key]
+                if not prefix and directory != self.storage_path:
+                    self._drop_namespace(secondary_key)
+                    return
+                deleted = self._pop_keys(prefix, secondary_key)
+                if secondary_key not in self._keys_index and directory != self.storage_path:
+                    self._drop_namespace(secondary_key)
+                    return
+                for (key, internal_key) in deleted:
+                    path = f'{directory}/{internal_key}'
+                    if self._transaction is not None:
+                        self._transaction.pop(path, None)
+                    self._delete(path)
+                    logging.debug(f"Deleted key: {key}")
+                index_path = self._index_path(secondary_key)
+                if secondary_key not in self._keys_index:
+                    self._index_garbage.pop(secondary_key, None)
+                    self._directories.pop(secondary_key)
+                    self._delete(index_path)
+                elif deleted:
+                    self._append(index_path, '\n'.join(json.dumps([key, None]) for (key, _internal_key) in deleted))
+                    garbage = self._index_garbage.get(secondary_key, 0) + 2 * len(deleted)
+                    self._index_garbage[secondary_key] = garbage
+                    self._maybe_compact_index(secondary_key)
         except Exception as e:
             logging.error(f"Error deleting keys by prefix: {prefix}: {e}")
 
+    def _drop_namespace(self, secondary_key: str):
+        """Deletes every key of secondary_key by renaming its directory away, which is removed in the background."""
+        directory = self._directories.pop(secondary_key)
+        self._keys_index.pop(secondary_key, None)
+        self._sorted_keys.pop(secondary_key, None)
+        self._index_garbage.pop(secondary_key, None)
+        with self._sync_lock:
+            paths = [path for path in {*self._handles, *self._dirty} if path.startswith(f'{directory}/')]
+        for path in paths:
+            with self._locks[self._stripe(path)]:
+                self._close_handle(path, discard=True)
+                with self._sync_lock:
+                    f = self._dirty.pop(path, None)
+                    if f is not None:
+                        f.close()
+        with self._sync_lock:
+            self._dirty_directories.discard(directory)
+        if self._transaction is not None:
+            for path in [path for path in self._transaction if path.startswith(f'{directory}/')]:
+                self._transaction.pop(path)
+        dropped = f'{self.storage_path}/{DROPPED_PREFIX}{uuid.uuid4()}'
+        os.rename(directory, dropped)
+        self._directory_changed()
+        logging.debug(f"Dropped namespace {secondary_key}")
+        self._remove_in_background(dropped)
+
+    def _remove_in_background(self, directory: str):
+        threading.Thread(target=shutil.rmtree, args=(directory,), kwargs={'ignore_errors': True}, daemon=True).start()
+
+    def _path(self, key: str, secondary_key: str) -> str:
+        internal_key = self._get_internal_key(key, secondary_key)
+        return f'{self._directories[secondary_key]}/{internal_key}'
+
+    def _index_path(self, secondary_key: str) -> str:
+        return f'{self._directories[secondary_key]}/{KEYS_INDEX_KEY_PREFIX}{secondary_key}'
+
+    def _keys_with_prefix(self, prefix: str, secondary_key: str) -> list[str]:
+        keys = self._keys_index.get(secondary_key)
+        if not keys:
+            return []
+        if not prefix:
+            return list(keys)
+        return self._sorted(secondary_key).with_prefix(prefix)
+
+    def _pop_keys(self, prefix: str, secondary_key: str) -> list[tuple[str, object]]:
+        """Removes the keys of secondary_key that start with prefix from the index, returns them with their values.
+
+        Drops the secondary key when none are left.
+        """
+        keys = self._keys_index.get(secondary_key)
+        if not keys:
+            return []
+        if not prefix:
+            self._sorted_keys.pop(secondary_key, None)
+            return list(self._keys_index.pop(secondary_key).items())
+        popped = [(key, keys.pop(key)) for key in self._sorted(secondary_key).remove_prefix(prefix)]
+        if not keys:
+            self._keys_index.pop(secondary_key)
+            self._sorted_keys.pop(secondary_key)
+        return popped
+
+    def _sorted(self, secondary_key: str) -> SortedKeys:
+        sorted_keys = self._sorted_keys.get(secondary_key)
+        if sorted_keys is None:
+            sorted_keys = self._sorted_keys[secondary_key] = SortedKeys(self._keys_index[secondary_key])
+        return sorted_keys
+
+    def _key_added(self, key: str, secondary_key: str):
+        sorted_keys = self._sorted_keys.get(secondary_key)
+        if sorted_keys is not None:
+            sorted_keys.add(key)
+
+    def _maybe_compact_index(self, secondary_key: str):
+        garbage = self._index_garbage.get(secondary_key, 0)
+        if garbage < max(INDEX_COMPACTION_MIN_ENTRIES, len(self._keys_index.get(secondary_key, {}))):
+            return
+        if secondary_key not in self._index_compactions:
+            self._index_compactions.add(secondary_key)
+            threading.Thread(target=self._compact_index, args=(secondary_key,), daemon=True).start()
+
+    def _compact_index(self, secondary_key: str):
+        """Rewrites the key index file of secondary_key with its live entries only."""
+        with self._index_lock:
+            self._index_compactions.discard(secondary_key)
+            keys = self._keys_index.get(secondary_key)
+            if not keys or secondary_key not in self._index_garbage:
+                return
+            logging.debug(f"Compacting key index of {secondary_key}, "
+                          f"{self._index_garbage[secondary_key]} dead entries, {len(keys)} live")
+            entries = '\n'.join(json.dumps([key, internal_key]) for key, internal_key in keys.items())
+            self._write(self._index_path(secondary_key), entries)
+            self._index_garbage.pop(secondary_key)
+
     def _get_internal_key(self, key: str, secondary_key: str = 'default') -> str:
         internal_key = self._keys_index.get(secondary_key, {}).get(key)
-        if internal_key is None:
+        if internal_key is not None:
+            return internal_key
+        with self._index_lock:
+            # Another thread may have created it meanwhile
+            internal_key = self._keys_index.get(secondary_key, {}).get(key)
+            if internal_key is not None:
+                return internal_key
             logging.debug(f"Generating internal key for key: {key}, secondary_key: {secondary_key}")
-            if secondary_key not in self._keys_index:
-                self._keys_index[secondary_key] = {}
             internal_key = str(uuid.uuid4())
-            self._keys_index[secondary_key][key] = internal_key
-            self._append(f'{self.storage_path}/{KEYS_INDEX_KEY_PREFIX}{secondary_key}',
-                         json.dumps([key, internal_key]))
+            if secondary_key not in self._directories:
+                directory = f'{self.storage_path}/{NAMESPACE_PREFIX}{secondary_key}'
+                os.makedirs(directory, exist_ok=True)
+                self._directory_changed()
+                self._directories[secondary_key] = directory
+            self._keys_index.setdefault(secondary_key, {})[key] = internal_key
+            self._key_added(key, secondary_key)
+            self._append(self._index_path(secondary_key), json.dumps([key, internal_key]))
         return internal_key
 
     def _init_state(self):
-        for file_name in [file.name for file in os.scandir(self.storage_path)
-                          if file.is_file() and file.name.startswith(KEYS_INDEX_KEY_PREFIX)]:
-            secondary_key = file_name.removeprefix(f'{KEYS_INDEX_KEY_PREFIX}')
-            self._keys_index[secondary_key] = {}
-            for entry in self._read(f'{self.storage_path}/{file_name}').splitlines():
-                [key, value] = json.loads(entry)
-                self._keys_index[secondary_key][key] = value
+        self._replay_journal()
+        migrated = os.path.exists(f'{self.storage_path}/{FORMAT_FILE}')
+        for file in os.scandir(self.storage_path):
+            if file.is_file() and file.name.startswith(KEYS_INDEX_KEY_PREFIX):
+                self._directories[file.name.removeprefix(KEYS_INDEX_KEY_PREFIX)] = self.storage_path
+            elif file.is_dir() and file.name.startswith(NAMESPACE_PREFIX):
+                self._directories[file.name.removeprefix(NAMESPACE_PREFIX)] = file.path
+            elif file.is_dir() and file.name.startswith(DROPPED_PREFIX):
+                self._remove_in_background(file.path)
+        for secondary_key in self._directories:
+            index_path = self._index_path(secondary_key)
+            keys = self._keys_index[secondary_key] = {}
+            if not migrated:
+                self._migrate_file(index_path)
+            # Rewritten indexes and tombstones of a delete are a single value
+            # with an entry per line
+            entries = 0
+            for value in self._iter_file(index_path):
+                for entry in value.splitlines():
+                    [key, internal_key] = json.loads(entry)
+                    if internal_key is None:
+                        keys.pop(key, None)
+                    else:
+                        keys[key] = internal_key
+                    entries += 1
+            if entries > len(keys):
+                self._index_garbage[secondary_key] = entries - len(keys)
+                self._maybe_compact_index(secondary_key)
+        if not migrated:
+            for secondary_key, keys in self._keys_index.items():
+                for internal_key in keys.values():
+                    self._migrate_file(f'{self._directories[secondary_key]}/{internal_key}')
+            with open(f'{self.storage_path}/{FORMAT_FILE}', 'wb') as f:
+                f.write(FILE_MAGIC)
+            self._directory_changed()
         logging.debug(
             f"Initialized PersistenceManager with state: {self._keys_index}")
+
+    def _migrate_file(self, path):
+        """Rewrites a file of a previous version in the current format, unless it already is."""
+        try:
+            with open(path, 'rb') as f:
+                if f.read(len(FILE_MAGIC)) == FILE_MAGIC:
+                    return
+                f.seek(0)
+                values = []
+                while (length := f.read(LEGACY_LENGTH_BYTES)):
+                    length = int.from_bytes(length, byteorder='big')
+                    content = f.readline()
+                    if len(content) == length:
+                        values.append(content[:-1].decode('unicode_escape'))
+                    else:
+                        logging.error(f"Corrupted data in {path} expected {length} bytes, got {len(content)} bytes")
+        except FileNotFoundError:
+            return
+        logging.info(f"Migrating {path} to the current format")
+        if values:
+            self._write(path, values[0], values[1:])
+        else:
+            self._delete(path)
@@ -0,0 +1,93 @@
+import logging
+import math
+import time
+from collections import deque
+
+
+class PrefetchController:
+    """Adapts the prefetch count of a channel to how fast its messages are handled.
+
+    The prefetched messages of an instance should hold about target_latency
+    seconds of work: enough to keep it busy between deliveries, but not so
+    much that a slow stage hoards messages its idle peers could be handling.
+    Every interval seconds the prefetch is recomputed as
+
+        ceil(target_latency / service_time) + peak unacked messages
+
+    where the second term covers messages already handled but still waiting
+    for their ack (group commit, publisher confirms). The result is clamped to
+    [minimum, maximum] and is only applied when it moves more than 20%.
+    """
+
+    def __init__(self,
+                 initial: int,
+                 minimum: int,
+                 maximum: int,
+                 target_latency: float,
+                 interval: float,
+                 history_size: int = 100):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.prefetch = min(max(initial, self.minimum), self.maximum)
+        self.target_latency = target_latency
+        self.interval = interval
+        self.service_time: float = None
+        self.ack_rate: float = None
+        self.history: deque[tuple[float, int]] = deque(maxlen=history_size)
+        self.history.append((time.time(), self.prefetch))
+        self._window_start = time.monotonic()
+        self._busy = 0.0
+        self._processed = 0
+        self._acked = 0
+        self._unacked = 0
+        self._peak_unacked = 0
+
+    def record_message(self, service_time: float):
+        self._busy += service_time
+        self._processed += 1
+        self._unacked += 1
+        self._peak_unacked = max(self._peak_unacked, self._unacked)
+
+    def record_ack(self, count: int = 1):
+        self._acked += count
+        self._unacked = max(0, self._unacked - count)
+
+    def update(self) -> int:
+        """Returns the new prefetch count if it has to change, None otherwise."""
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.interval or not self._processed:
+            return None
+
+        self.service_time = self._busy / self._processed
+        self.ack_rate = self._acked / elapsed
+        wanted = math.ceil(self.target_latency / max(self.service_time, 1e-6)) + self._peak_unacked
+        wanted = min(max(wanted, self.minimum), self.maximum)
+
+        self._window_start = now
+        self._busy = 0.0
+        self._processed = 0
+        self._acked = 0
+        self._peak_unacked = self._unacked
+
+        if abs(wanted - self.prefetch) <= self.prefetch * 0.2 \
+                and wanted not in (self.minimum, self.maximum):
+            return None
+        if wanted == self.prefetch:
+            return None
+        logging.info(f"Prefetch {self.prefetch} -> {wanted} "
+                     f"(service time {self.service_time * 1000:.3f}ms, ack rate {self.ack_rate:.1f}/s)")
+        self.prefetch = wanted
+        self.history.append((time.time(), wanted))
+        return wanted
+
+    def stats(self) -> dict:
+        return {
+            'prefetch': self.prefetch,
+            'service_time_ms': None if self.service_time is None else self.service_time * 1000,
+            'ack_rate': self.ack_rate,
+            'history': list(self.history),
+        }
+
+    def __str__(self):
+        return f"PrefetchController(prefetch={self.prefetch}, bounds=[{self.minimum}, {self.maximum}])"
@@ -0,0 +1,160 @@
+import base64
+import bisect
+import json
+import struct
+import zlib
+from array import array
+
+# Ids above the watermark are kept in fixed-size chunks of CHUNK_SIZE ids,
+# each a sorted array of the ids it holds (2 bytes per id) until it would
+# take as much as a bitmap of the whole chunk, and a bitmap from then on
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+BITMAP_BYTES = CHUNK_SIZE // 8
+ARRAY_MAX = BITMAP_BYTES // 2
+# (chunk index, number of ids, or ARRAY_MAX for a bitmap) of an encoded chunk
+CHUNK_HEADER = struct.Struct('<IH')
+
+
+class ProcessedIds:
+    """Set of processed packet ids of a single client.
+
+    Packet ids are assigned incrementally per client, so instead of keeping
+    every id it keeps a low watermark (every id below it was processed) plus
+    the ids above it, in fixed-size chunks. Consumers of hash-partitioned
+    queues only see a scattered subset of the ids of a client, so their
+    watermark never advances: a chunk costs at most 2 bytes per id it holds
+    and at most one bit per id of its range, and chunks with no ids cost
+    nothing. Once every id of the chunk at the watermark was processed, the
+    chunk is dropped and the watermark moves past it. Membership checks are
+    O(1) on bitmap chunks and O(log n) on array chunks.
+    """
+
+    def __init__(self, watermark: int = 0):
+        self.watermark = watermark
+        self.arrays: dict[int, array] = {}
+        self.bitmaps: dict[int, bytearray] = {}
+        # Number of ids set in each bitmap
+        self.counts: dict[int, int] = {}
+
+    def __contains__(self, packet_id: int) -> bool:
+        if packet_id < self.watermark:
+            return packet_id >= 0
+        chunk = packet_id >> CHUNK_BITS
+        low = packet_id & (CHUNK_SIZE - 1)
+        bitmap = self.bitmaps.get(chunk)
+        if bitmap is not None:
+            return bool(bitmap[low >> 3] & (1 << (low & 7)))
+        ids = self.arrays.get(chunk)
+        if ids is None:
+            return False
+        index = bisect.bisect_left(ids, low)
+        return index < len(ids) and ids[index] == low
+
+    def add(self, packet_id: int):
+        if packet_id < self.watermark or packet_id < 0:
+            return
+        chunk = packet_id >> CHUNK_BITS
+        low = packet_id & (CHUNK_SIZE - 1)
+        bitmap = self.bitmaps.get(chunk)
+        if bitmap is not None:
+            mask = 1 << (low & 7)
+            if bitmap[low >> 3] & mask:
+                return
+            bitmap[low >> 3] |= mask
+            count = self.counts[chunk] = self.counts[chunk] + 1
+        else:
+            ids = self.arrays.get(chunk)
+            if ids is None:
+                ids = self.arrays[chunk] = array('H')
+            # Ids mostly arrive in order
+            if not ids or ids[-1] < low:
+                ids.append(low)
+            else:
+                index = bisect.bisect_left(ids, low)
+                if ids[index] == low:
+                    return
+                ids.insert(index, low)
+            count = len(ids)
+            if count >= ARRAY_MAX:
+                self._to_bitmap(chunk)
+        if chunk == self.watermark >> CHUNK_BITS and count == ((chunk + 1) << CHUNK_BITS) - self.watermark:
+            self._advance_watermark()
+
+    def _to_bitmap(self, chunk: int):
+        bitmap = bytearray(BITMAP_BYTES)
+        ids = self.arrays.pop(chunk)
+        for low in ids:
+            bitmap[low >> 3] |= 1 << (low & 7)
+        self.bitmaps[chunk] = bitmap
+        self.counts[chunk] = len(ids)
+
+    def _count(self, chunk: int) -> int:
+        if chunk in self.bitmaps:
+            return self.counts[chunk]
+        return len(self.arrays.get(chunk, ()))
+
+    def _advance_watermark(self):
+        chunk = self.watermark >> CHUNK_BITS
+        while self._count(chunk) == ((chunk + 1) << CHUNK_BITS) - self.watermark:
+            self.arrays.pop(chunk, None)
+            self.bitmaps.pop(chunk, None)
+            self.counts.pop(chunk, None)
+            chunk += 1
+            self.watermark = chunk << CHUNK_BITS
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes taken by the ids above the watermark."""
+        return (sum(len(ids) * ids.itemsize for ids in self.arrays.values())
+                + len(self.bitmaps) * BITMAP_BYTES)
+
+    def __len__(self):
+        return self.watermark + sum(self.counts.values()) + sum(len(ids) for ids in self.arrays.values())
+
+    def encode(self) -> str:
+        chunks = []
+        for chunk in sorted([*self.arrays, *self.bitmaps]):
+            if chunk in self.bitmaps:
+                chunks.append(CHUNK_HEADER.pack(chunk, ARRAY_MAX) + bytes(self.bitmaps[chunk]))
+            else:
+                ids = self.arrays[chunk]
+                chunks.append(CHUNK_HEADER.pack(chunk, len(ids)) + struct.pack(f'<{len(ids)}H', *ids))
+        data = base64.b64encode(zlib.compress(b''.join(chunks))).decode()
+        return json.dumps({'watermark': self.watermark, 'chunks': data})
+
+    @staticmethod
+    def decode(data: str) -> 'ProcessedIds':
+        decoded = json.loads(data)
+        if isinstance(decoded, list):
+            return ProcessedIds._decode_bitmap(*decoded)
+        processed_ids = ProcessedIds(decoded['watermark'])
+        chunks = zlib.decompress(base64.b64decode(decoded['chunks']))
+        offset = 0
+        while offset < len(chunks):
+            (chunk, length) = CHUNK_HEADER.unpack_from(chunks, offset)
+            offset += CHUNK_HEADER.size
+            if length == ARRAY_MAX:
+                processed_ids.bitmaps[chunk] = bytearray(chunks[offset:offset + BITMAP_BYTES])
+                processed_ids.counts[chunk] = bin(int.from_bytes(
+                    processed_ids.bitmaps[chunk], 'big')).count('1')
+                offset += BITMAP_BYTES
+            else:
+                processed_ids.arrays[chunk] = array('H', struct.unpack_from(f'<{length}H', chunks, offset))
+                offset += length * 2
+        return processed_ids
+
+    @staticmethod
+    def _decode_bitmap(watermark: int, bitmap: str) -> 'ProcessedIds':
+        # Snapshot written by previous versions: a single bitmap of the ids
+        # from the watermark on
+        processed_ids = ProcessedIds(watermark)
+        for (index, byte) in enumerate(zlib.decompress(base64.b64decode(bitmap))):
+            for bit in range(8):
+                if byte & (1 << bit):
+                    processed_ids.add(watermark + (index << 3) + bit)
+        return processed_ids
+
+    def __str__(self):
+        return (f"ProcessedIds(watermark={self.watermark}, "
+                f"chunks={len(self.arrays) + len(self.bitmaps)}, bytes={self.nbytes})")
@@ -0,0 +1,56 @@
+import json
+import os
+
+from common.lazy_packet import LazyPacket
+from common.packet_decoder import PacketDecoder
+from common.packet_type import PACKET_FIELDS
+
+# Fields that no consumer of an output needs, per output queue or exchange,
+# as computed by the docker compose generator, e.g. {"books": ["description"]}
+OUTPUT_PROJECTIONS: dict[str, list[str]] = json.loads(os.getenv('OUTPUT_PROJECTIONS') or '{}')
+
+
+class Projection:
+    """Blanks out (sets to null) the fields of a packet that its consumers do not need.
+
+    Packets keep their shape, so consumers decode them as usual. Packets
+    without any of the fields, or where they are already blank, are
+    returned as they are, so they are not re-encoded.
+    """
+
+    def __init__(self, dropped_fields: list[str]):
+        self.dropped_fields = dropped_fields
+        # Packet type -> indexes of the dropped fields in its payload
+        self.indexes = {packet_type: [i for i, field in enumerate(fields) if field in dropped_fields]
+                        for packet_type, fields in PACKET_FIELDS.items()}
+
+    def apply(self, packet):
+        """Projects a Packet, LazyPacket or encoded packet, returning it unchanged if nothing is dropped."""
+        decoded = PacketDecoder.decode_lazy(packet) if isinstance(packet, (str, bytes)) else packet
+        indexes = self.indexes.get(decoded.packet_type)
+        if not indexes:
+            return packet
+        fields = PACKET_FIELDS[decoded.packet_type]
+        if isinstance(decoded, LazyPacket):
+            if all(decoded.get(fields[i]) is None for i in indexes):
+                return packet
+            payload = list(decoded.payload)
+        else:
+            payload = decoded.payload
+            if all(payload[i] is None for i in indexes):
+                return packet
+            payload = list(payload)
+        for i in indexes:
+            payload[i] = None
+        return PacketDecoder.decode_fields(
+            [decoded.client_id, decoded.packet_id, decoded.packet_type.value, payload])
+
+    @staticmethod
+    def for_output(name: str) -> 'Projection':
+        """Returns the projection of an output queue or exchange, None if it has none.
+
+        Instance queues ({queue}_{i}) take the projection of their queue.
+        """
+        (queue, _separator, suffix) = name.rpartition('_')
+        dropped_fields = OUTPUT_PROJECTIONS.get(name) or (OUTPUT_PROJECTIONS.get(queue) if suffix.isdigit() else None)
+        return Projection(dropped_fields) if dropped_fields else None
@@ -0,0 +1,197 @@
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from collections import deque, namedtuple
+
+# Queues listed in SHM_QUEUES are carried through ring buffers in SHM_PATH
+# (a tmpfs volume shared by the co-located containers) instead of RabbitMQ
+SHM_PATH = os.getenv('SHM_PATH', '/shm')
+SHM_QUEUES = set(json.loads(os.getenv('SHM_QUEUES') or '[]'))
+SHM_CAPACITY = int(os.getenv('SHM_CAPACITY', str(64 * 1024 * 1024)))
+SHM_POLL_MS = int(os.getenv('SHM_POLL_MS', '1'))
+# A producer waits for room in a full ring rather than falling back to
+# RabbitMQ, which would let later records (an EOF among them) overtake the
+# ones in the ring. It warns every SHM_FULL_WARNING_MS while it waits.
+SHM_FULL_WARNING_MS = int(os.getenv('SHM_FULL_WARNING_MS', '5000'))
+
+# Write offset (only producers move it) and committed read offset (only the
+# consumer moves it). Both grow forever, positions are taken modulo capacity.
+HEADER = struct.Struct('<QQ')
+RECORD_LENGTH = struct.Struct('<I')
+
+ShmDeliveryTag = namedtuple('ShmDeliveryTag', ['queue', 'offset'])
+ShmDelivery = namedtuple('ShmDelivery', ['delivery_tag', 'routing_key'])
+
+
+class ShmRing:
+    """Ring buffer of length-prefixed records in a memory-mapped file.
+
+    Every writer holds an exclusive flock on the file, so any number of
+    processes can produce into it. Records become visible to the consumer
+    only once the write offset moves past them, after they were copied.
+    """
+
+    def __init__(self, queue: str, directory: str = SHM_PATH, capacity: int = SHM_CAPACITY):
+        self.queue = queue
+        self.fd = os.open(os.path.join(directory, f'{queue}.ring'), os.O_RDWR | os.O_CREAT, 0o666)
+        with self.locked():
+            if os.fstat(self.fd).st_size < HEADER.size + RECORD_LENGTH.size:
+                os.ftruncate(self.fd, HEADER.size + capacity)
+        # The first one to create the file decides its capacity
+        self.capacity = os.fstat(self.fd).st_size - HEADER.size
+        self.map = mmap.mmap(self.fd, 0)
+
+    def locked(self):
+        return _FileLock(self.fd)
+
+    def offsets(self) -> tuple[int, int]:
+        return HEADER.unpack_from(self.map, 0)
+
+    def set_write_offset(self, offset: int):
+        struct.pack_into('<Q', self.map, 0, offset)
+
+    def set_read_offset(self, offset: int):
+        struct.pack_into('<Q', self.map, 8, offset)
+
+    def write(self, offset: int, data: bytes):
+        position = offset % self.capacity
+        first = min(len(data), self.capacity - position)
+        self.map[HEADER.size + position:HEADER.size + position + first] = data[:first]
+        if first < len(data):
+            self.map[HEADER.size:HEADER.size + len(data) - first] = data[first:]
+
+    def read(self, offset: int, length: int) -> bytes:
+        position = offset % self.capacity
+        first = min(length, self.capacity - position)
+        data = self.map[HEADER.size + position:HEADER.size + position + first]
+        if first < length:
+            data += self.map[HEADER.size:HEADER.size + length - first]
+        return data
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class _FileLock:
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    def __enter__(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class ShmProducer:
+    def __init__(self, ring: ShmRing):
+        self.ring = ring
+
+    def publish(self, body: bytes) -> bool:
+        """Appends a record, waiting for room if the ring is full.
+
+        Returns False if the record could never fit, once every record in
+        the ring was consumed, in which case nothing was written.
+        """
+        record = RECORD_LENGTH.pack(len(body)) + body
+        fits = len(record) <= self.ring.capacity
+        warning = time.monotonic() + SHM_FULL_WARNING_MS / 1000
+        backoff = 0.0005
+        while True:
+            with self.ring.locked():
+                (write_offset, read_offset) = self.ring.offsets()
+                if not fits and write_offset == read_offset:
+                    return False
+                if fits and write_offset + len(record) - read_offset <= self.ring.capacity:
+                    self.ring.write(write_offset, record)
+                    self.ring.set_write_offset(write_offset + len(record))
+                    return True
+            if time.monotonic() >= warning:
+                logging.warning(f"Shared memory queue {self.ring.queue} is full, waiting for its consumer")
+                warning = time.monotonic() + SHM_FULL_WARNING_MS / 1000
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 0.05)
+
+
+class ShmConsumer:
+    """Single consumer of a ring with the ack semantics of a RabbitMQ queue.
+
+    Records are delivered ahead of the committed read offset, which only
+    moves past a record once it and every record before it were acked. A
+    consumer that crashes therefore starts over from its first unacked record.
+    Nacked records are delivered again, straight from the ring.
+    """
+
+    def __init__(self, ring: ShmRing):
+        self.ring = ring
+        (_write_offset, self.next_offset) = ring.offsets()
+        # Delivered records in ring order: offset -> (end offset, acked)
+        self.delivered: dict[int, list] = {}
+        self.requeued: deque[int] = deque()
+
+    @property
+    def unacked(self) -> int:
+        return len(self.delivered)
+
+    def poll(self, limit: int) -> list[tuple[ShmDeliveryTag, bytes]]:
+        deliveries = []
+        while self.requeued and len(deliveries) < limit:
+            offset = self.requeued.popleft()
+            if offset not in self.delivered:
+                continue
+            deliveries.append((ShmDeliveryTag(self.ring.queue, offset), self._read_record(offset)))
+
+        (write_offset, _read_offset) = self.ring.offsets()
+        while self.next_offset < write_offset and len(deliveries) < limit:
+            offset = self.next_offset
+            body = self._read_record(offset)
+            self.next_offset = offset + RECORD_LENGTH.size + len(body)
+            self.delivered[offset] = [self.next_offset, False]
+            deliveries.append((ShmDeliveryTag(self.ring.queue, offset), body))
+        return deliveries
+
+    def _read_record(self, offset: int) -> bytes:
+        (length,) = RECORD_LENGTH.unpack(self.ring.read(offset, RECORD_LENGTH.size))
+        return self.ring.read(offset + RECORD_LENGTH.size, length)
+
+    def ack(self, delivery_tag: ShmDeliveryTag, multiple: bool = False):
+        for offset in self._offsets_up_to(delivery_tag, multiple):
+            self.delivered[offset][1] = True
+
+        committed = None
+        while self.delivered:
+            offset = next(iter(self.delivered))
+            (end_offset, acked) = self.delivered[offset]
+            if not acked:
+                break
+            del self.delivered[offset]
+            committed = end_offset
+        if committed is not None:
+            with self.ring.locked():
+                self.ring.set_read_offset(committed)
+
+    def nack(self, delivery_tag: ShmDeliveryTag, multiple: bool = False):
+        for offset in self._offsets_up_to(delivery_tag, multiple):
+            if offset not in self.requeued:
+                self.requeued.append(offset)
+
+    def _offsets_up_to(self, delivery_tag: ShmDeliveryTag, multiple: bool) -> list[int]:
+        if multiple:
+            return [offset for offset, (_end, acked) in self.delivered.items()
+                    if offset <= delivery_tag.offset and not acked]
+        return [delivery_tag.offset] if delivery_tag.offset in self.delivered else []
+
+
+def open_producer(queue: str) -> ShmProducer:
+    logging.info(f"Publishing to {queue} through shared memory")
+    return ShmProducer(ShmRing(queue))
+
+
+def open_consumer(queue: str) -> ShmConsumer:
+    logging.info(f"Consuming {queue} from shared memory")
+    return ShmConsumer(ShmRing(queue))
@@ -0,0 +1,72 @@
+from bisect import bisect_left, insort
+from typing import Iterable
+
+# Chunks are split once they hold twice as many keys
+CHUNK_SIZE = 1000
+
+
+class SortedKeys:
+    """Set of keys kept sorted, for the prefix lookups of PersistenceManager.
+
+    Keys are kept in sorted chunks of up to 2 * CHUNK_SIZE keys, plus the
+    last key of each chunk to bisect them. Adding a key costs O(log n +
+    CHUNK_SIZE), and listing or removing the keys with a prefix O(log n)
+    plus the keys listed, instead of scanning every key. Keys sharing a
+    prefix are contiguous, so removing them only rebuilds the chunks at
+    both ends of the range.
+    """
+
+    def __init__(self, keys: Iterable[str] = ()):
+        keys = sorted(keys)
+        self._chunks: list[list[str]] = [keys[i:i + CHUNK_SIZE] for i in range(0, len(keys), CHUNK_SIZE)]
+        self._maxes: list[str] = [chunk[-1] for chunk in self._chunks]
+
+    def add(self, key: str):
+        if not self._chunks:
+            self._chunks.append([key])
+            self._maxes.append(key)
+            return
+        i = bisect_left(self._maxes, key)
+        if i == len(self._chunks):
+            i -= 1
+            self._chunks[i].append(key)
+            self._maxes[i] = key
+        else:
+            insort(self._chunks[i], key)
+        chunk = self._chunks[i]
+        if len(chunk) > 2 * CHUNK_SIZE:
+            self._chunks[i:i + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+            self._maxes[i:i + 1] = [chunk[CHUNK_SIZE - 1], chunk[-1]]
+
+    def with_prefix(self, prefix: str) -> list[str]:
+        (keys, _start, _end) = self._range(prefix)
+        return keys
+
+    def remove_prefix(self, prefix: str) -> list[str]:
+        """Removes the keys that start with prefix and returns them."""
+        (keys, (first, start), (last, end)) = self._range(prefix)
+        if not keys:
+            return keys
+        rest = self._chunks[first][:start] + self._chunks[last][end:]
+        self._chunks[first:last + 1] = [rest] if rest else []
+        self._maxes[first:last + 1] = [rest[-1]] if rest else []
+        return keys
+
+    def _range(self, prefix: str) -> tuple[list[str], tuple[int, int], tuple[int, int]]:
+        """Returns the keys that start with prefix, and the (chunk, index) of the first of them and after the last."""
+        keys = []
+        first = bisect_left(self._maxes, prefix)
+        start = bisect_left(self._chunks[first], prefix) if first < len(self._chunks) else 0
+        (chunk, index) = (first, start)
+        while chunk < len(self._chunks):
+            keys_in_chunk = self._chunks[chunk]
+            while index < len(keys_in_chunk) and keys_in_chunk[index].startswith(prefix):
+                keys.append(keys_in_chunk[index])
+                index += 1
+            if index < len(keys_in_chunk):
+                break
+            (chunk, index) = (chunk + 1, 0)
+        if chunk == len(self._chunks) and chunk > first:
+            # The range runs to the end of the last chunk
+            (chunk, index) = (chunk - 1, len(self._chunks[chunk - 1]))
+        return keys, (first, start), (chunk, index)
@@ -0,0 +1,108 @@
+import json
+import logging
+import os
+from typing import Callable
+
+from common.persistence_manager import PersistenceManager
+
+# A client's state is snapshotted once its log holds as many entries as the
+# state has, and at least STATE_SNAPSHOT_MIN_ENTRIES, so snapshots cost
+# O(1) amortized per entry. The minimum must stay above the messages of a
+# group commit (MIDDLEWARE_GROUP_COMMIT_SIZE), see StateLog.snapshot.
+STATE_SNAPSHOT_MIN_ENTRIES = int(os.getenv('STATE_SNAPSHOT_MIN_ENTRIES', '1000'))
+
+SNAPSHOT_KEY = 'snapshot'
+LOG_KEY_PREFIX = 'log_'
+
+
+class StateLog:
+    """Persists the in-memory state of a service, per client, as a snapshot plus a log of deltas.
+
+    The state of a client is a dict, e.g. title -> stats. Instead of writing
+    a whole entry on every change, the service records the delta it applied
+    (e.g. [title, score]), which is appended to the client's log. Once the
+    log is long enough, the whole state of the client is written as a
+    snapshot and a new log is started. On startup every snapshot is loaded
+    and the deltas logged after it are replayed with the same apply function
+    the service uses, so persisting a message costs O(delta) instead of
+    O(state entry).
+
+    Snapshots and logs are numbered by generation. The snapshot of
+    generation g holds every delta of the logs before g, so a crash right
+    after a snapshot never replays a delta twice.
+    """
+
+    def __init__(self,
+                 persistence_manager: PersistenceManager,
+                 name: str,
+                 apply: Callable[[dict, list], None]):
+        self.persistence_manager = persistence_manager
+        self.name = name
+        self.apply = apply
+        # client id -> (generation, entries in its log)
+        self._logs: dict[int, tuple[int, int]] = {}
+
+    def _secondary_key(self, client_id: int) -> str:
+        return f'{self.name}_{client_id}'
+
+    def record(self, client_id: int, delta: list, state: dict):
+        """Logs a delta already applied to state, the client's state, snapshotting it if due."""
+        (generation, entries) = self._logs.get(client_id, (0, 0))
+        self.persistence_manager.append(
+            _log_key(generation), json.dumps(delta), self._secondary_key(client_id))
+        self._logs[client_id] = (generation, entries + 1)
+        if entries + 1 >= max(STATE_SNAPSHOT_MIN_ENTRIES, len(state)):
+            self.snapshot(client_id, state)
+
+    def snapshot(self, client_id: int, state: dict):
+        """Writes the whole state of a client and starts a new log.
+
+        The previous log is only deleted at the next snapshot: under a
+        group commit the snapshot may still be buffered in a transaction,
+        while the files backend deletes keys right away.
+        """
+        (generation, _entries) = self._logs.get(client_id, (0, 0))
+        secondary_key = self._secondary_key(client_id)
+        self.persistence_manager.put(SNAPSHOT_KEY, json.dumps([generation + 1, state]), secondary_key)
+        if generation > 0:
+            self.persistence_manager.delete_keys(_log_key(generation - 1), secondary_key)
+        self._logs[client_id] = (generation + 1, 0)
+        logging.debug(f"Snapshotted {self.name} of client {client_id}, generation {generation + 1}")
+
+    def clear(self, client_id: int):
+        """Deletes the snapshot and logs of a client, which the files backend does in the background."""
+        self.persistence_manager.delete_keys(secondary_key=self._secondary_key(client_id))
+        self._logs.pop(client_id, None)
+
+    def load(self, states: dict[int, dict] = None) -> dict[int, dict]:
+        """Returns the state of every client, from its snapshot and the deltas logged after it.
+
+        Clients without a snapshot replay their log on top of their state in
+        states, if given, e.g. one loaded from an older layout.
+        """
+        states = states if states is not None else {}
+        secondary_keys = {secondary_key for (_key, secondary_key) in self.persistence_manager.get_keys()
+                          if secondary_key.startswith(f'{self.name}_')}
+        for secondary_key in secondary_keys:
+            suffix = secondary_key.removeprefix(f'{self.name}_')
+            if not suffix.isdigit():
+                continue
+            client_id = int(suffix)
+            snapshot = self.persistence_manager.get(SNAPSHOT_KEY, secondary_key)
+            (generation, state) = json.loads(snapshot) if snapshot else (0, states.get(client_id, {}))
+            entries = 0
+            for delta in self.persistence_manager.iter_records(_log_key(generation), secondary_key):
+                self.apply(state, json.loads(delta))
+                entries += 1
+            for (key, _secondary_key) in self.persistence_manager.get_keys(LOG_KEY_PREFIX, secondary_key):
+                if key != _log_key(generation):
+                    # Already in the snapshot
+                    self.persistence_manager.delete_keys(key, secondary_key)
+            states[client_id] = state
+            self._logs[client_id] = (generation, entries)
+        return states
+
+
+def _log_key(generation: int) -> str:
+    # Fixed width, so that deleting a log by prefix never matches another one
+    return f'{LOG_KEY_PREFIX}{generation:010d}'
@@ -49,6 +49,14 @@ def initialize_config():
         config["CONTAINERS"]["FICTION_REVIEW_SENTIMENT_ANALYZER"])
     config_params["docktor"] = int(
         config["CONTAINERS"]["DOCKTOR"])
+    # Optional host of each service (and a DEFAULT one), used to route
+    # packets between co-located stages through shared memory
+    config_params["hosts"] = dict(config["HOSTS"]) if config.has_section("HOSTS") else {}
+    # Optional publisher confirms, with the number of publishes that may
+    # wait for a confirm at once
+    middleware = config["MIDDLEWARE"] if config.has_section("MIDDLEWARE") else {}
+    config_params["publisher_confirms"] = middleware.get("PUBLISHER_CONFIRMS", "false").lower() == "true"
+    config_params["confirm_window"] = int(middleware.get("CONFIRM_WINDOW", "256"))
 
     return config_params
 
@@ -1,9 +1,32 @@
 import json
 
+GROUP_COMMIT_ENV = "MIDDLEWARE_GROUP_COMMIT_SIZE=50"
+SHM_VOLUME = "shm"
+SHM_PATH = "/shm"
+# Large free-text fields, the only ones worth dropping from a packet (a
+# projection makes the producer re-encode every packet it sends), each with
+# the title field of the packets that carry it: books and reviews
+PROJECTABLE_FIELDS = {"description": "title", "text": "book_title"}
+# Outputs whose consumers read review texts are compressed with these
+# settings, as they make up most of the bytes in the broker
+COMPRESSED_FIELD = "text"
+COMPRESSION = {"level": 1, "min_bytes": 4096}
+# Images that do not use the middleware
+NON_MIDDLEWARE_IMAGES = {"client:latest", "docktor:latest"}
+
 
 class ConfigGenerator:
     def __init__(self, config_params):
         self.config_params = config_params
+        self.hosts: dict[str, str] = config_params.get("hosts", {})
+        self.service_instances: dict[str, list[str]] = {}
+        # (router, routed queue, consumer service) of every router
+        self.routed_queues: list[tuple[str, str, str]] = []
+        # Consumed queue -> (consumer service, fields it uses, whether it
+        # forwards the packets to its outputs)
+        self.queue_consumers: dict[str, tuple[str, list[str], bool]] = {}
+        self.exchange_queues: dict[str, list[str]] = {}
+        self.service_outputs: dict[str, list[str]] = {}
         self.config = {
             "name": "tp1",
             "services": {},
@@ -42,6 +65,10 @@ class ConfigGenerator:
         self._generate_review_mean_aggregator()
         self._generate_output_gateway()
         self._generate_docktor()
+        self._assign_shared_memory_queues()
+        self._assign_output_projections()
+        self._assign_compression()
+        self._assign_publisher_confirms()
         return self.config
 
     def _generate_routers(self):
@@ -49,7 +76,7 @@ class ConfigGenerator:
             "book_router_by_author",
             "authors",
             self.config_params["book_router_by_author"],
-            self.config_params["author_decades_counter"],
+            "author_decades_counter",
             {"book_router_by_author": "books"},
             ["books_by_authors"]
         )
@@ -57,7 +84,7 @@ class ConfigGenerator:
             "fiction_book_router_by_title",
             "title",
             self.config_params["fiction_book_router_by_title"],
-            self.config_params["review_filter_by_book_category_fiction"],
+            "review_filter_by_book_category_fiction",
             {"fiction_books": ""},
             ["fiction_books_by_title"]
         )
@@ -65,7 +92,7 @@ class ConfigGenerator:
             "1990_1999_book_router_by_title",
             "title",
             self.config_params["1990_1999_book_router_by_title"],
-            self.config_params["review_filter_by_book_year_1990_1999"],
+            "review_filter_by_book_year_1990_1999",
             {"1990_1999_books": ""},
             ["1990_1999_books_by_title"]
         )
@@ -73,7 +100,7 @@ class ConfigGenerator:
             "fiction_review_router_by_title",
             "book_title",
             self.config_params["fiction_review_router_by_title"],
-            self.config_params["review_filter_by_book_category_fiction"],
+            "review_filter_by_book_category_fiction",
             {"fiction_reviews_filter_router": "reviews"},
             ["fiction_reviews_by_title"]
         )
@@ -81,7 +108,7 @@ class ConfigGenerator:
             "1990_1999_review_router_by_title",
             "book_title",
             self.config_params["1990_1999_review_router_by_title"],
-            self.config_params["review_filter_by_book_year_1990_1999"],
+            "review_filter_by_book_year_1990_1999",
             {"1990_1999_reviews_filter_router": "reviews"},
             ["1990_1999_reviews_by_title"]
         )
@@ -90,7 +117,7 @@ class ConfigGenerator:
             "1990_1999_review_stats_router_by_title",
             "book_title",
             self.config_params["1990_1999_reviews_stats_router_by_title"],
-            self.config_params["review_stats_service"],
+            "review_stats_service",
             {"1990_1999_reviews": ""},
             ["1990_1999_reviews_stats_router_by_title"]
         )
@@ -105,13 +132,29 @@ class ConfigGenerator:
                           input_queues: dict[str, str] = None,
                           output_queues: list[str] = None,
                           output_exchanges: list[str] = None,
-                          instances: int = 1):
+                          instances: int = 1,
+                          fields: list[str] = None,
+                          forwards: bool = False):
+        """Adds the instances of a service.
+
+        fields are the packet fields the service reads from its input
+        queues, and forwards tells whether it publishes those same packets
+        (as filters and routers do), so it also needs whatever its outputs
+        need. Both are used to project the packets sent to it.
+        """
         if volumes is None:
             volumes = []
         volumes.append("storage:/storage")
+        for (queue, exchange) in (input_queues or {}).items():
+            self._declare_consumer(queue, service_name, fields, forwards)
+            if exchange:
+                self.exchange_queues.setdefault(exchange, []).append(queue)
+        self.service_outputs[service_name] = (output_queues or []) + (output_exchanges or [])
+        self.service_instances[service_name] = []
         for instance_id in range(instances):
             instance_suffix = "" if instances == 1 else f"_{instance_id}"
             service_name_instance = f"{service_name}{instance_suffix}"
+            self.service_instances[service_name].append(service_name_instance)
             current_environment = ["PYTHONUNBUFFERED=1",
                                    "LOGGING_LEVEL=INFO",
                                    "PYTHONHASHSEED=1234"]
@@ -157,7 +200,9 @@ class ConfigGenerator:
             input_queues={"books_filter_by_category_computers": "books"},
             output_queues=["computers_books"],
             output_exchanges=[],
-            instances=instances
+            instances=instances,
+            fields=["categories"],
+            forwards=True
         )
 
     def _generate_book_filters_by_category_fiction(self):
@@ -170,7 +215,9 @@ class ConfigGenerator:
             input_queues={"books_filter_by_category_fiction": "books"},
             output_queues=["fiction_books"],
             output_exchanges=[],
-            instances=instances
+            instances=instances,
+            fields=["categories"],
+            forwards=True
         )
 
     def _generate_book_filters_by_year_2000_2023(self):
@@ -184,7 +231,9 @@ class ConfigGenerator:
             input_queues={"computers_books": ""},
             output_queues=["2000_2023_computers_books"],
             output_exchanges=[],
-            instances=instances
+            instances=instances,
+            fields=["year"],
+            forwards=True
         )
 
     def _generate_book_filters_by_year_1990_1999(self):
@@ -198,7 +247,9 @@ class ConfigGenerator:
             input_queues={"book_filter_by_year_1990_1999": "books"},
             output_queues=["1990_1999_books"],
             output_exchanges=[],
-            instances=instances
+            instances=instances,
+            fields=["year"],
+            forwards=True
         )
 
     def _generate_book_filters_by_title_distributed(self):
@@ -211,7 +262,9 @@ class ConfigGenerator:
             input_queues={"2000_2023_computers_books": ""},
             output_queues=["query1_result"],
             output_exchanges=[],
-            instances=instances
+            instances=instances,
+            fields=["title"],
+            forwards=True
         )
 
     def _generate_author_decades_counters(self):
@@ -219,12 +272,13 @@ class ConfigGenerator:
         self._generate_service(
             "author_decades_counter",
             "author_decades_counter:latest",
-            [],
+            [GROUP_COMMIT_ENV],
             ["test_net"],
             input_queues={"books_by_authors": ""},
             output_queues=["query2_result"],
             output_exchanges=[],
-            instances=instances
+            instances=instances,
+            fields=["authors", "year"]
         )
 
     def _generate_review_filters_by_book_year_1990_1999(self):
@@ -239,6 +293,10 @@ class ConfigGenerator:
             output_exchanges=[],
             instances=instances
         )
+        self._declare_consumer("1990_1999_books_by_title",
+                               "review_filter_by_book_year_1990_1999", ["title", "authors"])
+        self._declare_consumer("1990_1999_reviews_by_title",
+                               "review_filter_by_book_year_1990_1999", ["book_title", "score", "text"])
 
     def _generate_review_filters_by_book_category_fiction(self):
         instances = self.config_params[
@@ -253,24 +311,32 @@ class ConfigGenerator:
             output_exchanges=[],
             instances=instances
         )
+        self._declare_consumer("fiction_books_by_title",
+                               "review_filter_by_book_category_fiction", ["title", "authors"])
+        self._declare_consumer("fiction_reviews_by_title",
+                               "review_filter_by_book_category_fiction", ["book_title", "score", "text"])
 
     def _generate_router(self,
                          name: str,
                          field_to_hash: str,
                          instances: int,
-                         target_instances: str,
+                         target_service: str,
                          input_queues: dict[str, str],
                          output_queues: list[str]):
+        for queue in output_queues:
+            self.routed_queues.append((name, queue, target_service))
         self._generate_service(
             name,
             "router:latest",
             [f'HASH_BY_FIELD={field_to_hash}',
-             f'N_INSTANCES={target_instances}'],
+             f'N_INSTANCES={self.config_params[target_service]}'],
             ["test_net"],
             input_queues=input_queues,
             output_queues=output_queues,
             output_exchanges=[],
-            instances=instances
+            instances=instances,
+            fields=[field_to_hash],
+            forwards=True
         )
 
     def _generate_client(self):
@@ -317,6 +383,9 @@ class ConfigGenerator:
              f"RESULT_QUEUES={result_queues}"],
             ["test_net"],
         )
+        # The client shows the title, authors, publisher and year of the
+        # books of query 1; the results of the other queries are shown whole
+        self._declare_consumer("query1_result", "output_gateway", ["title", "authors", "publisher", "year"])
 
     def _generate_review_stats_service(self):
         instances = self.config_params["review_stats_service"]
@@ -324,10 +393,12 @@ class ConfigGenerator:
             "review_stats_service",
             "review_stats_service:latest",
             ['REQUIRED_REVIEWS_BOOKS_OUTPUT_QUEUE="query3_result"',
-             'TOP_BOOKS_OUTPUT_QUEUE="top_10_books"'],
+             'TOP_BOOKS_OUTPUT_QUEUE="top_10_books"',
+             GROUP_COMMIT_ENV],
             ["test_net"],
             input_queues={"1990_1999_reviews_stats_router_by_title": ""},
-            instances=instances
+            instances=instances,
+            fields=["book_title", "score", "authors"]
         )
 
     def _generate_sentiment_analyzer(self):
@@ -339,14 +410,15 @@ class ConfigGenerator:
             ["test_net"],
             input_queues={"fiction_reviews": ""},
             output_queues=["fiction_reviews_sentiment_scores"],
-            instances=instances
+            instances=instances,
+            fields=["book_title", "text"]
         )
 
     def _generate_sentiment_aggregator(self):
         self._generate_service(
             "fiction_review_sentiment_aggregator",
             "sentiment_aggregator:latest",
-            [],
+            [GROUP_COMMIT_ENV],
             ["test_net"],
             input_queues={"fiction_reviews_sentiment_scores": ""},
             output_queues=["query5_result"],
@@ -356,7 +428,7 @@ class ConfigGenerator:
         self._generate_service(
             "review_mean_aggregator",
             "review_mean_aggregator:latest",
-            [],
+            [GROUP_COMMIT_ENV],
             ["test_net"],
             input_queues={"top_10_books": ""},
             output_queues=["query4_result"],
@@ -376,3 +448,124 @@ class ConfigGenerator:
             volumes=["/var/run/docker.sock:/var/run/docker.sock"],
             instances=self.config_params["docktor"]
         )
+
+    def _declare_consumer(self, queue: str, service_name: str, fields: list[str] = None, forwards: bool = False):
+        self.queue_consumers[queue] = (service_name, fields, forwards)
+
+    def _needed_fields(self, output: str) -> set[str]:
+        """Fields needed by the consumers of an output and everything downstream of them.
+
+        None if some of them may need every field, e.g. a queue with an
+        undeclared consumer.
+        """
+        if output in self.exchange_queues:
+            queues = self.exchange_queues[output]
+        elif output in self.queue_consumers:
+            queues = [output]
+        else:
+            return None
+        needed = set()
+        for queue in queues:
+            (service_name, fields, forwards) = self.queue_consumers.get(queue, (None, None, False))
+            if fields is None:
+                return None
+            needed.update(fields)
+            if forwards:
+                for forwarded_output in self.service_outputs.get(service_name, []):
+                    forwarded_fields = self._needed_fields(forwarded_output)
+                    if forwarded_fields is None:
+                        return None
+                    needed.update(forwarded_fields)
+        return needed
+
+    def _assign_output_projections(self):
+        """Tells every producer which fields of its packets no consumer downstream needs.
+
+        Only PROJECTABLE_FIELDS are dropped, and only by the first producer
+        on the way: a service that forwards its packets already receives
+        them without the fields that none of its outputs need.
+        """
+        for (service_name, outputs) in self.service_outputs.items():
+            received = set(PROJECTABLE_FIELDS)
+            forwarded_queues = [queue for (queue, (consumer, _fields, forwards)) in self.queue_consumers.items()
+                                if consumer == service_name and forwards]
+            if forwarded_queues:
+                received = set()
+                for queue in forwarded_queues:
+                    needed = self._needed_fields(queue)
+                    received.update(PROJECTABLE_FIELDS if needed is None else needed)
+            projections = {}
+            for output in outputs:
+                needed = self._needed_fields(output)
+                if needed is None:
+                    continue
+                dropped = [field for (field, title) in PROJECTABLE_FIELDS.items()
+                           if field in received and field not in needed and title in needed]
+                if dropped:
+                    projections[output] = dropped
+            if not projections:
+                continue
+            for instance in self.service_instances[service_name]:
+                self.config["services"][instance]["environment"].append(
+                    f"OUTPUT_PROJECTIONS={json.dumps(projections, separators=(',', ':'))}")
+
+    def _assign_compression(self):
+        """Compresses every output whose consumers, or anything downstream of them, read review texts."""
+        for (service_name, outputs) in self.service_outputs.items():
+            compression = {output: COMPRESSION for output in outputs
+                           if COMPRESSED_FIELD in (self._needed_fields(output) or [])}
+            if not compression:
+                continue
+            for instance in self.service_instances[service_name]:
+                self.config["services"][instance]["environment"].append(
+                    f"MIDDLEWARE_COMPRESSION={json.dumps(compression, separators=(',', ':'))}")
+
+    def _assign_publisher_confirms(self):
+        """Enables publisher confirms on every service that uses the middleware.
+
+        Only the asyncio backend keeps more than one publish waiting for a
+        confirm (the blocking one waits for each before the next), so those
+        services are switched to it.
+        """
+        if not self.config_params.get("publisher_confirms"):
+            return
+        for service in self.config["services"].values():
+            if service["image"] in NON_MIDDLEWARE_IMAGES:
+                continue
+            service["environment"].extend([
+                "MIDDLEWARE_BACKEND=asyncio",
+                "MIDDLEWARE_PUBLISHER_CONFIRMS=true",
+                f"MIDDLEWARE_CONFIRM_WINDOW={self.config_params['confirm_window']}"])
+
+    def _host(self, service_name: str) -> str:
+        return self.hosts.get(service_name, self.hosts.get("default", ""))
+
+    def _assign_shared_memory_queues(self):
+        """Routes the queues between co-located routers and their consumers through shared memory.
+
+        A router and the service it feeds are co-located when they have the
+        same (non-empty) host in the HOSTS section of the config. All their
+        instances then share a tmpfs volume and list the routed queues in
+        SHM_QUEUES. Every instance-suffixed queue has a single consumer, which
+        is what the shared memory rings support.
+        """
+        shm_queues: dict[str, set[str]] = {}
+        for (router, queue, target_service) in self.routed_queues:
+            host = self._host(router)
+            if not host or host != self._host(target_service):
+                continue
+            queues = {f"{queue}_{i}" for i in range(self.config_params[target_service])}
+            for service in [router, target_service]:
+                for instance in self.service_instances[service]:
+                    shm_queues.setdefault(instance, set()).update(queues)
+
+        if not shm_queues:
+            return
+        self.config["volumes"][SHM_VOLUME] = {
+            "driver_opts": {"type": "tmpfs", "device": "tmpfs"}
+        }
+        for (instance, queues) in shm_queues.items():
+            service = self.config["services"][instance]
+            service["environment"].append(f"SHM_PATH={SHM_PATH}")
+            service["environment"].append(f"SHM_QUEUES={json.dumps(sorted(queues))}")
+            service.setdefault("volumes", []).append(f"{SHM_VOLUME}:{SHM_PATH}")
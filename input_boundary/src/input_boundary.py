@@ -1,5 +1,5 @@
 import logging
-from queue import Queue
+from queue import Empty, Queue
 import socket
 import threading
 from concurrent.futures import ThreadPoolExecutor
@@ -19,6 +19,7 @@ QUEUE_SIZE = 10000
 CLIENT_ID_BYTES = 2
 MAX_CONCURRENT_CONNECTIONS = 5
 TIMEOUT = 5
+FLUSH_INTERVAL = 0.1
 CLIENT_ID_KEY = "client_id"
 CLIENT_STATE_PREFIX = "client_state_"
 EOF_STR = "EOF"
@@ -40,7 +41,6 @@ class InputBoundary:
         self.reviews_middleware_sender_thread = None
         self.client_id = 0
         self.persistence_manager = PersistenceManager('../storage/input_boundary')
-        self.persistence_manager_lock = threading.Lock()
         self.books_exchange = books_exchange
         self.reviews_exchange = reviews_exchange
         self._init_state()
@@ -75,8 +75,7 @@ class InputBoundary:
     def __next_client_id(self):
         client_id = self.client_id
         self.client_id += 1
-        with self.persistence_manager_lock:
-            self.persistence_manager.put(CLIENT_ID_KEY, str(self.client_id))
+        self.persistence_manager.put(CLIENT_ID_KEY, str(self.client_id))
         return client_id
 
     def __middleware_sender(self, packet_queue, output_exchange, should_clean_on_eof: bool = False):
@@ -84,19 +83,23 @@ class InputBoundary:
         middleware = Middleware(output_exchanges=[output_exchange])
         while self.should_stop is False:
             try:
-                packet = packet_queue.get(block=True)
+                try:
+                    packet = packet_queue.get(block=True, timeout=FLUSH_INTERVAL)
+                except Empty:
+                    middleware.flush()
+                    continue
                 if packet is None:
                     middleware.shutdown()
                     break
-                middleware.send(packet.encode())
+                middleware.send(packet)
                 if packet.packet_type == PacketType.EOF:
+                    middleware.flush()
                     client_id = packet.client_id
                     logging.info(f"Sent EOF packet for client {client_id} to {output_exchange}")
                     if not should_clean_on_eof:
                         self._change_client_state(client_id, ClientState.SENDING_REVIEWS)
                     else:
-                        with self.persistence_manager_lock:
-                            self.persistence_manager.delete_keys(f"{CLIENT_STATE_PREFIX}{client_id}")
+                        self.persistence_manager.delete_keys(f"{CLIENT_STATE_PREFIX}{client_id}")
             except OSError:
                 logging.error("Middleware closed")
                 break
@@ -181,8 +184,7 @@ class InputBoundary:
                 thread.join()
 
     def _change_client_state(self, client_id: int, new_state: ClientState):
-        with self.persistence_manager_lock:
-            self.persistence_manager.put(f"{CLIENT_STATE_PREFIX}{client_id}", str(new_state))
+        self.persistence_manager.put(f"{CLIENT_STATE_PREFIX}{client_id}", str(new_state))
 
     def _init_state(self):
         for (key, _secondary_key) in self.persistence_manager.get_keys(CLIENT_STATE_PREFIX):
@@ -1,9 +1,15 @@
+import itertools
 import logging
+import os
 import threading
 import time
+from typing import Iterator, Union
 from common.book import Book
+from common.book_index import BookIndex, MappedBookIndex
 from common.eof_packet import EOFPacket
 from common.middleware import CallbackAction, Middleware
+from common.packet_decoder import PacketDecoder
+from common.parked_reviews import ParkedReviews
 from common.review import Review
 from common.review_and_author import ReviewAndAuthor
 from common.persistence_manager import PersistenceManager
@@ -13,6 +19,13 @@ BOOKS_KEY = 'books'
 EOFS_KEY = 'eofs'
 REQUEUE_EOF_KEY = 'should_requeue_eof'
 CLEANUP_TIMEOUT = 60 * 20  # 20 minutes
+# Books of every client are kept in memory up to BOOKS_MEMORY_BYTES, past
+# which the clients with the most are moved to memory mapped indexes in
+# MAPPED_BOOKS_DIRECTORY, under the storage path. Checked every
+# BOOKS_MEMORY_CHECK_INTERVAL books of a client and once loaded on startup.
+BOOKS_MEMORY_BYTES = int(os.getenv('BOOKS_MEMORY_BYTES', str(256 * 1024 * 1024)))
+BOOKS_MEMORY_CHECK_INTERVAL = 1000
+MAPPED_BOOKS_DIRECTORY = 'mapped_books'
 
 
 class ReviewFilter:
@@ -29,13 +42,20 @@ class ReviewFilter:
         self.cluster_size = cluster_size
         self.output_queues = output_queues
         self.output_exchanges = output_exchanges
-        self.books: dict[int, dict[str, str]] = {}
+        self.books: dict[int, Union[BookIndex, MappedBookIndex]] = {}
         self.eofs: set[int] = set()
         self.should_requeue_eof: set[int] = set()
         self.last_packet_timestamp: dict[int, float] = {}
+        # Reviews that arrived before their book, until it does. Parking a
+        # review, taking the reviews of a book that arrived and the books
+        # EOF hold parked_lock, so no review is parked after its book.
+        self.parked_lock = threading.Lock()
+        # (client_id, title) taken from parked, to be sent on by the reviews thread
+        self.ready_to_release: list[tuple[int, str]] = []
 
         self.persistence_manager = PersistenceManager(
             f'../storage/review_filter_{review_input_queue[0]}_{book_input_queue[0]}_{instance_id}')
+        self.parked = ParkedReviews(self.persistence_manager)
         self._init_state()
 
         self.reviews_middleware = None
@@ -46,7 +66,9 @@ class ReviewFilter:
         self.should_stop = False
         self.lock = threading.Lock()
         self.condition = threading.Condition()
-        self.persistence_manager_lock = threading.Lock()
+        # eofs and should_requeue_eof are changed from several threads and
+        # persisted whole, so each change and its put go together
+        self.eofs_lock = threading.Lock()
 
     def start(self):
         self.books_receiver.start()
@@ -106,8 +128,6 @@ class ReviewFilter:
             input_queues={self.book_input_queue[0]: self.book_input_queue[1]},
             callback=self._add_book,
             eof_callback=self.handle_books_eof,
-            output_queues=self.output_queues,
-            output_exchanges=self.output_exchanges,
             instance_id=self.instance_id)
         self.books_middleware.start()
 
@@ -117,6 +137,7 @@ class ReviewFilter:
             output_queues=self.output_queues,
             output_exchanges=self.output_exchanges,
             instance_id=self.instance_id,
+            cluster_size=self.cluster_size,
         )
         self.reviews_middleware.add_input_queue(
             f"{self.review_input_queue[0]}_{self.instance_id}",
@@ -125,114 +146,198 @@ class ReviewFilter:
             eof_callback=self.handle_reviews_eof,
             auto_ack=False
         )
+        # Taken before the middleware existed, e.g. on startup
+        self._release_parked()
         self.reviews_middleware.start()
 
     def _add_book(self, book: Book):
         client_id = book.client_id
+        # Logged first, a mapped index counts the records it was built from
+        self.persistence_manager.append(BOOKS_KEY, json.dumps([book.title, book.authors]), f"{BOOKS_KEY}_{client_id}")
         if client_id not in self.books:
-            self.books[client_id] = {}
-        self.books[client_id][book.title] = book.authors
-        with self.persistence_manager_lock:
-            self.persistence_manager.append(f"{BOOKS_KEY}_{client_id}", json.dumps([book.title, book.authors]))
+            self.books[client_id] = BookIndex()
+        books = self.books[client_id]
+        books.add(book.title, book.authors)
+        if isinstance(books, BookIndex) and len(books) % BOOKS_MEMORY_CHECK_INTERVAL == 0:
+            self._check_books_memory()
+        with self.parked_lock:
+            taken = self.parked.take(client_id, book.title)
+            if taken:
+                self.ready_to_release.append((client_id, book.title))
+        if taken:
+            self._schedule_release()
 
         logging.debug("Received and saved book: %s", book.title)
         if len(self.books[client_id]) % 2000 == 0:
             logging.info("[Client %s] Stored books count: %d", client_id,  len(self.books[client_id]))
 
+    def _book_records(self, client_id: int) -> Iterator[str]:
+        # Written by previous versions as books_<client_id>
+        yield from self.persistence_manager.iter_records(f"{BOOKS_KEY}_{client_id}")
+        yield from self.persistence_manager.iter_records(BOOKS_KEY, f"{BOOKS_KEY}_{client_id}")
+
+    def _load_books(self, client_id: int, books: Union[BookIndex, MappedBookIndex]):
+        """Adds the books logged for the client to books, but the ones a mapped index already has."""
+        skip = books.records if isinstance(books, MappedBookIndex) else 0
+        for book in itertools.islice(self._book_records(client_id), skip, None):
+            [title, authors] = json.loads(book)
+            books.add(title, authors)
+
+    def _mapped_books_path(self, client_id: int) -> str:
+        return f"{self.persistence_manager.storage_path}/{MAPPED_BOOKS_DIRECTORY}/{client_id}"
+
+    def _check_books_memory(self):
+        """Moves the clients with the most books to mapped indexes until the rest fit in BOOKS_MEMORY_BYTES."""
+        in_memory = {client_id: books.nbytes for (client_id, books) in list(self.books.items())
+                     if isinstance(books, BookIndex)}
+        while in_memory and sum(in_memory.values()) > BOOKS_MEMORY_BYTES:
+            client_id = max(in_memory, key=in_memory.get)
+            nbytes = in_memory.pop(client_id)
+            books = MappedBookIndex(self._mapped_books_path(client_id))
+            self._load_books(client_id, books)
+            # Lookups use the books in memory until they are replaced
+            self.books[client_id] = books
+            logging.info("[Client %s] Moved %d books (%d bytes) to a memory mapped index", client_id, len(books), nbytes)
+
+    def _schedule_release(self):
+        # Without a reviews middleware yet, it releases them once created
+        if self.reviews_middleware and not self.should_stop:
+            self.reviews_middleware.call_threadsafe(self._release_parked)
+
+    def _release_parked(self):
+        """Sends on the parked reviews whose book arrived, from the reviews thread."""
+        with self.parked_lock:
+            (ready, self.ready_to_release) = (self.ready_to_release, [])
+        if not ready:
+            return
+        released = 0
+        for (client_id, title) in ready:
+            books = self.books.get(client_id)
+            author = books.get(title) if books is not None else None
+            if author is None:
+                # The client was reset meanwhile
+                continue
+            with self.parked_lock:
+                reviews = self.parked.releasing(client_id, title)
+            for review in reviews:
+                self._send_review(PacketDecoder.decode(review), author)
+                released += 1
+        # Sent before they are removed from disk
+        self.reviews_middleware.flush()
+        with self.parked_lock:
+            for (client_id, title) in ready:
+                self.parked.released(client_id, title)
+        logging.debug("Released %d parked reviews of %d titles", released, len(ready))
+
     def _reset_filter(self, client_id: int):
         logging.info("Starting filter reset for client id %s", client_id)
-        with self.persistence_manager_lock:
-            self.books.pop(client_id, None)
-            self.persistence_manager.delete_keys(f"{BOOKS_KEY}_{client_id}")
+        books = self.books.pop(client_id, None)
+        if isinstance(books, MappedBookIndex):
+            books.remove()
+        # Drops the client's namespace, its files are removed in the background
+        self.persistence_manager.delete_keys(secondary_key=f"{BOOKS_KEY}_{client_id}")
+        self.persistence_manager.delete_keys(f"{BOOKS_KEY}_{client_id}")
+        with self.eofs_lock:
             self.eofs.discard(client_id)
             self.persistence_manager.put(EOFS_KEY, json.dumps(list(self.eofs)))
 
         if client_id in self.should_requeue_eof:
             self.__remove_should_requeue_eof(client_id)
 
+        with self.parked_lock:
+            self.parked.clear(client_id)
+
         with self.lock:
             self.last_packet_timestamp.pop(client_id, None)
 
         logging.info("Filter reset for client id %s", client_id)
 
-    def __add_should_requeue_eof(self, client_id: int):
-        with self.persistence_manager_lock:
-            self.should_requeue_eof.add(client_id)
-            self.persistence_manager.put(REQUEUE_EOF_KEY, json.dumps(list(self.should_requeue_eof)))
-
     def __remove_should_requeue_eof(self, client_id: int):
-        with self.persistence_manager_lock:
+        with self.eofs_lock:
             self.should_requeue_eof.remove(client_id)
             self.persistence_manager.put(REQUEUE_EOF_KEY, json.dumps(list(self.should_requeue_eof)))
 
     def handle_books_eof(self, eof_packet: EOFPacket):
         logging.info(f" [x] Received Books EOF: {eof_packet}")
-        if self.instance_id not in eof_packet.ack_instances:
-            eof_packet.ack_instances.append(self.instance_id)
-            with self.lock:
-                self.last_packet_timestamp[eof_packet.client_id] = time.time()
-        with self.persistence_manager_lock:
-            self.eofs.add(eof_packet.client_id)
-            self.persistence_manager.put(EOFS_KEY, json.dumps(list(self.eofs)))
-
-        if len(eof_packet.ack_instances) == self.cluster_size:
-            logging.debug(f" [x] Finished propagating Books EOF: {eof_packet}")
-        else:
-            self.books_middleware.return_eof(eof_packet)
-            logging.debug(f" [x] Propagated Books EOF: {eof_packet}")
+        with self.lock:
+            self.last_packet_timestamp[eof_packet.client_id] = time.time()
+        with self.parked_lock:
+            with self.eofs_lock:
+                self.eofs.add(eof_packet.client_id)
+                self.persistence_manager.put(EOFS_KEY, json.dumps(list(self.eofs)))
+            # Every book of the client arrived, so parked reviews left have none
+            self.parked.drop(eof_packet.client_id)
 
     def handle_reviews_eof(self, eof_packet: EOFPacket):
-        if (eof_packet.client_id not in self.eofs and eof_packet.client_id in self.books) or eof_packet.client_id in self.should_requeue_eof:
+        # Reviews released before the books EOF go before the reviews EOF
+        self._release_parked()
+        client_id = eof_packet.client_id
+        if (client_id not in self.eofs and (client_id in self.books or client_id in self.parked)) \
+                or client_id in self.should_requeue_eof:
             logging.warning(f"Received reviews EOF for client {eof_packet.client_id} but have to requeue it - requeuing")
             if eof_packet.client_id in self.should_requeue_eof:
                 self.__remove_should_requeue_eof(eof_packet.client_id)
             return CallbackAction.REQUEUE
 
-        if self.instance_id not in eof_packet.ack_instances:
-            eof_packet.ack_instances.append(self.instance_id)
-            self._reset_filter(eof_packet.client_id)
+        self._reset_filter(eof_packet.client_id)
 
-        if len(eof_packet.ack_instances) == self.cluster_size:
-            self.reviews_middleware.send(EOFPacket(
-                eof_packet.client_id,
-                eof_packet.packet_id,
-            ).encode())
-            logging.debug(" [x] Forwarded EOF")
-        else:
-            self.reviews_middleware.return_eof(eof_packet)
+    def _author(self, review: Review) -> str:
+        books = self.books.get(review.client_id)
+        return books.get(review.book_title) if books is not None else None
+
+    def _send_review(self, review: Review, author: str):
+        review_and_author = ReviewAndAuthor(
+            review.book_title,
+            review.score,
+            review.text,
+            author,
+            review.client_id,
+            review.packet_id
+        )
+        self.reviews_middleware.send(review_and_author)
+        logging.debug("Filter passed - review for: %s", review.book_title)
 
     def _filter_review(self, review: Review):
         with self.lock:
             self.last_packet_timestamp[review.client_id] = time.time()
-        if review.book_title in self.books.get(review.client_id, {}):
-            author = self.books[review.client_id][review.book_title]
-            review_and_author = ReviewAndAuthor(
-                review.book_title,
-                review.score,
-                review.text,
-                author,
-                review.client_id,
-                review.packet_id
-            )
-            self.reviews_middleware.send(review_and_author.encode())
-            logging.debug("Filter passed - review for: %s", review.book_title)
-        elif review.client_id not in self.eofs:
-            if review.client_id not in self.should_requeue_eof:
-                self.__add_should_requeue_eof(review.client_id)
-            return CallbackAction.REQUEUE
+        author = self._author(review)
+        if author is None and review.client_id not in self.eofs:
+            with self.parked_lock:
+                # The book or the books EOF may have arrived meanwhile
+                author = self._author(review)
+                if author is None and review.client_id not in self.eofs:
+                    # Persisted, so the review can be acked
+                    self.parked.park(review.client_id, review.book_title, review.encode())
+                    logging.debug("Parked review for: %s", review.book_title)
+                    return CallbackAction.ACK
+        if author is not None:
+            self._send_review(review, author)
 
         return CallbackAction.ACK
 
     def _init_state(self):
         # Load books
+        client_ids = set()
         for (key, secondary_key) in self.persistence_manager.get_keys(BOOKS_KEY):
-            client_id = int(key.removeprefix(f"{BOOKS_KEY}_"))
-            books = self.persistence_manager.get(
-                key, secondary_key).splitlines()
-            self.books[client_id] = {}
-            for book in books:
-                book = json.loads(book)
-                self.books[client_id][book[0]] = book[1]
+            if key == BOOKS_KEY:
+                client_ids.add(int(secondary_key.removeprefix(f"{BOOKS_KEY}_")))
+            else:
+                # Written by previous versions as books_<client_id>
+                client_ids.add(int(key.removeprefix(f"{BOOKS_KEY}_")))
+        mapped_books_directory = f"{self.persistence_manager.storage_path}/{MAPPED_BOOKS_DIRECTORY}"
+        os.makedirs(mapped_books_directory, exist_ok=True)
+        for file in os.scandir(mapped_books_directory):
+            client_id = file.name.split('.')[0]
+            if file.name.endswith('.new') or not client_id.isdigit() or int(client_id) not in client_ids:
+                # Left by a crash while growing it or resetting its client
+                os.remove(file.path)
+        for client_id in client_ids:
+            # Mapped indexes are reopened and only add the books logged after them
+            path = self._mapped_books_path(client_id)
+            books = MappedBookIndex(path) if os.path.exists(f"{path}.table") else BookIndex()
+            self._load_books(client_id, books)
+            self.books[client_id] = books
+            self._check_books_memory()
 
         # Load eofs
         self.eofs = set(json.loads(
@@ -242,8 +347,22 @@ class ReviewFilter:
         for client_id in self.eofs:
             self.last_packet_timestamp[client_id] = time.time()
 
-        # Load should_requeue_eof
+        # Load should_requeue_eof, set by previous versions when they
+        # requeued reviews behind the reviews EOF
         self.should_requeue_eof = set(json.loads(self.persistence_manager.get(REQUEUE_EOF_KEY) or '[]'))
 
+        # Load parked reviews, releasing those whose book arrived before a
+        # crash and dropping those that will get none
+        for client_id in self.parked.load():
+            books = self.books.get(client_id)
+            for title in self.parked.titles(client_id):
+                if books is not None and title in books and self.parked.take(client_id, title):
+                    self.ready_to_release.append((client_id, title))
+            if client_id in self.eofs:
+                self.parked.drop(client_id)
+
+        books_count = {client_id: len(books) for client_id, books in self.books.items()}
+        mapped = [client_id for client_id, books in self.books.items() if isinstance(books, MappedBookIndex)]
         logging.info(
-            f"Initialized state with {self.books}, eofs: {self.eofs}, should_requeue_eof: {self.should_requeue_eof}")
+            f"Initialized state with books per client: {books_count} (memory mapped: {mapped}), eofs: {self.eofs}, should_requeue_eof: {self.should_requeue_eof}, "
+            f"parked reviews to release: {len(self.ready_to_release)} titles")
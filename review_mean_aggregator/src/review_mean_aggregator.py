@@ -37,11 +37,7 @@ class ReviewMeanAggregator:
     def _handle_eof(self, eof_packet: EOFPacket):
         client_id = eof_packet.client_id
         for book_stats in self.books_stats.get(client_id, []):
-            self.middleware.send(book_stats.encode())
-        self.middleware.send(EOFPacket(
-            eof_packet.client_id,
-            eof_packet.packet_id
-        ).encode())
+            self.middleware.send(book_stats)
         if client_id in self.books_stats:
             self.persistence_manager.delete_keys(
                 f"{BOOK_STATS_KEY}_{client_id}")
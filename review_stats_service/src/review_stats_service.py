@@ -3,9 +3,9 @@ from common.book import Book
 from common.book_stats import BookStats
 from common.eof_packet import EOFPacket
 from common.middleware import Middleware
-from common.review import Review
 from common.review_and_author import ReviewAndAuthor
 from common.persistence_manager import PersistenceManager
+from common.state_log import StateLog
 import json
 
 REQUIRED_TOTAL_REVIEWS = 500
@@ -23,6 +23,8 @@ class ReviewStatsService:
         self.persistence_manager = PersistenceManager(
             f'../storage/review_stats_service_{instance_id}')
         self.book_reviews: dict[int, dict[str, str]] = {}
+        # Logs [book_title, score, authors, packet_id] per review
+        self.state_log = StateLog(self.persistence_manager, 'review_stats', self._apply_review)
         self._init_state()
         self.middleware = Middleware(
             input_queues=input_queues,
@@ -31,6 +33,7 @@ class ReviewStatsService:
             eof_callback=self._handle_eof,
             instance_id=instance_id,
             persistence_manager=self.persistence_manager,
+            cluster_size=cluster_size,
         )
         self.required_reviews_books_queue = required_reviews_books_queue
         self.top_books_queue = top_books_queue
@@ -64,7 +67,7 @@ class ReviewStatsService:
         book_stats = BookStats(book_title, average_score,
                                client_id, stats["packet_id"])
         self.middleware.send_to_queue(
-            self.top_books_queue, book_stats.encode())
+            self.top_books_queue, book_stats)
 
     def _send_top_books(self, client_id: int):
         books_required_reviews = self._get_books_with_required_reviews(
@@ -75,52 +78,40 @@ class ReviewStatsService:
             logging.info("Sent top book to queue: %s", book_title)
 
         self.book_reviews[client_id] = {}
+        self.state_log.clear(client_id)
         self.persistence_manager.delete_keys(f"{REVIEW_STATS_KEY_PREFIX}{client_id}_", secondary_key=str(client_id))
         logging.info("Reset state for client: %s", client_id)
 
     def _handle_eof(self, eof_packet: EOFPacket):
         logging.debug(f" [x] Received EOF: {eof_packet}")
-        if self.instance_id not in eof_packet.ack_instances:
-            eof_packet.ack_instances.append(self.instance_id)
-            self._send_top_books(eof_packet.client_id)
+        self._send_top_books(eof_packet.client_id)
 
-        if len(eof_packet.ack_instances) == self.cluster_size:
-            self.middleware.send(
-                EOFPacket(
-                    client_id=eof_packet.client_id,
-                    packet_id=eof_packet.packet_id).encode())
-            logging.debug("Forwarded EOF")
-        else:
-            self.middleware.return_eof(eof_packet)
-
-    def _update_review_stats(self, review: Review):
-        self.book_reviews[review.client_id][review.book_title]["total_reviews"] += 1
-        self.book_reviews[review.client_id][review.book_title]["total_rating"] += review.score
-        self.book_reviews[review.client_id][review.book_title]["packet_id"] = review.packet_id
+    def _apply_review(self, reviews: dict[str, dict], delta: list):
+        [book_title, score, authors, packet_id] = delta
+        if book_title not in reviews:
+            reviews[book_title] = {
+                "total_reviews": 1,
+                "total_rating": score,
+                "authors": authors,
+                "packet_id": packet_id,
+            }
+        # Only update state if it is not a duplicate
+        # (received and saved but then shutdown and restarted before acking the message)
+        elif reviews[book_title]["packet_id"] != packet_id:
+            reviews[book_title]["total_reviews"] += 1
+            reviews[book_title]["total_rating"] += score
+            reviews[book_title]["packet_id"] = packet_id
 
     def _save_review(self, review: ReviewAndAuthor):
         client_id = review.client_id
         if client_id not in self.book_reviews:
             self.book_reviews[client_id] = {}
-        if review.book_title not in self.book_reviews[client_id]:
-            self.book_reviews[client_id][review.book_title] = {
-                "total_reviews": 1,
-                "total_rating": review.score,
-                "authors": review.authors,
-                "packet_id": review.packet_id,
-            }
-        else:
-            # Only update state if it is not a duplicate
-            # (received and saved but then shutdown and restarted before acking the message)
-            if self.book_reviews[client_id][review.book_title]["packet_id"] != review.packet_id:
-                self._update_review_stats(review)
-
-        key = f'{REVIEW_STATS_KEY_PREFIX}{client_id}_{review.book_title}'
-        self.persistence_manager.put(
-            key,
-            json.dumps(self.book_reviews[client_id][review.book_title]),
-            secondary_key=str(client_id)
-        )
+        reviews = self.book_reviews[client_id]
+        # Authors are only needed by the first review of a book
+        authors = review.authors if review.book_title not in reviews else None
+        delta = [review.book_title, review.score, authors, review.packet_id]
+        self._apply_review(reviews, delta)
+        self.state_log.record(client_id, delta, reviews)
         logging.debug("Received and saved review for: %s", review.book_title)
 
         total_reviews = self.book_reviews[client_id][review.book_title]["total_reviews"]
@@ -129,16 +120,16 @@ class ReviewStatsService:
                         "", -1, [], client_id, review.packet_id)
             self.middleware.send_to_queue(
                 self.required_reviews_books_queue,
-                book.encode())
+                book)
             logging.info(f"Sent book to required reviews queue: {book.title}. Client id: {client_id}")
 
     def _init_state(self):
         self.book_reviews = {}
+        # Stats of a book per key, written by previous versions
         for (key, secondary_key) in self.persistence_manager.get_keys(REVIEW_STATS_KEY_PREFIX):
             [client_id, book_title] = key.removeprefix(REVIEW_STATS_KEY_PREFIX).split('_', maxsplit=1)
             client_id = int(client_id)
             stats = json.loads(self.persistence_manager.get(key, secondary_key) or '{}')
-            if client_id not in self.book_reviews:
-                self.book_reviews[client_id] = {}
-            self.book_reviews[client_id][book_title] = stats
+            self.book_reviews.setdefault(client_id, {})[book_title] = stats
+        self.book_reviews = self.state_log.load(self.book_reviews)
         logging.info(f"State initialized with {self.book_reviews}")
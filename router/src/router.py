@@ -1,6 +1,5 @@
 from common.book import Book
 from common.middleware import Middleware
-from common.eof_packet import EOFPacket
 import logging
 
 
@@ -16,10 +15,12 @@ class Router:
         self.middleware: Middleware = Middleware(
             input_queues=input_queues,
             callback=self.route_by_field_hash,
-            eof_callback=self.handle_eof,
             output_queues=output_queues,
             output_exchanges=output_exchanges,
-            n_output_instances=n_instances)
+            n_output_instances=n_instances,
+            cluster_size=cluster_size,
+            cluster_instance_id=instance_id,
+            lazy_decoding=True)
         self.instance_id = instance_id
         self.cluster_size = cluster_size
         self.hash_by_field = hash_by_field
@@ -32,20 +33,6 @@ class Router:
         logging.info(" [x] Graceful shutdown")
         self.middleware.shutdown()
 
-    def handle_eof(self, eof_packet: EOFPacket):
-        logging.debug(f" [x] Received EOF: {eof_packet}")
-        if self.instance_id not in eof_packet.ack_instances:
-            eof_packet.ack_instances.append(self.instance_id)
-
-        if len(eof_packet.ack_instances) == self.cluster_size:
-            self.middleware.send(EOFPacket(
-                eof_packet.client_id,
-                eof_packet.packet_id
-            ).encode(), instance_id=0)
-            logging.debug(f" [x] Sent EOF: {eof_packet}")
-        else:
-            self.middleware.return_eof(eof_packet)
-
     def hash_and_route(self, book: Book, field_value):
         instance_id = hash(field_value) % (self.n_instances)
         self.middleware.send(book.encode(), instance_id)
@@ -3,6 +3,7 @@ from common.book_stats import BookStats
 from common.eof_packet import EOFPacket
 from common.middleware import Middleware
 from common.persistence_manager import PersistenceManager
+from common.state_log import StateLog
 import json
 
 
@@ -17,6 +18,8 @@ class SentimentAggregator:
         self.persistence_manager = PersistenceManager(
             '../storage/sentiment_aggregator')
         self.books_stats: dict[int, dict[str, dict[str, str]]] = {}
+        # Logs [title, score, packet_id] per book stats
+        self.state_log = StateLog(self.persistence_manager, 'book_stats', self._apply_stats)
         self._init_state()
         self.middleware = Middleware(
             input_queues=input_queues,
@@ -50,41 +53,39 @@ class SentimentAggregator:
                           if book_stats.score >= percentile_90_score]
 
             for book_stats in percentile:
-                self.middleware.send(book_stats.encode())
+                self.middleware.send(book_stats)
                 logging.info("Sent book stats: %s", book_stats)
 
-        self.middleware.send(EOFPacket(
-            client_id,
-            eof_packet.packet_id
-        ).encode())
+        self.state_log.clear(client_id)
         self.persistence_manager.delete_keys(f"{BOOK_STATS_PREFIX}{client_id}_")
         self.books_stats.pop(client_id, None)
 
+    def _apply_stats(self, books_stats: dict[str, dict], delta: list):
+        [title, score, packet_id] = delta
+        if title not in books_stats:
+            books_stats[title] = {
+                "total_score": score,
+                "total_reviews": 1,
+                "packet_id": packet_id
+            }
+        # Only update state if it is not a duplicate
+        # (received and saved but then shutdown and restarted before acking the message)
+        elif books_stats[title]["packet_id"] != packet_id:
+            books_stats[title]["total_score"] += score
+            books_stats[title]["total_reviews"] += 1
+            books_stats[title]["packet_id"] = packet_id
+
     def _save_stats(self, book_stats: BookStats):
         client_id = book_stats.client_id
         if client_id not in self.books_stats:
             self.books_stats[client_id] = {}
-
-        if book_stats.title not in self.books_stats[client_id]:
-            self.books_stats[client_id][book_stats.title] = {
-                "total_score": book_stats.score,
-                "total_reviews": 1,
-                "packet_id": book_stats.packet_id
-            }
-        else:
-            # Only update state if it is not a duplicate
-            # (received and saved but then shutdown and restarted before acking the message)
-            if self.books_stats[client_id][book_stats.title]["packet_id"] != book_stats.packet_id:
-                self.books_stats[client_id][book_stats.title]["total_score"] += book_stats.score
-                self.books_stats[client_id][book_stats.title]["total_reviews"] += 1
-                self.books_stats[client_id][book_stats.title]["packet_id"] = book_stats.packet_id
-
-        key = f'{BOOK_STATS_PREFIX}{client_id}_{book_stats.title}'
-        self.persistence_manager.put(key, json.dumps(
-            self.books_stats[book_stats.client_id][book_stats.title]))
+        delta = [book_stats.title, book_stats.score, book_stats.packet_id]
+        self._apply_stats(self.books_stats[client_id], delta)
+        self.state_log.record(client_id, delta, self.books_stats[client_id])
         logging.debug("Received book stats: %s", book_stats)
 
     def _init_state(self):
+        # Stats of a book per key, written by previous versions
         for (key, secondary_key) in self.persistence_manager.get_keys(BOOK_STATS_PREFIX):
             [client_id, book_title] = key.removeprefix(BOOK_STATS_PREFIX).split('_', maxsplit=1)
             client_id = int(client_id)
@@ -92,4 +93,5 @@ class SentimentAggregator:
             if client_id not in self.books_stats:
                 self.books_stats[client_id] = {}
             self.books_stats[client_id][book_title] = book_stats
+        self.books_stats = self.state_log.load(self.books_stats)
         logging.info(f"Initialized with state: {self.books_stats}")
@@ -1,7 +1,6 @@
 import logging
 from textblob import TextBlob
 from common.book_stats import BookStats
-from common.eof_packet import EOFPacket
 from common.middleware import Middleware
 from common.review_and_author import ReviewAndAuthor
 
@@ -16,7 +15,8 @@ class SentimentAnalyzer:
             input_queues=input_queues,
             output_queues=output_queues,
             callback=self._calculate_sentiment,
-            eof_callback=self._handle_eof,
+            cluster_size=cluster_size,
+            cluster_instance_id=instance_id,
         )
         self.instance_id = instance_id
         self.cluster_size = cluster_size
@@ -36,19 +36,6 @@ class SentimentAnalyzer:
             review.client_id,
             review.packet_id
         )
-        self.middleware.send(stats.encode())
+        self.middleware.send(stats)
         logging.debug("Review %s - Sentiment score: %f",
                       review.book_title, sentiment)
-
-    def _handle_eof(self, eof_packet: EOFPacket):
-        if self.instance_id not in eof_packet.ack_instances:
-            eof_packet.ack_instances.append(self.instance_id)
-
-        if len(eof_packet.ack_instances) == self.cluster_size:
-            self.middleware.send(EOFPacket(
-                eof_packet.client_id,
-                eof_packet.packet_id,
-            ).encode())
-            logging.debug("Forwarded EOF")
-        else:
-            self.middleware.return_eof(eof_packet)
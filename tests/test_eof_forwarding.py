@@ -0,0 +1,103 @@
+"""Aggregators emit a single EOF per client, the one Middleware forwards.
+
+Runs the stages on the in-process MemoryBroker, without RabbitMQ:
+
+    python3 -m pytest tests
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+os.environ['MIDDLEWARE_BACKEND'] = 'memory'
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common.book_stats import BookStats  # noqa: E402
+from common.eof_packet import EOFPacket  # noqa: E402
+from common.memory_broker import BROKER  # noqa: E402
+from common.packet_decoder import PacketDecoder  # noqa: E402
+from common.packet_type import PacketType  # noqa: E402
+
+INPUT_QUEUE = 'test_input'
+OUTPUT_QUEUE = 'test_output'
+TIMEOUT_S = 10
+
+
+def load_stage_module(stage: str, module: str):
+    path = os.path.join(ROOT, stage, 'src', f'{module}.py')
+    spec = importlib.util.spec_from_file_location(f'test_{module}', path)
+    stage_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(stage_module)
+    return stage_module
+
+
+def output_messages() -> list:
+    with BROKER.lock:
+        bodies = [body for (body, *_rest) in BROKER.queues.get(OUTPUT_QUEUE, ())]
+    return [PacketDecoder.decode(body) for body in bodies]
+
+
+def output_packets() -> list:
+    packets = []
+    for packet in output_messages():
+        packets.extend(packet.packets if packet.packet_type == PacketType.BATCH else [packet])
+    return packets
+
+
+class EOFForwardingTest(unittest.TestCase):
+    def setUp(self):
+        BROKER.purge()
+        # Stages keep their storage in ../storage
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.directory.name, 'stage'))
+        os.chdir(os.path.join(self.directory.name, 'stage'))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+        BROKER.purge()
+
+    def run_stage(self, stage) -> list:
+        """Feeds books stats and an EOF of a client to stage, returns the packets it outputs."""
+        for i in range(3):
+            BROKER.publish('', INPUT_QUEUE, BookStats(f'Title {i}', float(i), 1, i).encode().encode())
+        BROKER.publish('', INPUT_QUEUE, EOFPacket(1, 3).encode().encode())
+        thread = threading.Thread(target=stage.start)
+        thread.start()
+        deadline = time.monotonic() + TIMEOUT_S
+        while not any(packet.packet_type == PacketType.EOF for packet in output_packets()):
+            self.assertLess(time.monotonic(), deadline, "no EOF was output")
+            time.sleep(0.01)
+        # Anything sent after the EOF would be out by now
+        time.sleep(0.2)
+        stage.shutdown()
+        thread.join(TIMEOUT_S)
+        return output_packets()
+
+    def assert_single_eof(self, packets: list):
+        eofs = [packet for packet in packets if packet.packet_type == PacketType.EOF]
+        self.assertEqual(len(eofs), 1)
+        self.assertEqual(packets[-1].packet_type, PacketType.EOF)
+        self.assertTrue(all(packet.packet_type == PacketType.BOOK_STATS for packet in packets[:-1]))
+        # In a message of its own, not batched with the stats before it
+        self.assertEqual(output_messages()[-1].packet_type, PacketType.EOF)
+
+    def test_review_mean_aggregator(self):
+        module = load_stage_module('review_mean_aggregator', 'review_mean_aggregator')
+        stage = module.ReviewMeanAggregator({INPUT_QUEUE: ''}, [OUTPUT_QUEUE])
+        self.assert_single_eof(self.run_stage(stage))
+
+    def test_sentiment_aggregator(self):
+        module = load_stage_module('sentiment_aggregator', 'sentiment_aggregator')
+        stage = module.SentimentAggregator({INPUT_QUEUE: ''}, [OUTPUT_QUEUE])
+        self.assert_single_eof(self.run_stage(stage))
+
+
+if __name__ == '__main__':
+    unittest.main()
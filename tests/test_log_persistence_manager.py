@@ -0,0 +1,57 @@
+"""The log backend yields the same records before and after compacting them.
+
+    python3 -m pytest tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common import log_persistence_manager  # noqa: E402
+from common.log_persistence_manager import LogPersistenceManager  # noqa: E402
+
+SEGMENT_BYTES = 512
+
+
+class TestCompaction(unittest.TestCase):
+    def setUp(self):
+        self.storage_path = tempfile.mkdtemp()
+        patcher = mock.patch.object(log_persistence_manager, 'LOG_SEGMENT_BYTES', SEGMENT_BYTES)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_path, ignore_errors=True)
+
+    def records(self, manager: LogPersistenceManager) -> dict:
+        return {(key, secondary_key): list(manager.iter_records(key, secondary_key))
+                for (key, secondary_key) in manager.get_keys()}
+
+    def test_records_survive_compaction_and_restart(self):
+        manager = LogPersistenceManager(self.storage_path)
+        for i in range(50):
+            manager.append('log', f'["entry", {i}]', 'client_1')
+            manager.put('state', f'{{"count": {i}}}', 'client_1')
+            manager.append('log', f'line {i}\nwith a newline', 'client_2')
+        manager.put('rewritten', 'first', 'client_2')
+        manager.append('rewritten', 'appended', 'client_2')
+        manager.delete_keys('state', 'client_1')
+        manager.append('log', 'after the last sealed segment', 'client_1')
+        expected = self.records(manager)
+        self.assertGreater(len(manager._sizes), 2)
+
+        manager.compact(force=True)
+        self.assertEqual(self.records(manager), expected)
+        self.assertEqual(len(expected[('log', 'client_1')]), 51)
+
+        reopened = LogPersistenceManager(self.storage_path)
+        self.assertEqual(self.records(reopened), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""ProcessedIds stays small and exact on the scattered ids of a hash-partitioned queue.
+
+    python3 -m pytest tests
+"""
+import base64
+import json
+import os
+import random
+import sys
+import unittest
+import zlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common.processed_ids import CHUNK_SIZE, ProcessedIds  # noqa: E402
+
+IDS = 1_000_000
+PARTITIONS = 64
+PRODUCERS = 3
+
+
+class TestProcessedIds(unittest.TestCase):
+    def interleave(self, ids: list[int], rng: random.Random) -> list[int]:
+        streams = [ids[i::PRODUCERS] for i in range(PRODUCERS)]
+        positions = [0] * PRODUCERS
+        interleaved = []
+        while any(position < len(stream) for (position, stream) in zip(positions, streams)):
+            i = rng.choice([i for i in range(PRODUCERS) if positions[i] < len(streams[i])])
+            burst = streams[i][positions[i]:positions[i] + rng.randint(1, 200)]
+            interleaved.extend(burst)
+            positions[i] += len(burst)
+        return interleaved
+
+    def test_sparse_interleaved_ids(self):
+        rng = random.Random(1)
+        seen = [packet_id for packet_id in range(IDS) if rng.randrange(PARTITIONS) == 0]
+        processed_ids = ProcessedIds()
+        for packet_id in self.interleave(seen, rng):
+            processed_ids.add(packet_id)
+        # Redeliveries
+        for packet_id in rng.sample(seen, 1000):
+            processed_ids.add(packet_id)
+
+        self.assertEqual(processed_ids.watermark, 0)
+        self.assertEqual(len(processed_ids), len(seen))
+        # At most 2 bytes per id, where a bitmap of the whole range takes 1 bit per id
+        self.assertLessEqual(processed_ids.nbytes, 2 * len(seen))
+        self.assertLess(processed_ids.nbytes, IDS // 8 // 3)
+
+        reloaded = ProcessedIds.decode(processed_ids.encode())
+        for ids in [processed_ids, reloaded]:
+            self.assertEqual([packet_id for packet_id in range(IDS) if packet_id in ids], seen)
+        self.assertNotIn(-1, reloaded)
+
+    def test_dense_ids_advance_the_watermark(self):
+        rng = random.Random(2)
+        ids = list(range(3 * CHUNK_SIZE + 10))
+        processed_ids = ProcessedIds()
+        for packet_id in self.interleave(ids, rng):
+            processed_ids.add(packet_id)
+
+        self.assertEqual(processed_ids.watermark, 3 * CHUNK_SIZE)
+        self.assertEqual(len(processed_ids), len(ids))
+        self.assertIn(3 * CHUNK_SIZE + 9, processed_ids)
+        self.assertNotIn(3 * CHUNK_SIZE + 10, processed_ids)
+        self.assertLessEqual(processed_ids.nbytes, 20)
+
+    def test_decodes_previous_bitmap_snapshots(self):
+        ids = [5, 6, 9, 70000, 70001]
+        bitmap = bytearray(70001 // 8 + 1)
+        for packet_id in ids:
+            offset = packet_id - 5
+            bitmap[offset >> 3] |= 1 << (offset & 7)
+        snapshot = json.dumps([5, base64.b64encode(zlib.compress(bytes(bitmap))).decode()])
+
+        processed_ids = ProcessedIds.decode(snapshot)
+        self.assertEqual([packet_id for packet_id in range(70010) if packet_id in processed_ids],
+                         [0, 1, 2, 3, 4] + ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
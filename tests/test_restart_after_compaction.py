@@ -0,0 +1,107 @@
+"""State logged one JSON value per append reloads after the log was compacted, on both backends.
+
+    python3 -m pytest tests
+"""
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common import log_persistence_manager, parked_reviews, persistence_manager  # noqa: E402
+from common.log_persistence_manager import LogPersistenceManager  # noqa: E402
+from common.persistence_manager import FILES_BACKEND, LOG_BACKEND, PersistenceManager  # noqa: E402
+from common.state_log import StateLog  # noqa: E402
+
+CLIENT_ID = 1
+
+
+def load_stage_module(stage: str, module: str):
+    path = os.path.join(ROOT, stage, 'src', f'{module}.py')
+    spec = importlib.util.spec_from_file_location(f'test_{module}', path)
+    stage_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(stage_module)
+    return stage_module
+
+
+def add_score(state: dict, delta: list):
+    (title, score) = delta
+    state[title] = state.get(title, 0) + score
+
+
+def compact(manager: PersistenceManager):
+    # The files backend keeps a file per key and has nothing to compact
+    if isinstance(manager, LogPersistenceManager):
+        manager.compact(force=True)
+
+
+class RestartAfterCompaction:
+    backend: str
+
+    def setUp(self):
+        # Stages keep their storage in ../storage
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.directory.name, 'stage'))
+        os.chdir(os.path.join(self.directory.name, 'stage'))
+        for patcher in [mock.patch.object(persistence_manager, 'PERSISTENCE_BACKEND', self.backend),
+                        mock.patch.object(log_persistence_manager, 'LOG_SEGMENT_BYTES', 1024),
+                        mock.patch.object(parked_reviews, 'PARKED_REVIEWS_IN_MEMORY', 2)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_state_log(self):
+        storage_path = os.path.join(self.directory.name, 'state')
+        manager = PersistenceManager(storage_path)
+        state_log = StateLog(manager, 'stats', add_score)
+        state = {}
+        for i in range(100):
+            delta = [f'Title {i % 7}', i]
+            add_score(state, delta)
+            state_log.record(CLIENT_ID, delta, state)
+        compact(manager)
+
+        reloaded = StateLog(PersistenceManager(storage_path), 'stats', add_score)
+        self.assertEqual(reloaded.load(), {CLIENT_ID: state})
+
+    def test_review_filter(self):
+        review_filter_module = load_stage_module('review_filter', 'review_filter')
+
+        def review_filter():
+            return review_filter_module.ReviewFilter(('books', 'books'), ('reviews', 'reviews'), [], [], 0, 1)
+
+        books = {f'Title {i}': json.dumps([f'Author {i}']) for i in range(50)}
+        reviews = [f'review {i} of the unknown book' for i in range(10)]
+        stage = review_filter()
+        for (title, authors) in books.items():
+            stage.persistence_manager.append(review_filter_module.BOOKS_KEY, json.dumps([title, authors]),
+                                             f'{review_filter_module.BOOKS_KEY}_{CLIENT_ID}')
+        for review in reviews:
+            stage.parked.park(CLIENT_ID, 'Unknown', review)
+        compact(stage.persistence_manager)
+
+        reloaded = review_filter()
+        self.assertEqual({title: reloaded.books[CLIENT_ID].get(title) for title in books}, books)
+        self.assertTrue(reloaded.parked.take(CLIENT_ID, 'Unknown'))
+        self.assertEqual(list(reloaded.parked.releasing(CLIENT_ID, 'Unknown')), reviews)
+
+
+class FilesBackendTest(RestartAfterCompaction, unittest.TestCase):
+    backend = FILES_BACKEND
+
+
+class LogBackendTest(RestartAfterCompaction, unittest.TestCase):
+    backend = LOG_BACKEND
+
+
+if __name__ == '__main__':
+    unittest.main()